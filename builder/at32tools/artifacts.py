@@ -0,0 +1,278 @@
+"""Post-link artifacts generated from one read of the linked ELF.
+
+Every artifact kind is written by a function of the open
+:class:`~at32tools.elf.ElfFile`, and the requested kinds run in parallel.
+A kind is only regenerated when the SHA-256 of the ELF (or its settings)
+differs from the one recorded in ``artifacts.json`` when it was last
+written, so an identical relink costs one hash::
+
+    python artifacts.py firmware.elf .pio/build/<env> bin hex symbols
+
+Kinds:
+
+* ``bin``: ``<name>.bin`` plus the segment files and manifest of a
+  multi-region image (see :mod:`at32tools.segments`)
+* ``hex``: Intel HEX of the load image
+* ``asm``: ``objdump -d -S`` listing (the only one using a tool)
+* ``symbols``: ``symbols_<name>.txt``/``.json``, sized global symbols
+* ``size``: ``size_<name>.txt``, the ``size -B`` totals and region usage
+* ``map``: ``memory_report.json`` from ``linkmap.map``
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools import mapfile, segments  # noqa: E402
+from at32tools.demangle import demangle  # noqa: E402
+from at32tools.elf import SHT_NOBITS, ElfFile  # noqa: E402
+
+KINDS = ("bin", "hex", "asm", "symbols", "size", "map")
+STAMP_NAME = "artifacts.json"
+HASH_CHUNK = 1 << 20
+
+# SCons runs the actions of the artifact groups in threads of one process;
+# the stamp file is read, updated and replaced under this lock
+_stamp_lock = threading.Lock()
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def outputs(kind, build_dir, name):
+    """Files ``kind`` writes (the first is its main output)."""
+    join = os.path.join
+    return {
+        "bin": [join(build_dir, name + ".bin"),
+                segments.manifest_path(join(build_dir, name))],
+        "hex": [join(build_dir, name + ".hex")],
+        "asm": [join(build_dir, name + ".asm")],
+        "symbols": [join(build_dir, "symbols_%s.txt" % name),
+                    join(build_dir, "symbols_%s.json" % name)],
+        "size": [join(build_dir, "size_%s.txt" % name)],
+        "map": [join(build_dir, "memory_report.json")],
+    }[kind]
+
+
+def kind_of(path, build_dir, name):
+    for kind in KINDS:
+        if os.path.abspath(path) in [os.path.abspath(p) for p in outputs(kind, build_dir, name)]:
+            return kind
+    return None
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _ihex_record(kind, address, data):
+    record = struct.pack(">BHB", len(data), address, kind) + data
+    return ":%s%02X\n" % (record.hex().upper(), -sum(record) & 0xFF)
+
+
+def write_hex(elf, path):
+    lines = []
+    upper = None
+    for address, data in elf.load_image():
+        offset = 0
+        while offset < len(data):
+            current = address + offset
+            if current >> 16 != upper:
+                upper = current >> 16
+                lines.append(_ihex_record(4, 0, struct.pack(">H", upper)))
+            length = min(16, len(data) - offset, 0x10000 - (current & 0xFFFF))
+            lines.append(_ihex_record(0, current & 0xFFFF, data[offset:offset + length]))
+            offset += length
+    lines.append(_ihex_record(5, 0, struct.pack(">I", elf.entry)))
+    lines.append(":00000001FF\n")
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def write_symbols(elf, txt_path, json_path):
+    symbols = [sym for sym in elf.symbols() if sym.size and sym.kind.isupper()]
+    symbols.sort(key=lambda sym: (sym.size, sym.name))
+    names = [demangle(sym.name) for sym in symbols]
+    with open(txt_path, "w") as f:
+        for sym, name in zip(symbols, names):
+            f.write("%08x %08x %s %s\n" % (sym.value, sym.size, sym.kind, name))
+    with open(json_path, "w") as f:
+        json.dump([{
+            "name": sym.name, "demangled": name,
+            "address": sym.value, "size": sym.size, "type": sym.kind,
+            "section": sym.section,
+        } for sym, name in zip(symbols, names)], f, indent=1)
+
+
+def size_text(elf, elf_path, regions, limits):
+    text, data, bss = elf.size_totals()
+    lines = [
+        "   text\t   data\t    bss\t    dec\t    hex\tfilename",
+        "%7d\t%7d\t%7d\t%7d\t%7x\t%s" % (
+            text, data, bss, text + data + bss, text + data + bss, elf_path),
+    ]
+    usage = elf.region_usage(regions)
+    for region in regions:
+        lines.append("%-8s %8d / %8d bytes" % (
+            region.name, usage[region.name], limits.get(region.name, region.length)))
+    return "\n".join(lines) + "\n"
+
+
+def _generate(kind, elf, elf_path, build_dir, name, settings):
+    """Write ``kind``; returns a message for the build output or None."""
+    files = outputs(kind, build_dir, name)
+    if kind == "bin":
+        manifest = segments.write(
+            elf_path, files[0][:-len(".bin")], blocks=elf.load_image())
+        if len(manifest["segments"]) > 1:
+            return "Image segments: " + ", ".join(
+                "0x%08X (%d bytes)" % (s["address"], s["size"])
+                for s in manifest["segments"])
+    elif kind == "hex":
+        write_hex(elf, files[0])
+    elif kind == "asm":
+        with open(files[0], "w") as f:
+            result = subprocess.run(
+                [settings.get("objdump") or "arm-none-eabi-objdump", "-d", "-S", elf_path],
+                stdout=f, stderr=subprocess.PIPE, env=settings.get("tool_env"))
+        if result.returncode:
+            os.remove(files[0])
+            raise ArtifactError("objdump failed: %s" % result.stderr.decode(errors="replace"))
+    elif kind == "symbols":
+        write_symbols(elf, files[0], files[1])
+    elif kind == "size":
+        with open(files[0], "w") as f:
+            f.write(size_text(elf, elf_path, settings.get("regions") or [],
+                              settings.get("limits") or {}))
+    elif kind == "map":
+        nobits = set(s.name for s in elf.sections if s.type == SHT_NOBITS)
+        report = mapfile.analyse(
+            mapfile.MapFile(os.path.join(build_dir, "linkmap.map")), build_dir, nobits,
+            settings.get("lib_cache_dir"))
+        with open(files[0], "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return None
+
+
+def _settings_key(kind, settings):
+    if kind == "size":
+        return repr((settings.get("regions"), sorted((settings.get("limits") or {}).items())))
+    if kind == "map":
+        map_path = os.path.join(settings["build_dir"], "linkmap.map")
+        return file_hash(map_path) if os.path.isfile(map_path) else ""
+    return ""
+
+
+def _load_stamps(stamp_path):
+    try:
+        with open(stamp_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_stamps(stamp_path, written):
+    """Merge ``{kind: key or None}`` into the stamp file; re-read under the
+    lock so concurrent calls for other kinds keep their stamps."""
+    with _stamp_lock:
+        stamps = _load_stamps(stamp_path)
+        for kind, key in written.items():
+            if key is None:
+                stamps.pop(kind, None)
+            else:
+                stamps[kind] = key
+        fd, tmp = tempfile.mkstemp(prefix=STAMP_NAME + ".",
+                                   dir=os.path.dirname(stamp_path) or ".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(stamps, f, indent=1, sort_keys=True)
+        os.replace(tmp, stamp_path)
+
+
+def generate(elf_path, build_dir, name, kinds, jobs=None, **settings):
+    """Bring ``kinds`` up to date for ``elf_path``; returns ``{kind:
+    message}`` for the kinds that were written (message may be None).
+
+    ``settings``: ``regions``/``limits`` for ``size``, ``objdump`` and
+    ``tool_env`` for ``asm``, ``lib_cache_dir`` for ``map``.
+    """
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        raise ArtifactError("Unknown artifacts: %s" % ", ".join(sorted(unknown)))
+    settings["build_dir"] = build_dir
+    stamp_path = os.path.join(build_dir, STAMP_NAME)
+    stamps = _load_stamps(stamp_path)
+
+    elf_hash = file_hash(elf_path)
+    keys = {}
+    todo = []
+    for kind in kinds:
+        keys[kind] = hashlib.sha256(
+            (elf_hash + _settings_key(kind, settings)).encode()).hexdigest()
+        if stamps.get(kind) != keys[kind] or not all(
+                os.path.isfile(p) for p in outputs(kind, build_dir, name)):
+            todo.append(kind)
+    if not todo:
+        return {}
+
+    results = {}
+    written = {}
+    with ElfFile(elf_path) as elf:
+        with ThreadPoolExecutor(max_workers=jobs or len(todo)) as pool:
+            futures = dict((kind, pool.submit(
+                _generate, kind, elf, elf_path, build_dir, name, settings))
+                for kind in todo)
+            errors = []
+            for kind, future in futures.items():
+                try:
+                    results[kind] = future.result()
+                    written[kind] = keys[kind]
+                except (OSError, ValueError, ArtifactError) as e:
+                    written[kind] = None
+                    errors.append("%s: %s" % (kind, e))
+
+    _update_stamps(stamp_path, written)
+    if errors:
+        raise ArtifactError("; ".join(errors))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("elf")
+    parser.add_argument("build_dir")
+    parser.add_argument("kinds", nargs="+", choices=KINDS)
+    parser.add_argument("--name", help="output name (default: the ELF name)")
+    parser.add_argument("--objdump")
+    args = parser.parse_args(argv)
+
+    name = args.name or os.path.splitext(os.path.basename(args.elf))[0]
+    try:
+        results = generate(args.elf, args.build_dir, name, args.kinds,
+                           objdump=args.objdump)
+    except ArtifactError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    for kind in args.kinds:
+        print("%-8s %s" % (kind, "written" if kind in results else "unchanged"))
+        if results.get(kind):
+            print("         " + results[kind])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""Build-time instrumentation: records every spawned build command (and any
+wrapped Python action) and writes a Chrome/Perfetto trace plus a text
+summary of the slowest units.
+
+Open ``build_trace.json`` in ``chrome://tracing`` or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+TIME_REPORT_LINE = re.compile(r"^\s*(phase [\w ]+?|TOTAL)\s*:\s*(.*)$")
+TIME_REPORT_NOISE = re.compile(
+    r"^(Time variable\b|\s*\S.*?:\s+\d+\.\d+ \(\s*\d+%\)|\s*TOTAL\s*:|"
+    r"Extra diagnostic checks enabled|Configure with --enable-checking)")
+
+
+class BuildTrace(object):
+
+    def __init__(self, build_dir, time_report=False):
+        self.build_dir = os.path.abspath(build_dir)
+        self.time_report = time_report
+        self.events = []
+        self.phases = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._origin = time.time()
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self._lock:
+            return self._threads.setdefault(ident, len(self._threads) + 1)
+
+    def add(self, name, cat, group, start, end):
+        tid = self._tid()
+        with self._lock:
+            self.events.append({
+                "name": name, "cat": cat, "group": group,
+                "start": start, "end": end, "tid": tid,
+            })
+
+    def group_of(self, path):
+        """Library/unit group of an output path: ``driver``, ``cmsis``,
+        ``middleware/freertos``, ``src``, ``lib/<name>``, ..."""
+        path = os.path.abspath(path)
+        if not path.startswith(self.build_dir + os.sep):
+            return "other"
+        parts = os.path.relpath(path, self.build_dir).split(os.sep)
+        if parts[-1].startswith("lib") and parts[-1].endswith(".a"):
+            return "/".join(parts[:-1] + [parts[-1][3:-2]])
+        if len(parts) == 1:
+            return "program"
+        if parts[0] in ("middleware", "lib", "unity") and len(parts) > 2:
+            return "/".join(parts[:2])
+        return parts[0]
+
+    def classify(self, args):
+        """Return ``(category, output)`` for a build command line."""
+        words = " ".join(args).split()
+        tool = os.path.basename(words[0]).strip('"') if words else ""
+        output = None
+        if "-o" in words and words.index("-o") + 1 < len(words):
+            output = words[words.index("-o") + 1]
+        if tool.endswith("ranlib") and len(words) > 1:
+            return "archive", words[-1]
+        if tool.endswith("ar") and len(words) > 2:
+            return "archive", words[2]
+        if "-c" in words or ("-x" in words and "c-header" in words):
+            return "compile", output
+        if output and output.endswith(".elf"):
+            return "link", output
+        if ">" in words:
+            output = words[words.index(">") + 1]
+        return "post-link", output or (words[-1] if words else tool)
+
+    def wrap_spawn(self, spawn):
+        def _spawn(sh, escape, cmd, args, env):
+            category, output = self.classify(args)
+            output = (output or cmd).strip('"')
+            start = time.time()
+            if self.time_report and category == "compile":
+                rc = self._spawn_time_report(args, env, output)
+            else:
+                rc = spawn(sh, escape, cmd, args, env)
+            self.add(os.path.basename(output), category,
+                     self.group_of(output), start, time.time())
+            return rc
+        return _spawn
+
+    def wrap_action(self, func, name, category="post-link"):
+        """Wrap a Python SCons action function so it shows in the trace."""
+        def _action(target, source, env):
+            start = time.time()
+            try:
+                return func(target, source, env)
+            finally:
+                self.add(name, category, "program", start, time.time())
+        return _action
+
+    def _spawn_time_report(self, args, env, output):
+        proc = subprocess.run(
+            " ".join(args), shell=True, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        sys.stdout.write(proc.stdout.decode(errors="replace"))
+        group = self.group_of(output)
+        for line in proc.stderr.decode(errors="replace").splitlines():
+            m = TIME_REPORT_LINE.match(line)
+            if m:
+                times = re.findall(r"(\d+\.\d+)(?:\s*\(\s*\d+%\))?", m.group(2))
+                if len(times) >= 3:
+                    with self._lock:
+                        self.phases[group][m.group(1)] += float(times[2])
+                continue
+            if not TIME_REPORT_NOISE.match(line):
+                sys.stderr.write(line + "\n")
+        return proc.returncode
+
+    def write(self, top=10):
+        """Write ``build_trace.json`` and ``build_trace.txt``; return the
+        summary text."""
+        if not os.path.isdir(self.build_dir):
+            os.makedirs(self.build_dir)
+        trace = {"traceEvents": [
+            {"name": e["name"], "cat": "%s,%s" % (e["cat"], e["group"]),
+             "ph": "X", "pid": 1, "tid": e["tid"],
+             "ts": int((e["start"] - self._origin) * 1e6),
+             "dur": int((e["end"] - e["start"]) * 1e6),
+             "args": {"group": e["group"]}}
+            for e in self.events
+        ], "displayTimeUnit": "ms"}
+        with open(os.path.join(self.build_dir, "build_trace.json"), "w") as f:
+            json.dump(trace, f)
+
+        summary = self.summary(top)
+        with open(os.path.join(self.build_dir, "build_trace.txt"), "w") as f:
+            f.write(summary)
+        return summary
+
+    def summary(self, top=10):
+        by_cat = defaultdict(float)
+        by_group = defaultdict(float)
+        for e in self.events:
+            by_cat[e["cat"]] += e["end"] - e["start"]
+            by_group[e["group"]] += e["end"] - e["start"]
+        wall = (max(e["end"] for e in self.events)
+                - min(e["start"] for e in self.events)) if self.events else 0
+
+        lines = ["Build trace: %d actions, %.2fs wall" % (len(self.events), wall)]
+        lines.append("  By kind:")
+        for cat, secs in sorted(by_cat.items(), key=lambda x: -x[1]):
+            lines.append("    %-12s %8.2fs" % (cat, secs))
+        lines.append("  By library:")
+        for group, secs in sorted(by_group.items(), key=lambda x: -x[1]):
+            lines.append("    %-24s %8.2fs" % (group, secs))
+        lines.append("  Slowest %d:" % top)
+        for e in sorted(self.events, key=lambda e: e["start"] - e["end"])[:top]:
+            lines.append("    %8.2fs  %-9s %s (%s)" % (
+                e["end"] - e["start"], e["cat"], e["name"], e["group"]))
+        if self.phases:
+            lines.append("  -ftime-report phases (wall):")
+            for group in sorted(self.phases):
+                lines.append("    %s" % group)
+                for phase, secs in sorted(self.phases[group].items(),
+                                          key=lambda x: -x[1]):
+                    lines.append("      %-28s %8.2fs" % (phase, secs))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,163 @@
+"""Delta flashing: program only the flash sectors that changed since the
+last upload.
+
+A record of the image last flashed (base address, sector size and one
+hash per sector) is kept per board and probe. The next upload compares
+the new image against it and writes only the changed sectors; the whole
+image is then checked with OpenOCD's ``verify_image``, which compares
+on-target CRC32 checksums instead of reading the flash back. A missing
+or mismatching record, or a failed check (the chip was flashed by other
+means), falls back to a full ``program``::
+
+    python deltaflash.py firmware.bin --base 0x08000000 --record last.json
+
+prints the sectors an upload would write.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+# The largest AT32 flash sector (4 KB on the 4032 KB AT32F435/437 parts).
+# A sector size that is a multiple of the real one is always safe: every
+# sector that gets erased is also rewritten in full.
+DEFAULT_SECTOR_SIZE = 4096
+RECORD_VERSION = 1
+
+
+def sector_hashes(data, sector_size):
+    return [
+        hashlib.sha256(data[offset:offset + sector_size]).hexdigest()[:32]
+        for offset in range(0, len(data), sector_size)
+    ]
+
+
+def load_record(path):
+    try:
+        with open(path) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(record, dict) or record.get("version") != RECORD_VERSION:
+        return None
+    return record
+
+
+def save_record(path, data, base, sector_size, target):
+    record = {
+        "version": RECORD_VERSION,
+        "target": target,
+        "base": base,
+        "sector_size": sector_size,
+        "size": len(data),
+        "sectors": sector_hashes(data, sector_size),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace(tmp, path)
+
+
+def forget(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def changed_runs(data, base, sector_size, record, target):
+    """Return ``[(offset, length)]`` of the changed sector runs, or
+    ``None`` when the record cannot be used and the full image must be
+    programmed."""
+    if (not record or record.get("target") != target
+            or record.get("base") != base
+            or record.get("sector_size") != sector_size
+            or base % sector_size):
+        return None
+    old = record.get("sectors", [])
+    runs = []
+    for index, digest in enumerate(sector_hashes(data, sector_size)):
+        if index < len(old) and old[index] == digest:
+            continue
+        offset = index * sector_size
+        length = min(sector_size, len(data) - offset)
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1] + length)
+        else:
+            runs.append((offset, length))
+    return runs
+
+
+def _tcl_path(path):
+    return "{%s}" % os.path.abspath(path).replace("\\", "/")
+
+
+def openocd_script(image, base, runs, chunk_dir, extra=()):
+    """Write the changed runs to ``chunk_dir`` and return the OpenOCD
+    commands that flash them, check the whole image and reset.
+
+    ``extra`` segments (``[(address, path)]``) of a multi-region image are
+    programmed in full.
+    """
+    with open(image, "rb") as f:
+        data = f.read()
+    os.makedirs(chunk_dir, exist_ok=True)
+    for name in os.listdir(chunk_dir):
+        if name.endswith(".bin"):
+            os.remove(os.path.join(chunk_dir, name))
+
+    lines = ["init", "reset init"]
+    for offset, length in runs:
+        chunk = os.path.join(chunk_dir, "0x%08x.bin" % (base + offset))
+        with open(chunk, "wb") as f:
+            f.write(data[offset:offset + length])
+        lines.append("flash write_image erase %s 0x%08x bin" % (
+            _tcl_path(chunk), base + offset))
+    lines.extend([
+        "if {[catch {verify_image %s 0x%08x bin}]} {" % (_tcl_path(image), base),
+        '    echo "** Flash does not match the upload record, '
+        'programming the full image **"',
+        "    program %s 0x%08x verify" % (_tcl_path(image), base),
+        "}",
+    ])
+    lines.extend("program %s 0x%08x verify" % (_tcl_path(path), address)
+                 for address, path in extra)
+    lines.extend([
+        "reset run",
+        "shutdown",
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def describe(runs, sector_size, total):
+    if runs is None:
+        return "no usable upload record, programming the full image"
+    written = sum(length for _, length in runs)
+    sectors = sum((length + sector_size - 1) // sector_size for _, length in runs)
+    return "%d of %d sectors changed (%d of %d bytes)" % (
+        sectors, (total + sector_size - 1) // sector_size, written, total)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", help="raw binary image")
+    parser.add_argument("--base", default="0x08000000")
+    parser.add_argument("--sector-size", type=int, default=DEFAULT_SECTOR_SIZE)
+    parser.add_argument("--record", required=True)
+    parser.add_argument("--target", default="")
+    args = parser.parse_args(argv)
+
+    with open(args.image, "rb") as f:
+        data = f.read()
+    base = int(args.base, 0)
+    runs = changed_runs(data, base, args.sector_size,
+                        load_record(args.record), args.target)
+    print(describe(runs, args.sector_size, len(data)))
+    for offset, length in runs or []:
+        print("  0x%08x  %6d bytes" % (base + offset, length))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,653 @@
+"""Demangler for the subset of the Itanium C++ ABI that embedded firmware
+uses: functions and data in namespaces and classes, constructors and
+destructors, operators, builtin/qualified/pointer/reference/function
+parameter types, templates, lambdas, ABI tags, thunks and substitutions.
+The output follows ``c++filt``.
+
+:func:`demangle` returns names it does not understand unchanged, so its
+output is always safe to show. ``--compare`` checks it against
+``c++filt`` on the symbols of ELF files, archives or symbol lists::
+
+    python demangle.py _ZNSt6vectorIiSaIiEE9push_backERKi
+    python demangle.py --compare firmware.elf libstdc++_nano.a
+"""
+
+import argparse
+import re
+import shutil
+import subprocess
+import sys
+from collections import namedtuple
+
+BUILTIN_TYPES = {
+    "v": "void", "w": "wchar_t", "b": "bool", "c": "char",
+    "a": "signed char", "h": "unsigned char", "s": "short",
+    "t": "unsigned short", "i": "int", "j": "unsigned int", "l": "long",
+    "m": "unsigned long", "x": "long long", "y": "unsigned long long",
+    "n": "__int128", "o": "unsigned __int128", "f": "float", "d": "double",
+    "e": "long double", "g": "__float128", "z": "...",
+    "Dn": "decltype(nullptr)", "Di": "char32_t", "Ds": "char16_t",
+    "Du": "char8_t", "Da": "auto", "Dc": "decltype(auto)",
+    "Dd": "decimal64", "De": "decimal128", "Df": "decimal32", "Dh": "half",
+}
+
+OPERATORS = {
+    "nw": "new", "na": "new[]", "dl": "delete", "da": "delete[]",
+    "ps": "+", "ng": "-", "ad": "&", "de": "*", "co": "~", "pl": "+",
+    "mi": "-", "ml": "*", "dv": "/", "rm": "%", "an": "&", "or": "|",
+    "eo": "^", "aS": "=", "pL": "+=", "mI": "-=", "mL": "*=", "dV": "/=",
+    "rM": "%=", "aN": "&=", "oR": "|=", "eO": "^=", "ls": "<<", "rs": ">>",
+    "lS": "<<=", "rS": ">>=", "eq": "==", "ne": "!=", "lt": "<", "gt": ">",
+    "le": "<=", "ge": ">=", "ss": "<=>", "nt": "!", "aa": "&&", "oo": "||",
+    "pp": "++", "mm": "--", "cm": ",", "pm": "->*", "pt": "->", "cl": "()",
+    "ix": "[]", "qu": "?",
+}
+
+# Standard abbreviations, expanded in full like c++filt does:
+# ``(text, unqualified name for constructors and destructors)``
+_CHAR_TRAITS = "std::char_traits<char>"
+STD_SUBSTITUTIONS = {
+    "Sa": ("std::allocator", "allocator"),
+    "Sb": ("std::basic_string", "basic_string"),
+    "Ss": ("std::basic_string<char, %s, std::allocator<char> >" % _CHAR_TRAITS,
+           "basic_string"),
+    "Si": ("std::basic_istream<char, %s >" % _CHAR_TRAITS, "basic_istream"),
+    "So": ("std::basic_ostream<char, %s >" % _CHAR_TRAITS, "basic_ostream"),
+    "Sd": ("std::basic_iostream<char, %s >" % _CHAR_TRAITS, "basic_iostream"),
+}
+
+LITERAL_SUFFIXES = {
+    "int": "", "unsigned int": "u", "long": "l", "unsigned long": "ul",
+    "long long": "ll", "unsigned long long": "ull",
+}
+
+SPECIAL_NAMES = {
+    "TV": "vtable for ", "TT": "VTT for ", "TI": "typeinfo for ",
+    "TS": "typeinfo name for ",
+}
+SPECIAL_ENCODINGS = {
+    "TH": "TLS init function for ", "TW": "TLS wrapper function for ",
+    "GTt": "transaction clone for ",
+}
+
+CLONE_SUFFIX_RE = re.compile(r"\.(?:[A-Za-z_]+(?:\.\d+)*|\d+)")
+
+# A type as printed: ``left + right``, declarators (``*``, ``&``) go in
+# between. ``kind`` is ``simple``, ``function`` (``void (int)``), ``array``
+# (``int [3]``), ``declarator`` (``void (*)(int)``, ``int (*) [3]``) or
+# ``pack`` (template parameter pack). ``base`` is the unqualified name of a
+# class, which its constructors and destructors are named after, or the
+# element types of a pack.
+Type = namedtuple("Type", "left right kind base")
+# A parsed <name>: printed text, whether its last component has template
+# arguments, ``ctor``/``dtor``/``conversion`` for those special members,
+# the trailing method qualifiers and the last unqualified class name
+Name = namedtuple("Name", "text is_template special qualifiers base")
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _simple(text, base=None):
+    return Type(text, "", "simple", base)
+
+
+def _text(t):
+    return t.left + t.right
+
+
+def _join(texts):
+    """Join argument lists like c++filt: an empty pack prints nothing, and
+    the comma before it only when something follows."""
+    result = ""
+    for text in reversed(texts):
+        result = text + (", " + result if result else "")
+    return result
+
+
+def _with_args(name, args):
+    # ``operator<< <char>``, not ``operator<<<char>``
+    return name + (" " if name.endswith("<") else "") + args
+
+
+def _pack(elements):
+    return Type(", ".join(_text(e) for e in elements), "", "pack", tuple(elements))
+
+
+def _pointer(symbol, inner):
+    """``inner`` behind the declarator ``*``, ``&`` or ``&&``."""
+    if inner.kind == "simple":
+        text = inner.left
+        if symbol != "*" and text.endswith("&"):
+            # Reference collapsing: only && applied to && stays &&
+            return _simple(text[:-2] + "&" if text.endswith("&&") and symbol == "&"
+                           else text)
+        return _simple(text + symbol)
+    if inner.kind == "function":
+        return Type(inner.left + "(" + symbol, ")" + inner.right, "declarator", None)
+    if inner.kind == "array":
+        return Type(inner.left + "(" + symbol, ") " + inner.right, "declarator", None)
+    if inner.kind == "declarator":
+        return inner._replace(left=inner.left + symbol)
+    return _pack([_pointer(symbol, e) for e in inner.base])
+
+
+def _qualified(quals, inner):
+    """``inner`` with the cv-qualifiers ``quals``."""
+    if inner.kind in ("simple", "declarator"):
+        return inner._replace(left=inner.left + _qualifier_text(quals), base=None)
+    if inner.kind == "function":
+        return inner._replace(right=inner.right + _qualifier_text(quals))
+    if inner.kind == "pack":
+        return _pack([_qualified(quals, e) for e in inner.base])
+    raise _Unsupported()
+
+
+def _qualifier_text(quals):
+    """``K``/``V``/``r`` and ``R``/``O`` codes -> `` const volatile &``."""
+    text = "".join(" " + word for code, word in (
+        ("K", "const"), ("V", "volatile"), ("r", "restrict")) if code in quals)
+    if "R" in quals:
+        text += " &"
+    elif "O" in quals:
+        text += " &&"
+    return text
+
+
+class _Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.subs = []
+        self.template_args = []
+
+    def peek(self, n=1):
+        return self.text[self.pos:self.pos + n]
+
+    def eat(self, s):
+        if self.text.startswith(s, self.pos):
+            self.pos += len(s)
+            return True
+        return False
+
+    def expect(self, s):
+        if not self.eat(s):
+            raise _Unsupported()
+
+    def at_end(self):
+        return self.pos >= len(self.text)
+
+    def number(self):
+        negative = self.eat("n")
+        start = self.pos
+        while self.peek().isdigit():
+            self.pos += 1
+        if start == self.pos:
+            raise _Unsupported()
+        value = int(self.text[start:self.pos])
+        return -value if negative else value
+
+    def seq_id(self, terminator="_"):
+        if self.eat(terminator):
+            return 0
+        value = 0
+        while True:
+            c = self.peek()
+            if c.isdigit():
+                value = value * 36 + int(c)
+            elif c.isupper():
+                value = value * 36 + ord(c) - ord("A") + 10
+            else:
+                break
+            self.pos += 1
+        self.expect(terminator)
+        return value + 1
+
+    def discriminator(self):
+        """``_ <digit>`` or ``__ <number> _``; returns the number + 2, or 1
+        without a discriminator (the ``#n`` of lambdas and unnamed types)."""
+        if not self.eat("_"):
+            return 1
+        if self.eat("_"):
+            value = self.number()
+            self.expect("_")
+            return value + 2
+        if not self.peek().isdigit():
+            raise _Unsupported()
+        self.pos += 1
+        return int(self.text[self.pos - 1]) + 2
+
+    # <encoding> ::= <name> <bare-function-type> | <name> | <special-name>
+    def encoding(self, return_type=True):
+        """``return_type``: print the return type of template functions,
+        which c++filt leaves out for the scope of local names."""
+        for code, prefix in SPECIAL_ENCODINGS.items():
+            if self.eat(code):
+                if code == "GTt":
+                    return prefix + self.encoding()
+                return prefix + self.name(outer=True).text
+        if self.eat("Th"):
+            self.number()
+            self.expect("_")
+            return "non-virtual thunk to " + self.encoding()
+        if self.eat("Tv"):
+            self.number()
+            self.expect("_")
+            self.number()
+            self.expect("_")
+            return "virtual thunk to " + self.encoding()
+        if self.peek() in ("T", "G"):
+            raise _Unsupported()
+
+        name = self.name(outer=True)
+        if self.at_end() or self.peek() in ("E", "."):
+            return name.text
+        # Template functions encode their return type first
+        ret = ""
+        if name.is_template and not name.special:
+            ret_type = self.type()
+            if ret_type.kind != "simple":
+                raise _Unsupported()
+            if return_type:
+                ret = _text(ret_type) + " "
+        params = self.parameters()
+        return "%s%s(%s)%s" % (ret, name.text, params, _qualifier_text(name.qualifiers))
+
+    def parameters(self, terminator=None):
+        params = []
+        while not self.at_end() and self.peek() not in ("E", ".", terminator):
+            if terminator and self.peek(2) in ("RE", "OE"):
+                break  # ref-qualifier of a function type
+            params.append(_text(self.type()))
+        if params == ["void"]:
+            params = []
+        return _join(params)
+
+    def name(self, outer=False):
+        if self.peek() == "N":
+            return self.nested_name(outer)
+        if self.eat("Z"):
+            return self.local_name()
+        if self.peek() == "S" and self.peek(2) != "St":
+            sub = self.substitution()
+            if self.peek() != "I":
+                return Name(_text(sub), False, None, "", sub.base)
+            args = self.template_args_list(outer)
+            text = _with_args(_text(sub), args)
+            self.subs.append(_simple(text, sub.base))
+            return Name(text, True, None, "", sub.base)
+        std = self.eat("St")
+        text, special, base = self.unqualified_name(None)
+        if std:
+            text = "std::" + text
+        if self.peek() == "I":
+            self.subs.append(_simple(text, base))
+            text = _with_args(text, self.template_args_list(outer))
+            return Name(text, True, special, "", base)
+        return Name(text, False, special, "", base)
+
+    def local_name(self):
+        scope = self.encoding(return_type=False)
+        self.expect("E")
+        if self.eat("s"):
+            self.discriminator()
+            return Name(scope + "::string literal", False, None, "", None)
+        if self.eat("d"):
+            # default argument: ``d [<number>] _ <name>``
+            number = self.number() + 2 if self.peek().isdigit() else 1
+            self.expect("_")
+            inner = self.name()
+            return inner._replace(text="%s::{default arg#%d}::%s" % (
+                scope, number, inner.text))
+        inner = self.name()
+        self.discriminator()
+        return inner._replace(text="%s::%s" % (scope, inner.text))
+
+    def nested_name(self, outer=False):
+        self.expect("N")
+        quals = ""
+        while self.peek() in ("r", "V", "K"):
+            quals += self.peek()
+            self.pos += 1
+        if self.peek() in ("R", "O"):
+            quals += self.peek()
+            self.pos += 1
+        text = ""
+        base = None
+        is_template = False
+        special = None
+        while not self.eat("E"):
+            if self.peek() == "S" and not text:
+                if self.eat("St"):
+                    text = "std"
+                    continue
+                sub = self.substitution()
+                text, base = _text(sub), sub.base
+                continue  # substitutions are not candidates again
+            elif self.peek() == "I":
+                if not text:
+                    raise _Unsupported()
+                text = _with_args(text, self.template_args_list(outer))
+                is_template = True
+            elif self.peek() == "T" and not text:
+                text = _text(self.template_param())
+                base = None
+            elif self.peek() == "D" and self.peek(2) in ("Dt", "DT"):
+                raise _Unsupported()  # decltype prefixes
+            else:
+                component, special, base = self.unqualified_name(base if text else None)
+                text = "%s::%s" % (text, component) if text else component
+                is_template = False
+            if self.peek() != "E":
+                self.subs.append(_simple(text, base))
+        return Name(text, is_template, special, quals, base)
+
+    def unqualified_name(self, enclosing):
+        """Return ``(text, special, base)``; ``enclosing`` is the class name
+        constructors and destructors take."""
+        c = self.peek()
+        special = None
+        if c.isdigit():
+            text = base = self.source_name()
+        elif c == "C" and self.peek(2) in ("C1", "C2", "C3", "C4", "C5"):
+            if not enclosing:
+                raise _Unsupported()
+            self.pos += 2
+            text, base, special = enclosing, enclosing, "ctor"
+        elif c == "D" and self.peek(2) in ("D0", "D1", "D2", "D4", "D5"):
+            if not enclosing:
+                raise _Unsupported()
+            self.pos += 2
+            text, base, special = "~" + enclosing, enclosing, "dtor"
+        elif c == "L":
+            self.pos += 1
+            text = base = self.source_name()
+            if self.eat("_"):
+                self.number()
+        elif self.eat("Ut"):
+            number = self.number() + 2 if self.peek().isdigit() else 1
+            self.expect("_")
+            text, base = "{unnamed type#%d}" % number, None
+        elif self.eat("Ul"):
+            params = self.parameters(terminator="E")
+            self.expect("E")
+            number = self.number() + 2 if self.peek().isdigit() else 1
+            self.expect("_")
+            text, base = "{lambda(%s)#%d}" % (params, number), None
+        elif self.eat("cv"):
+            if self.peek() == "T":
+                raise _Unsupported()  # templated conversion operators
+            text, base, special = "operator " + _text(self.type()), None, "conversion"
+        elif self.peek(2) in OPERATORS:
+            op = OPERATORS[self.peek(2)]
+            text, base = "operator" + (" " if op[0].isalpha() else "") + op, None
+            self.pos += 2
+        else:
+            raise _Unsupported()
+        while self.eat("B"):
+            text += "[abi:%s]" % self.source_name()
+        return text, special, base
+
+    def source_name(self):
+        length = self.number()
+        if length <= 0:
+            raise _Unsupported()
+        name = self.text[self.pos:self.pos + length]
+        if len(name) != length:
+            raise _Unsupported()
+        self.pos += length
+        if name.startswith("_GLOBAL__N"):
+            return "(anonymous namespace)"
+        return name
+
+    def substitution(self):
+        code = self.peek(2)
+        if code in STD_SUBSTITUTIONS:
+            self.pos += 2
+            return _simple(*STD_SUBSTITUTIONS[code])
+        self.expect("S")
+        index = self.seq_id()
+        if index >= len(self.subs):
+            raise _Unsupported()
+        return self.subs[index]
+
+    def template_param(self):
+        self.expect("T")
+        index = self.seq_id()
+        if index >= len(self.template_args):
+            raise _Unsupported()
+        return self.template_args[index]
+
+    def template_args_list(self, outer=False):
+        """Parse ``I <args> E``; the arguments of the encoded name itself
+        (``outer``) are the ones ``T_`` refers to."""
+        self.expect("I")
+        args = []
+        while not self.eat("E"):
+            if self.peek() == "L":
+                args.append(_simple(self.literal()))
+            elif self.eat("J") or self.eat("I"):  # I: packs before GCC 4.7
+                pack = []
+                while not self.eat("E"):
+                    pack.append(self.type())
+                args.append(_pack(pack))
+            elif self.peek() == "X":
+                raise _Unsupported()  # expressions
+            else:
+                args.append(self.type())
+        if outer:
+            self.template_args = args
+        text = _join([_text(a) for a in args])
+        return "<%s%s>" % (text, " " if text.endswith(">") else "")
+
+    def literal(self):
+        self.expect("L")
+        if self.eat("_Z"):
+            value = self.encoding()
+            self.expect("E")
+            return value
+        kind = _text(self.type())
+        negative = self.eat("n")
+        start = self.pos
+        while self.peek() and self.peek() != "E":
+            self.pos += 1
+        if start == self.pos:
+            raise _Unsupported()
+        value = ("-" if negative else "") + self.text[start:self.pos]
+        self.expect("E")
+        if kind == "bool" and value in ("0", "1"):
+            return "true" if value == "1" else "false"
+        if kind in LITERAL_SUFFIXES:
+            return value + LITERAL_SUFFIXES[kind]
+        return "(%s)%s" % (kind, value)
+
+    def type(self):
+        c = self.peek()
+        for code in (self.peek(2), c):
+            if code in BUILTIN_TYPES:
+                self.pos += len(code)
+                return _simple(BUILTIN_TYPES[code])
+        if self.eat("DF"):
+            bits = self.number()
+            self.expect("_")
+            return _simple("_Float%d" % bits)
+        if c in ("K", "V", "r"):
+            return self._add(self.qualified_type())
+        if c in ("P", "R", "O"):
+            self.pos += 1
+            symbol = {"P": "*", "R": "&", "O": "&&"}[c]
+            return self._add(_pointer(symbol, self.type()))
+        if c == "F":
+            self.pos += 1
+            self.eat("Y")
+            ret = self.type()
+            if ret.kind != "simple":
+                raise _Unsupported()  # functions returning function pointers
+            params = self.parameters(terminator="E")
+            quals = ""
+            if self.peek() in ("R", "O"):
+                quals = self.peek()
+                self.pos += 1
+            self.expect("E")
+            return self._add(Type(_text(ret) + " ", "(%s)%s" % (
+                params, _qualifier_text(quals)), "function", None))
+        if c == "A":
+            self.pos += 1
+            size = str(self.number()) if self.peek().isdigit() else ""
+            self.expect("_")
+            elem = self.type()
+            if elem.kind == "array":
+                result = elem._replace(right="[%s]%s" % (size, elem.right))
+            elif elem.kind == "simple":
+                result = Type(elem.left + " ", "[%s]" % size, "array", None)
+            else:
+                raise _Unsupported()
+            return self._add(result)
+        if c == "M":
+            self.pos += 1
+            cls = _text(self.type())
+            # A qualified member function type is not a candidate itself
+            member = self.qualified_type() if self.peek() in ("K", "V", "r") else self.type()
+            if member.kind == "function":
+                result = Type(member.left + "(%s::*" % cls, ")" + member.right,
+                              "declarator", None)
+            elif member.kind == "simple":
+                result = _simple("%s %s::*" % (member.left, cls))
+            else:
+                raise _Unsupported()
+            return self._add(result)
+        if c == "T":
+            result = self._add(self.template_param())
+            if self.peek() == "I":
+                result = self._add(_simple(_with_args(_text(result), self.template_args_list())))
+            return result
+        if c == "S" and self.peek(2) != "St":
+            result = self.substitution()
+            if self.peek() == "I":
+                result = self._add(_simple(
+                    _with_args(_text(result), self.template_args_list()), result.base))
+            return result
+        if self.eat("Dp"):
+            inner = self.type()
+            if inner.kind != "pack":
+                raise _Unsupported()
+            return self._add(inner)
+        if c == "u":
+            self.pos += 1
+            return self._add(_simple(self.source_name()))
+        if c == "N" or c.isdigit() or c == "Z" or self.peek(2) in ("St", "Ut", "Ul"):
+            name = self.name()
+            return self._add(_simple(name.text, name.base))
+        raise _Unsupported()
+
+    def qualified_type(self):
+        quals = ""
+        while self.peek() in ("K", "V", "r"):
+            quals += self.peek()
+            self.pos += 1
+        return _qualified(quals, self.type())
+
+    def _add(self, t):
+        self.subs.append(t)
+        return t
+
+
+def demangle(symbol):
+    """Demangle ``symbol``; non-C++ or unsupported names are returned
+    unchanged."""
+    if not symbol.startswith("_Z"):
+        return symbol
+    parser = _Parser(symbol)
+    parser.pos = 2
+    try:
+        special = SPECIAL_NAMES.get(parser.peek(2))
+        if special:
+            parser.pos += 2
+            result = special + _text(parser.type())
+        elif parser.eat("TC"):
+            derived = _text(parser.type())
+            parser.number()
+            parser.expect("_")
+            result = "construction vtable for %s-in-%s" % (_text(parser.type()), derived)
+        elif parser.eat("GV"):
+            result = "guard variable for " + parser.name(outer=True).text
+        else:
+            result = parser.encoding()
+    except (_Unsupported, IndexError, ValueError, RecursionError):
+        return symbol
+    rest = symbol[parser.pos:]
+    # GCC clones: .constprop.0, .isra.0, .part.0, .cold, ...
+    while rest:
+        m = CLONE_SUFFIX_RE.match(rest)
+        if not m:
+            return symbol
+        result += " [clone %s]" % m.group(0)
+        rest = rest[m.end():]
+    return result
+
+
+def _symbols_of(path):
+    """C++ symbols of an ELF file or archive (via ``nm``), or of a text
+    file with one symbol per line."""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic.startswith(b"\x7fELF") or magic == b"!<arch>\n":
+        nm = shutil.which("arm-none-eabi-nm") or "nm"
+        out = subprocess.run([nm, path], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True).stdout.decode()
+        names = [line.split()[-1] for line in out.splitlines() if len(line.split()) >= 2]
+    else:
+        with open(path) as f:
+            names = [line.strip() for line in f]
+    return sorted(set(n.split("@")[0] for n in names if n.startswith("_Z")))
+
+
+def compare(symbols, cxxfilt):
+    """Return ``(wrong, unchanged)`` against ``c++filt``: the symbols
+    demangled differently (``[(symbol, ours, expected)]``) and those left
+    unchanged that ``c++filt`` demangles."""
+    expected = subprocess.run(
+        [cxxfilt], input="\n".join(symbols).encode(), stdout=subprocess.PIPE,
+        check=True).stdout.decode().splitlines()
+    wrong, unchanged = [], []
+    for symbol, reference in zip(symbols, expected):
+        ours = demangle(symbol)
+        if ours == symbol and reference != symbol:
+            unchanged.append(symbol)
+        elif ours != reference:
+            wrong.append((symbol, ours, reference))
+    return wrong, unchanged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="symbols, or files with --compare")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare with c++filt on the symbols of the files")
+    parser.add_argument("--cxxfilt", help="default: arm-none-eabi-c++filt or c++filt")
+    args = parser.parse_args(argv)
+
+    if not args.compare:
+        for name in args.names:
+            print(demangle(name))
+        return 0
+    cxxfilt = args.cxxfilt or shutil.which("arm-none-eabi-c++filt") or "c++filt"
+    symbols = []
+    try:
+        for path in args.names:
+            symbols.extend(_symbols_of(path))
+        wrong, unchanged = compare(sorted(set(symbols)), cxxfilt)
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    for symbol, ours, reference in wrong:
+        print("%s\n  ours:     %s\n  c++filt:  %s" % (symbol, ours, reference))
+    print("%d symbols: %d different, %d left mangled" % (
+        len(set(symbols)), len(wrong), len(unchanged)))
+    return 1 if wrong else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""DFU file post-processing without ``dfu-suffix``/``dfuse-pack``.
+
+``suffix`` appends (or replaces) the 16-byte DFU 1.1 suffix of a raw
+binary. ``dfuse`` builds a DfuSe (``.dfu``) container from the loadable
+sections of an ELF file: one element per contiguous block, so gaps
+between memory regions are not padded. ``verify`` checks the structure
+and CRC of either kind of file and, given a reference file (e.g. one
+made by ``dfu-suffix`` or ``dfuse-pack.py``), compares them::
+
+    python dfu.py suffix firmware.bin --vid 0x2E3C --pid 0xDF11
+    python dfu.py dfuse firmware.elf firmware.dfu --vid 0x2E3C --pid 0xDF11
+    python dfu.py verify firmware.dfu --reference reference.dfu
+"""
+
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools.elf import ElfFile  # noqa: E402
+
+SUFFIX_FORMAT = "<HHHH3sB"
+SUFFIX_LENGTH = 16
+SUFFIX_SIGNATURE = b"UFD"
+BCD_DFU = 0x0100
+BCD_DFUSE = 0x011A
+DFUSE_PREFIX = "<5sBIB"
+DFUSE_TARGET = "<6sBI255sII"
+DFUSE_ELEMENT = "<II"
+DEFAULT_DEVICE = 0xFFFF
+DEFAULT_TARGET_NAME = "AT32"
+
+
+class DfuError(Exception):
+    pass
+
+
+def crc32(data):
+    """The DFU CRC: CRC-32 without the final inversion."""
+    return zlib.crc32(data) ^ 0xFFFFFFFF
+
+
+def make_suffix(body, vid, pid, device=DEFAULT_DEVICE, bcd_dfu=BCD_DFU):
+    suffix = struct.pack(SUFFIX_FORMAT, device, pid, vid, bcd_dfu,
+                         SUFFIX_SIGNATURE, SUFFIX_LENGTH)
+    return suffix + struct.pack("<I", crc32(body + suffix))
+
+
+def parse_suffix(data):
+    """Return the suffix fields of ``data``, or None without a valid one."""
+    if len(data) < SUFFIX_LENGTH:
+        return None
+    device, pid, vid, bcd_dfu, signature, length = struct.unpack_from(
+        SUFFIX_FORMAT, data, len(data) - SUFFIX_LENGTH)
+    (crc,) = struct.unpack_from("<I", data, len(data) - 4)
+    if signature != SUFFIX_SIGNATURE or length != SUFFIX_LENGTH:
+        return None
+    return {
+        "device": device, "pid": pid, "vid": vid, "bcd_dfu": bcd_dfu,
+        "crc": crc, "crc_ok": crc == crc32(data[:-4]),
+    }
+
+
+def add_suffix(path, vid, pid, device=DEFAULT_DEVICE):
+    """Give the binary at ``path`` a DFU suffix; an existing suffix is
+    replaced. Returns False when the file already had this exact suffix."""
+    with open(path, "rb") as f:
+        data = f.read()
+    suffix = parse_suffix(data)
+    if suffix and suffix["crc_ok"]:
+        if (suffix["vid"], suffix["pid"], suffix["device"]) == (vid, pid, device):
+            return False
+        data = data[:-SUFFIX_LENGTH]
+    with open(path, "wb") as f:
+        f.write(data + make_suffix(data, vid, pid, device))
+    return True
+
+
+def dfuse_image(elements, vid, pid, device=DEFAULT_DEVICE, alt=0,
+                name=DEFAULT_TARGET_NAME):
+    """DfuSe file with one target holding ``[(address, bytes)]``."""
+    body = b"".join(
+        struct.pack(DFUSE_ELEMENT, address, len(data)) + data
+        for address, data in elements)
+    target = struct.pack(DFUSE_TARGET, b"Target", alt, 1, name.encode(),
+                         len(body), len(elements)) + body
+    image = struct.pack(DFUSE_PREFIX, b"DfuSe", 1,
+                        struct.calcsize(DFUSE_PREFIX) + len(target), 1) + target
+    return image + make_suffix(image, vid, pid, device, BCD_DFUSE)
+
+
+def parse_dfuse(data):
+    """Return ``(targets, suffix)``; every target is a dict with ``alt``,
+    ``name`` and ``elements`` (``[(address, bytes)]``)."""
+    suffix = parse_suffix(data)
+    if suffix is None:
+        raise DfuError("no DFU suffix")
+    prefix_size = struct.calcsize(DFUSE_PREFIX)
+    signature, version, size, count = struct.unpack_from(DFUSE_PREFIX, data)
+    if signature != b"DfuSe" or version != 1:
+        raise DfuError("not a DfuSe file")
+    if size != len(data) - SUFFIX_LENGTH:
+        raise DfuError("image size %d does not match the file (%d)" % (
+            size, len(data) - SUFFIX_LENGTH))
+    targets = []
+    offset = prefix_size
+    for _ in range(count):
+        (signature, alt, named, name, target_size,
+         element_count) = struct.unpack_from(DFUSE_TARGET, data, offset)
+        if signature != b"Target":
+            raise DfuError("bad target signature at offset %d" % offset)
+        offset += struct.calcsize(DFUSE_TARGET)
+        end = offset + target_size
+        elements = []
+        for _ in range(element_count):
+            address, element_size = struct.unpack_from(DFUSE_ELEMENT, data, offset)
+            offset += struct.calcsize(DFUSE_ELEMENT)
+            elements.append((address, bytes(data[offset:offset + element_size])))
+            offset += element_size
+        if offset != end:
+            raise DfuError("target size does not match its elements")
+        targets.append({
+            "alt": alt,
+            "name": name.rstrip(b"\0").decode(errors="replace") if named else "",
+            "elements": elements,
+        })
+    if offset != size:
+        raise DfuError("%d trailing bytes after the last target" % (size - offset))
+    return targets, suffix
+
+
+def build_dfuse(elf_path, out_path, vid, pid, device=DEFAULT_DEVICE, alt=0,
+                name=DEFAULT_TARGET_NAME):
+    """Write the DfuSe file of ``elf_path``; skipped (returns False) when
+    the image and parameters hash the same as for the existing file."""
+    with ElfFile(elf_path) as elf:
+        elements = elf.load_image()
+    digest = hashlib.sha256(repr((vid, pid, device, alt, name)).encode())
+    for address, data in elements:
+        digest.update(struct.pack("<II", address, len(data)) + data)
+    stamp = out_path + ".sha256"
+    if os.path.isfile(out_path) and os.path.isfile(stamp):
+        with open(stamp) as f:
+            if f.read().strip() == digest.hexdigest():
+                return False
+    with open(out_path, "wb") as f:
+        f.write(dfuse_image(elements, vid, pid, device, alt, name))
+    with open(stamp, "w") as f:
+        f.write(digest.hexdigest() + "\n")
+    return True
+
+
+def verify(path, reference=None):
+    """Return a list of problems with the DFU file at ``path`` (empty when
+    it is valid and, if given, identical to ``reference``) and a summary."""
+    with open(path, "rb") as f:
+        data = f.read()
+    problems = []
+    suffix = parse_suffix(data)
+    if suffix is None:
+        return ["no DFU suffix"], ""
+    if not suffix["crc_ok"]:
+        problems.append("CRC mismatch")
+    summary = "VID 0x%04X PID 0x%04X device 0x%04X DFU %x.%02x" % (
+        suffix["vid"], suffix["pid"], suffix["device"],
+        suffix["bcd_dfu"] >> 8, suffix["bcd_dfu"] & 0xFF)
+    if data.startswith(b"DfuSe"):
+        try:
+            targets, _ = parse_dfuse(data)
+        except (DfuError, struct.error) as e:
+            problems.append(str(e))
+            targets = []
+        for target in targets:
+            summary += "\n  target %d %s" % (target["alt"], target["name"])
+            for address, element in target["elements"]:
+                summary += "\n    0x%08X  %d bytes" % (address, len(element))
+    else:
+        summary += "\n  raw image, %d bytes" % (len(data) - SUFFIX_LENGTH)
+    if reference:
+        with open(reference, "rb") as f:
+            expected = f.read()
+        if data != expected:
+            first = next((i for i, (a, b) in enumerate(zip(data, expected)) if a != b),
+                         min(len(data), len(expected)))
+            problems.append("differs from %s at offset %d (%d vs %d bytes)" % (
+                reference, first, len(data), len(expected)))
+    return problems, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    for command in ("suffix", "dfuse"):
+        p = sub.add_parser(command)
+        if command == "suffix":
+            p.add_argument("binary")
+        else:
+            p.add_argument("elf")
+            p.add_argument("output")
+            p.add_argument("--alt", type=int, default=0)
+            p.add_argument("--name", default=DEFAULT_TARGET_NAME)
+        p.add_argument("--vid", required=True)
+        p.add_argument("--pid", required=True)
+        p.add_argument("--device", default="0xffff")
+    p = sub.add_parser("verify")
+    p.add_argument("file")
+    p.add_argument("--reference")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "suffix":
+            add_suffix(args.binary, int(args.vid, 16), int(args.pid, 16),
+                       int(args.device, 16))
+        elif args.command == "dfuse":
+            build_dfuse(args.elf, args.output, int(args.vid, 16), int(args.pid, 16),
+                        int(args.device, 16), args.alt, args.name)
+        elif args.command == "verify":
+            problems, summary = verify(args.file, args.reference)
+            print(summary)
+            for problem in problems:
+                sys.stderr.write("Error: %s\n" % problem)
+            return 1 if problems else 0
+        else:
+            parser.print_help()
+            return 1
+    except (OSError, DfuError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
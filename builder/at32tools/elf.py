@@ -0,0 +1,249 @@
+"""Minimal reader for the 32-bit little-endian ARM ELF files we link."""
+
+import mmap
+import struct
+from collections import namedtuple
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+PT_LOAD = 1
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xFF00
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STT_OBJECT = 1
+STT_FUNC = 2
+
+Section = namedtuple("Section", "name type flags addr offset size lma")
+Segment = namedtuple("Segment", "type offset vaddr paddr filesz memsz flags")
+Symbol = namedtuple("Symbol", "name value size type bind section kind")
+MemoryRegion = namedtuple("MemoryRegion", "name origin length")
+
+# NOLOAD sections of the AT32 linker scripts that only reserve space
+RESERVATION_SECTIONS = ("._user_heap_stack", ".heap", ".stack")
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ElfError("%s is not an ELF file" % path)
+        if self._data[:4] != b"\x7fELF":
+            raise ElfError("%s is not an ELF file" % path)
+        if self._data[4] != 1 or self._data[5] != 1:
+            raise ElfError("%s is not a 32-bit little-endian ELF file" % path)
+        (self.entry, phoff, shoff, _flags, _ehsize, phentsize, phnum,
+         shentsize, shnum, shstrndx) = struct.unpack_from(
+             "<IIIIHHHHHH", self._data, 24)
+        self.segments = [
+            Segment(*struct.unpack_from(
+                "<IIIIIII", self._data, phoff + i * phentsize)[:7])
+            for i in range(phnum)
+        ]
+        raw = [
+            struct.unpack_from("<IIIIIIIIII", self._data, shoff + i * shentsize)
+            for i in range(shnum)
+        ]
+        self._raw_sections = raw
+        names_offset = raw[shstrndx][4] if shnum else 0
+        self.sections = []
+        for name, sh_type, flags, addr, offset, size in (r[:6] for r in raw):
+            self.sections.append(Section(
+                self._cstring(names_offset + name), sh_type, flags, addr,
+                offset, size, self._lma(sh_type, flags, addr, offset, size)))
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _cstring(self, offset):
+        end = self._data.find(b"\0", offset)
+        return self._data[offset:end].decode("utf-8", "replace")
+
+    def _lma(self, sh_type, flags, addr, offset, size):
+        """Load address: where the section content is stored in the image
+        (differs from ``addr`` for ``.data``-like sections copied to RAM)."""
+        if not flags & SHF_ALLOC:
+            return addr
+        for seg in self.segments:
+            if seg.type != PT_LOAD:
+                continue
+            if sh_type != SHT_NOBITS and seg.offset <= offset < seg.offset + seg.filesz:
+                return seg.paddr + offset - seg.offset
+            if sh_type == SHT_NOBITS and seg.vaddr <= addr < seg.vaddr + seg.memsz:
+                return seg.paddr + addr - seg.vaddr
+        return addr
+
+    def section(self, name):
+        for sec in self.sections:
+            if sec.name == name:
+                return sec
+        return None
+
+    def section_data(self, sec):
+        if sec.type == SHT_NOBITS:
+            return b""
+        return self._data[sec.offset:sec.offset + sec.size]
+
+    def load_sections(self):
+        """Sections with content that end up in the programmed image."""
+        return [
+            sec for sec in self.sections
+            if sec.flags & SHF_ALLOC and sec.type != SHT_NOBITS and sec.size
+        ]
+
+    def memory_usage(self):
+        """Return ``(flash, ram)`` byte counts of the allocatable sections.
+
+        Initialised data counts towards both: its initial values are stored
+        in flash and copied to RAM by the startup code.
+        """
+        flash = ram = 0
+        for sec in self.sections:
+            if not sec.flags & SHF_ALLOC or not sec.size:
+                continue
+            if sec.type != SHT_NOBITS:
+                flash += sec.size
+            if sec.flags & SHF_WRITE:
+                ram += sec.size
+        return flash, ram
+
+    def symbols(self):
+        """Defined symbols of ``.symtab``; ``kind`` is the nm-style type
+        letter (``T``, ``D``, ``B``, ``R``, ``W``/``V`` for weak, lower
+        case for local symbols)."""
+        result = []
+        for sh in self._raw_sections:
+            if sh[1] != SHT_SYMTAB:
+                continue
+            strtab = self._raw_sections[sh[6]][4]
+            entsize = sh[9] or 16
+            for offset in range(sh[4] + entsize, sh[4] + sh[5], entsize):
+                name, value, size, info, _other, shndx = struct.unpack_from(
+                    "<IIIBBH", self._data, offset)
+                sym_type, bind = info & 0xF, info >> 4
+                if (shndx == SHN_UNDEF or shndx >= SHN_LORESERVE
+                        or sym_type not in (0, STT_OBJECT, STT_FUNC)):
+                    continue
+                name = self._cstring(strtab + name)
+                if not name or name.startswith("$"):  # ARM mapping symbols
+                    continue
+                sec = self.sections[shndx]
+                result.append(Symbol(name, value, size, sym_type, bind,
+                                     sec.name, self._kind(sec, sym_type, bind)))
+        return result
+
+    def mapping_symbols(self):
+        """ARM mapping symbols as a sorted list of ``(address, kind)``;
+        kind is ``"t"`` (Thumb code), ``"a"`` (ARM code) or ``"d"``
+        (data, e.g. literal pools)."""
+        result = []
+        for sh in self._raw_sections:
+            if sh[1] != SHT_SYMTAB:
+                continue
+            strtab = self._raw_sections[sh[6]][4]
+            entsize = sh[9] or 16
+            for offset in range(sh[4] + entsize, sh[4] + sh[5], entsize):
+                name, value, _, _, _, shndx = struct.unpack_from(
+                    "<IIIBBH", self._data, offset)
+                if shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+                    continue
+                name = self._cstring(strtab + name)
+                if name[:1] == "$" and name[1:2] in ("t", "a", "d"):
+                    result.append((value, name[1]))
+        return sorted(result)
+
+    def load_image(self):
+        """The programmed image as ``[(load address, bytes)]``, sorted, with
+        contiguous sections merged (what ``objcopy -O binary`` writes,
+        without the padding between blocks)."""
+        blocks = []
+        for sec in sorted(self.load_sections(), key=lambda s: s.lma):
+            data = self.section_data(sec)
+            if blocks and blocks[-1][0] + len(blocks[-1][1]) == sec.lma:
+                blocks[-1][1].extend(data)
+            else:
+                blocks.append((sec.lma, bytearray(data)))
+        return [(address, bytes(data)) for address, data in blocks]
+
+    def read(self, address, size):
+        """Bytes of the loaded image at run address ``address``."""
+        for sec in self.load_sections():
+            if sec.addr <= address and address + size <= sec.addr + sec.size:
+                start = sec.offset + address - sec.addr
+                return self._data[start:start + size]
+        return None
+
+    @staticmethod
+    def _kind(sec, sym_type, bind):
+        if bind == STB_WEAK:
+            return "V" if sym_type == STT_OBJECT else "W"
+        if sec.flags & SHF_EXECINSTR:
+            kind = "T"
+        elif sec.type == SHT_NOBITS:
+            kind = "B"
+        elif sec.flags & SHF_WRITE:
+            kind = "D"
+        else:
+            kind = "R"
+        return kind if bind == STB_GLOBAL else kind.lower()
+
+    def region_usage(self, regions):
+        """Bytes used in each linker memory region, from the allocated
+        sections: content counts at its load address (flash), the memory
+        image at its run address (RAM, for ``.data`` both). Sections that
+        only reserve the heap and stack (``RESERVATION_SECTIONS``) are not
+        counted, as in the ``size`` based figures.
+
+        Returns ``{region name: used bytes}``; usage outside every region
+        is reported under ``"?"``.
+        """
+        def region_of(address):
+            for region in regions:
+                if region.origin <= address < region.origin + region.length:
+                    return region.name
+            return "?"
+
+        usage = dict((region.name, 0) for region in regions)
+        for sec in self.sections:
+            if (not sec.flags & SHF_ALLOC or not sec.size
+                    or sec.name in RESERVATION_SECTIONS):
+                continue
+            load_region = region_of(sec.lma) if sec.type != SHT_NOBITS else None
+            run_region = region_of(sec.addr)
+            if load_region is not None and load_region != run_region:
+                usage[load_region] = usage.get(load_region, 0) + sec.size
+            usage[run_region] = usage.get(run_region, 0) + sec.size
+        return usage
+
+    def size_totals(self):
+        """Return ``(text, data, bss)`` as ``size -B`` counts them."""
+        text = data = bss = 0
+        for sec in self.sections:
+            if not sec.flags & SHF_ALLOC:
+                continue
+            if sec.type == SHT_NOBITS:
+                bss += sec.size
+            elif sec.flags & SHF_WRITE:
+                data += sec.size
+            else:
+                text += sec.size
+        return text, data, bss
@@ -0,0 +1,186 @@
+"""Firmware library packages: git locations, and a local store that builds
+can resolve from without network access.
+
+The store is a directory holding, per package, either a bare git mirror
+(``<package>.git``) or a tarball (``<package>.tar.gz`` or
+``<package>-<version>.tar.gz``, the highest version wins).  Fill or
+refresh it for every BSP with::
+
+    python fwstore.py --store /srv/at32-store --jobs 8 [--mirror gitee]
+
+or ``pio run -t prefetch_firmware`` with the store configured.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------------------------------------------------------------------
+# BSP → package name → git URL resolution
+# ---------------------------------------------------------------------------
+
+BSP_PACKAGE_MAP = {
+    "AT32A403A": "AT32A403A_Firmware_Library",
+    "AT32A423": "AT32A423_Firmware_Library",
+    "AT32F011": "AT32F011_Firmware_Library",
+    "AT32F402_405": "AT32F402_405_Firmware_Library",
+    "AT32F403": "AT32F403_Firmware_Library",
+    "AT32F403A_407": "AT32F403A_407_Firmware_Library",
+    "AT32F413": "AT32F413_Firmware_Library",
+    "AT32F415": "AT32F415_Firmware_Library",
+    "AT32F421": "AT32F421_Firmware_Library",
+    "AT32F422_426": "AT32F422_426_Firmware_Library",
+    "AT32F423": "AT32F423_Firmware_Library",
+    "AT32F425": "AT32F425_Firmware_Library",
+    "AT32F435_437": "AT32F435_437_Firmware_Library",
+    "AT32F45x": "AT32F45x_Firmware_Library",
+    "AT32F490": "AT32F490_Firmware_Library",
+    "AT32L021": "AT32L021_Firmware_Library",
+    "AT32M412_416": "AT32M412_416_Firmware_Library",
+    "AT32WB415": "AT32WB415_Firmware_Library",
+}
+
+PACKAGE_GIT_URLS = {
+    "AT32A403A_Firmware_Library": "https://github.com/ArteryTek/AT32A403A_Firmware_Library.git",
+    "AT32A423_Firmware_Library": "https://github.com/ArteryTek/AT32A423_Firmware_Library.git",
+    "AT32F011_Firmware_Library": "https://github.com/ArteryTek/AT32F011_Firmware_Library.git",
+    "AT32F402_405_Firmware_Library": "https://github.com/ArteryTek/AT32F402_405_Firmware_Library.git",
+    "AT32F403_Firmware_Library": "https://github.com/ArteryTek/AT32F403_Firmware_Library.git",
+    "AT32F403A_407_Firmware_Library": "https://github.com/ArteryTek/AT32F403A_407_Firmware_Library.git",
+    "AT32F413_Firmware_Library": "https://github.com/ArteryTek/AT32F413_Firmware_Library.git",
+    "AT32F415_Firmware_Library": "https://github.com/ArteryTek/AT32F415_Firmware_Library.git",
+    "AT32F421_Firmware_Library": "https://github.com/ArteryTek/AT32F421_Firmware_Library.git",
+    "AT32F422_426_Firmware_Library": "https://github.com/ArteryTek/AT32F422_426_Firmware_Library.git",
+    "AT32F423_Firmware_Library": "https://github.com/ArteryTek/AT32F423_Firmware_Library.git",
+    "AT32F425_Firmware_Library": "https://github.com/ArteryTek/AT32F425_Firmware_Library.git",
+    "AT32F435_437_Firmware_Library": "https://github.com/ArteryTek/AT32F435_437_Firmware_Library.git",
+    "AT32F45x_Firmware_Library": "https://github.com/ArteryTek/AT32F45x_Firmware_Library.git",
+    "AT32F490_Firmware_Library": "https://github.com/ArteryTek/AT32F490_Firmware_Library.git",
+    "AT32L021_Firmware_Library": "https://github.com/ArteryTek/AT32L021_Firmware_Library.git",
+    "AT32M412_416_Firmware_Library": "https://github.com/ArteryTek/AT32M412_416_Firmware_Library.git",
+    "AT32WB415_Firmware_Library": "https://github.com/ArteryTek/AT32WB415_Firmware_Library.git",
+}
+
+# Gitee mirror URLs for the same repos — used as fallback when
+# GitHub is unreachable (common for users in China).
+PACKAGE_GIT_URLS_GITEE = {
+    k: v.replace("github.com/ArteryTek", "gitee.com/arterytek")
+    for k, v in PACKAGE_GIT_URLS.items()
+}
+
+
+def store_entry(store_dir, pkg_name):
+    """Return ``("git", path)``, ``("tar", path)`` or None."""
+    if not store_dir or not os.path.isdir(store_dir):
+        return None
+    mirror = os.path.join(store_dir, pkg_name + ".git")
+    if os.path.isdir(mirror):
+        return "git", mirror
+    tarballs = []
+    pat = re.compile(r"^%s(?:-(\d+(?:\.\d+)*))?\.tar\.gz$" % re.escape(pkg_name))
+    for name in os.listdir(store_dir):
+        m = pat.match(name)
+        if m:
+            version = tuple(int(x) for x in (m.group(1) or "0").split("."))
+            tarballs.append((version, os.path.join(store_dir, name)))
+    if tarballs:
+        return "tar", max(tarballs)[1]
+    return None
+
+
+def mirror_url(path):
+    """URL for cloning from a bare mirror (``file://`` so --depth works)."""
+    return "file://" + os.path.abspath(path).replace(os.sep, "/")
+
+
+def extract_tarball(path, pkg_dir):
+    """Extract a package tarball, dropping a single top-level directory."""
+    tmp_dir = pkg_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            target = os.path.realpath(os.path.join(tmp_dir, member.name))
+            if not target.startswith(os.path.realpath(tmp_dir) + os.sep):
+                raise ValueError("Unsafe path %s in %s" % (member.name, path))
+        tar.extractall(tmp_dir)
+    entries = os.listdir(tmp_dir)
+    root = tmp_dir
+    if len(entries) == 1 and os.path.isdir(os.path.join(tmp_dir, entries[0])):
+        root = os.path.join(tmp_dir, entries[0])
+    os.rename(root, pkg_dir)
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+
+def _prefetch_one(store_dir, pkg_name, url):
+    mirror = os.path.join(store_dir, pkg_name + ".git")
+    start = time.time()
+    if os.path.isdir(mirror):
+        cmd = ["git", "-C", mirror, "remote", "update", "--prune"]
+        action = "updated"
+    else:
+        cmd = ["git", "clone", "--mirror", "--quiet", url, mirror]
+        action = "mirrored"
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return {
+        "package": pkg_name,
+        "ok": proc.returncode == 0,
+        "action": action,
+        "seconds": round(time.time() - start, 1),
+        "output": proc.stdout.decode(errors="replace").strip(),
+    }
+
+
+def prefetch(store_dir, jobs=4, mirror="github", packages=None, log=print):
+    """Mirror or refresh every firmware library package in parallel.
+
+    Returns the list of per-package results; ``log`` gets one line each.
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    urls = PACKAGE_GIT_URLS_GITEE if mirror == "gitee" else PACKAGE_GIT_URLS
+    names = packages or sorted(set(BSP_PACKAGE_MAP.values()))
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(_prefetch_one, store_dir, name, urls[name])
+                   for name in names]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            log("%-32s %s in %.1fs%s" % (
+                result["package"],
+                result["action"] if result["ok"] else "FAILED",
+                result["seconds"],
+                "" if result["ok"] else "\n" + result["output"]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fill or refresh the local AT32 firmware library store.")
+    parser.add_argument("--store", default=os.environ.get("AT32_FIRMWARE_STORE"),
+                        help="store directory (default: $AT32_FIRMWARE_STORE)")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--mirror", choices=("github", "gitee"), default="github")
+    parser.add_argument("packages", nargs="*",
+                        help="package names (default: all BSPs)")
+    args = parser.parse_args(argv)
+    if not args.store:
+        parser.error("no store directory given")
+    unknown = [name for name in args.packages if name not in PACKAGE_GIT_URLS]
+    if unknown:
+        parser.error("unknown package(s) %s; valid names: %s" % (
+            ", ".join(unknown), ", ".join(sorted(PACKAGE_GIT_URLS))))
+    results = prefetch(args.store, args.jobs, args.mirror, args.packages or None)
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""Hot code placement in zero-wait flash or SRAM.
+
+On the AT32F403/F403A/F407 and AT32F435/437 the flash and the SRAM share
+one block of fast memory: the SRAM size selected by the EOPB0 option byte
+decides how much of the flash, counted from its start, is read without
+wait states ("ZW"); code beyond it runs much slower. The functions,
+objects and sections listed as hot are placed in front of ``.text`` by a
+linker script derived from the board's one, either right after the
+vector table (``zw``, inside the zero-wait area) or in SRAM, copied there
+from flash before the constructors run (``sram``). Functions marked
+``__hot`` in the sources go to the same place::
+
+    python hotcode.py generate AT32F403AxG_FLASH.ld hot.ld -e foo -e dsp.c -e .fast
+    python hotcode.py check firmware.elf --zw-size 256K -e foo
+
+Entries:
+
+* ``name`` (wildcards allowed): the function's ``.text.<name>`` section,
+  which needs ``-ffunction-sections``
+* ``file.c``/``file.cpp``/``file.o``: all code of that object
+* ``libname.a``: all code of that archive
+* ``.section``: that input section
+"""
+
+import argparse
+import fnmatch
+import os
+import re
+import sys
+from collections import namedtuple
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools import ldscript  # noqa: E402
+from at32tools.elf import STT_FUNC, ElfError, ElfFile  # noqa: E402
+
+FLASH_BASE = 0x08000000
+SRAM_BASE = 0x20000000
+REGIONS = ("zw", "sram")
+
+# Fast memory (KB) shared by the SRAM and the zero-wait flash, per BSP
+ZW_POOL = {
+    "AT32F403": 352,
+    "AT32F403A_407": 352,
+    "AT32A403A": 352,
+    "AT32F435_437": 640,
+}
+
+OUTPUT_SECTION = {"zw": ".hot_text", "sram": ".ramfunc"}
+START_SYMBOL = {"zw": "__hot_start", "sram": "__ramfunc_start"}
+END_SYMBOL = {"zw": "__hot_end", "sram": "__ramfunc_end"}
+OBJECT_SUFFIXES = (".c", ".cc", ".cpp", ".cxx", ".s", ".S", ".o")
+
+ENTRY_RE = re.compile(r"^[\w.*?+\-\[\]/]+$")
+TEXT_SECTION_RE = re.compile(r"^[ \t]*\.text\s*:", re.M)
+ESTACK_RE = re.compile(r"^([ \t]*_estack\s*=\s*)[^;]+;", re.M)
+
+Pattern = namedtuple("Pattern", "kind name input")
+
+
+class HotCodeError(Exception):
+    pass
+
+
+def parse_patterns(spec):
+    """``board_build.hot_code`` (comma or whitespace separated) as a list
+    of :class:`Pattern`; ``input`` is the linker input section
+    description."""
+    patterns = []
+    for entry in re.split(r"[,\s]+", spec or ""):
+        if not entry:
+            continue
+        if not ENTRY_RE.match(entry):
+            raise HotCodeError("Invalid hot code entry %r" % entry)
+        if entry.startswith("."):
+            patterns.append(Pattern("section", entry, "*(%s)" % entry))
+        elif entry.endswith(".a"):
+            patterns.append(Pattern(
+                "archive", entry, "*%s:*(.text .text.*)" % entry))
+        elif entry.endswith(OBJECT_SUFFIXES):
+            obj = entry if entry.endswith(".o") else entry + ".o"
+            patterns.append(Pattern("object", entry, "*%s(.text .text.*)" % obj))
+        else:
+            patterns.append(Pattern("function", entry, "*(.text.%s)" % entry))
+    return patterns
+
+
+def zw_size(bsp, sram_size):
+    """Zero-wait flash size in bytes with ``sram_size`` bytes of SRAM, or
+    None when the whole flash of the series runs at full speed or the
+    split is not known."""
+    pool = ZW_POOL.get(bsp)
+    if pool is None:
+        return None
+    return max(pool * 1024 - sram_size, 0)
+
+
+def ram_region(text):
+    for region in ldscript.parse_memory_regions(text):
+        if region.origin <= SRAM_BASE < region.origin + region.length:
+            return region
+    return None
+
+
+def _section_block(region, patterns, ram_name):
+    name = OUTPUT_SECTION[region]
+    lines = [
+        "  %s :" % name,
+        "  {",
+        "    . = ALIGN(4);",
+        "    %s = .;" % START_SYMBOL[region],
+        "    *(%s %s.*)" % (name, name),
+    ]
+    lines.extend("    %s" % p.input for p in patterns)
+    lines.extend([
+        "    . = ALIGN(4);",
+        "    %s = .;" % END_SYMBOL[region],
+        "  } >FLASH" if region == "zw" else "  } >%s AT> FLASH" % ram_name,
+    ])
+    if region == "sram":
+        lines.append("  __ramfunc_load = LOADADDR(.ramfunc);")
+    return "\n".join(lines) + "\n\n"
+
+
+def generate(text, patterns, region=None, sram_size=None, source=""):
+    """The linker script ``text`` with the hot code section for ``region``
+    (None: no hot code section) and, if given, the RAM region resized to
+    ``sram_size`` bytes.
+
+    The section is inserted in front of ``.text``, whose wildcards would
+    otherwise take the listed input sections first.
+    """
+    ram = ram_region(text)
+    if sram_size:
+        if ram is None:
+            raise HotCodeError("No RAM region at 0x%08X in %s" % (SRAM_BASE, source))
+        text, count = re.subn(
+            r"(^[ \t]*%s\b[^\n]*?(?:LENGTH|len|l)\s*=\s*)[^\n,;}]+" % re.escape(ram.name),
+            lambda m: "%s%dK" % (m.group(1), sram_size // 1024), text, count=1,
+            flags=re.M | re.I)
+        if not count:
+            raise HotCodeError("Cannot resize the %s region of %s" % (ram.name, source))
+        text = ESTACK_RE.sub(lambda m: "%sORIGIN(%s) + LENGTH(%s);" % (
+            m.group(1), ram.name, ram.name), text)
+
+    if region:
+        if region not in REGIONS:
+            raise HotCodeError("Unknown hot code region %r (expected %s)" % (
+                region, " or ".join(REGIONS)))
+        anchor = TEXT_SECTION_RE.search(text)
+        if not anchor:
+            raise HotCodeError("No .text output section in %s" % source)
+        if region == "sram":
+            if ram is None:
+                raise HotCodeError("No RAM region at 0x%08X in %s" % (SRAM_BASE, source))
+            if ".preinit_array" not in text:
+                # the copy to SRAM runs from .preinit_array
+                raise HotCodeError("No .preinit_array section in %s" % source)
+        block = _section_block(region, patterns, ram.name if ram else None)
+        text = text[:anchor.start()] + block + text[anchor.start():]
+
+    header = "/* Generated from %s by at32tools/hotcode.py, do not edit */\n\n" % (
+        source or "the board's linker script")
+    return header + text
+
+
+def header_text(region):
+    """``at32_hot.h``, force-included into every source."""
+    return (
+        "/* Generated by at32tools/hotcode.py: board_build.hot_code_region = %s */\n"
+        "#ifndef AT32_HOT_H\n"
+        "#define AT32_HOT_H\n"
+        "#ifndef __hot\n"
+        "#define __hot __attribute__((section(\"%s\"), noinline))\n"
+        "#endif\n"
+        "#endif\n" % (region, OUTPUT_SECTION[region]))
+
+
+# Runs from .preinit_array: after the .data copy and SystemInit(), before
+# the constructors and main()
+RAMFUNC_SOURCE = """\
+/* Generated by at32tools/hotcode.py: copies the SRAM hot code */
+#include <stdint.h>
+
+extern uint32_t __ramfunc_load[], __ramfunc_start[], __ramfunc_end[];
+
+static void at32_ramfunc_copy(void)
+{
+  const uint32_t *src = __ramfunc_load;
+  uint32_t *dst = __ramfunc_start;
+
+  while (dst < __ramfunc_end)
+    *dst++ = *src++;
+  __asm volatile ("dsb\\n\\tisb" ::: "memory");
+}
+
+__attribute__((used, section(".preinit_array")))
+static void (*const at32_ramfunc_init)(void) = at32_ramfunc_copy;
+"""
+
+
+def write_if_changed(path, text):
+    """Write ``text`` unless the file already holds it (keeps the
+    timestamp, so nothing relinks); returns True when written."""
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return True
+
+
+def check(elf_path, region, patterns=(), zw_end=None):
+    """Return ``(start, end, functions, spilled, missing)`` for the hot
+    code of the linked ELF: its address range, the functions in it
+    (``[(name, address, size)]``), those of them past ``zw_end`` (only
+    for ``zw``: SRAM runs at full speed) and the function entries that
+    matched none of them."""
+    with ElfFile(elf_path) as elf:
+        symbols = elf.symbols()
+    bounds = dict((s.name, s.value) for s in symbols
+                  if s.name in (START_SYMBOL[region], END_SYMBOL[region]))
+    if len(bounds) != 2:
+        raise HotCodeError("%s has no %s section" % (elf_path, OUTPUT_SECTION[region]))
+    start, end = bounds[START_SYMBOL[region]], bounds[END_SYMBOL[region]]
+    functions = sorted(
+        (s.name, s.value & ~1, s.size) for s in symbols
+        if s.type == STT_FUNC and start <= s.value & ~1 < end)
+    spilled = [f for f in functions
+               if region == "zw" and zw_end is not None and f[1] + f[2] > zw_end]
+    names = [f[0] for f in functions]
+    missing = [p.name for p in patterns if p.kind == "function"
+               and not fnmatch.filter(names, p.name)]
+    return start, end, functions, spilled, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("generate", help="write the linker script")
+    p.add_argument("ldscript")
+    p.add_argument("output")
+    p.add_argument("-e", "--entry", action="append", default=[], dest="entries",
+                   help="hot code entry (repeatable)")
+    p.add_argument("--region", choices=REGIONS, default="zw")
+    p.add_argument("--sram-size", help="e.g. 224K")
+    p = sub.add_parser("check", help="report the hot code of a linked ELF")
+    p.add_argument("elf")
+    p.add_argument("-e", "--entry", action="append", default=[], dest="entries",
+                   help="hot function to look for (repeatable)")
+    p.add_argument("--region", choices=REGIONS, default="zw")
+    p.add_argument("--zw-size", help="e.g. 256K")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "generate":
+            with open(args.ldscript) as f:
+                text = f.read()
+            sram_size = ldscript.parse_number(args.sram_size) if args.sram_size else None
+            write_if_changed(args.output, generate(
+                text, parse_patterns(",".join(args.entries)), args.region,
+                sram_size, os.path.basename(args.ldscript)))
+        elif args.command == "check":
+            zw_end = (FLASH_BASE + ldscript.parse_number(args.zw_size)
+                      if args.zw_size else None)
+            start, end, functions, spilled, missing = check(
+                args.elf, args.region, parse_patterns(",".join(args.entries)), zw_end)
+            print("%s: 0x%08X-0x%08X, %d bytes" % (
+                OUTPUT_SECTION[args.region], start, end, end - start))
+            for name, address, size in functions:
+                print("  0x%08X %6d %s%s" % (
+                    address, size, name, "  (slow flash)" if (name, address, size)
+                    in spilled else ""))
+            for name in missing:
+                print("  not placed: %s" % name)
+            return 1 if spilled or missing else 0
+        else:
+            parser.print_help()
+            return 1
+    except (OSError, ValueError, ElfError, HotCodeError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""Helpers for the GNU ld linker scripts of the AT32 firmware library."""
+
+import re
+
+from at32tools.elf import MemoryRegion
+
+MEMORY_BLOCK_RE = re.compile(r"\bMEMORY\s*\{(.*?)\}", re.S)
+REGION_RE = re.compile(
+    r"(\w+)\s*(?:\([^)]*\))?\s*:\s*(?:ORIGIN|org|o)\s*=\s*([^,]+),\s*"
+    r"(?:LENGTH|len|l)\s*=\s*([^\n;]+)", re.I)
+COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+
+
+def parse_number(text):
+    text = text.strip()
+    m = re.match(r"^(0x[0-9a-fA-F]+|\d+)\s*([KM]?)$", text)
+    if not m:
+        raise ValueError("unsupported expression %r" % text)
+    value = int(m.group(1), 0)
+    return value * {"": 1, "K": 1024, "M": 1024 * 1024}[m.group(2).upper()]
+
+
+def memory_regions(path):
+    """Return the ``MEMORY`` regions of a linker script, in order.
+
+    Regions whose origin or length is not a plain number (``K``/``M``
+    suffixes allowed) are skipped.
+    """
+    with open(path) as f:
+        return parse_memory_regions(f.read())
+
+
+def parse_memory_regions(text):
+    """:func:`memory_regions` of linker script text."""
+    text = COMMENT_RE.sub("", text)
+    block = MEMORY_BLOCK_RE.search(text)
+    if not block:
+        return []
+    regions = []
+    for name, origin, length in REGION_RE.findall(block.group(1)):
+        try:
+            regions.append(MemoryRegion(name, parse_number(origin), parse_number(length)))
+        except ValueError:
+            continue
+    return regions
@@ -0,0 +1,368 @@
+"""GNU ld map file analyser: attributes flash and RAM usage to the
+libraries, object files and symbols of a build.
+
+The build always writes ``linkmap.map`` (see ``frameworks/_bare.py``).
+Usage per memory region is summed for every input section of the map and
+attributed to a group (``cmsis``, ``driver``, ``middleware/<name>``,
+``lib/<name>``, ``src``, ``toolchain/<archive>``), an object file and a
+symbol. Space the linker adds itself (alignment, heap and stack
+reservations) is reported under the ``(linker)`` group.
+
+    python mapfile.py .pio/build/<env>/linkmap.map --elf firmware.elf
+    python mapfile.py linkmap.map --baseline memory_baseline.json
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from collections import defaultdict, namedtuple
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools.elf import SHT_NOBITS, ElfFile  # noqa: E402
+
+Region = namedtuple("Region", "name origin length")
+InputSection = namedtuple(
+    "InputSection", "output name address size file symbols")
+
+REGION_RE = re.compile(r"^(\S+)\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)")
+OUTPUT_RE = re.compile(
+    r"^(\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)"
+    r"(?:\s+load address 0x([0-9a-fA-F]+))?\s*$")
+INPUT_RE = re.compile(
+    r"^ (\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s*(.*)$")
+SYMBOL_RE = re.compile(r"^\s+0x([0-9a-fA-F]+)\s+([^\s=]+)\s*$")
+SECTION_PREFIXES = (".text.", ".rodata.", ".data.", ".bss.", ".noinit.",
+                    ".ramfunc.", ".sram_text.")
+NOBITS_NAMES = (".bss", ".noinit", "._user_heap_stack", ".heap", ".stack",
+                "COMMON")
+LINKER = "(linker)"
+
+
+class MapFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.regions = []
+        # output section name -> (address, size, load address or None)
+        self.outputs = {}
+        self.sections = []
+        self._parse()
+
+    def _parse(self):
+        with open(self.path, errors="replace") as f:
+            lines = f.read().splitlines()
+
+        i = 0
+        while i < len(lines) and lines[i].strip() != "Memory Configuration":
+            i += 1
+        i += 1
+        while i < len(lines) and lines[i].strip() != "Linker script and memory map":
+            m = REGION_RE.match(lines[i])
+            if m and m.group(1) not in ("Name", "*default*"):
+                self.regions.append(Region(
+                    m.group(1), int(m.group(2), 16), int(m.group(3), 16)))
+            i += 1
+
+        output = None
+        pending = None
+        current = None
+        for line in lines[i:]:
+            if pending is not None:
+                line = pending + line
+                pending = None
+            if not line.strip():
+                continue
+            if line[0] not in " *":
+                m = OUTPUT_RE.match(line)
+                if m and m.group(1):
+                    output = m.group(1)
+                    self.outputs[output] = (
+                        int(m.group(2), 16), int(m.group(3), 16),
+                        int(m.group(4), 16) if m.group(4) else None)
+                    current = None
+                elif " " not in line.strip() and not line.startswith(("LOAD", "OUTPUT")):
+                    pending = line  # long name, values on the next line
+                continue
+            if output is None:
+                continue
+            if line.startswith(" ") and not line.startswith("  "):
+                stripped = line.strip()
+                if stripped.startswith("*") and not stripped.startswith("*fill*"):
+                    continue  # input section pattern, e.g. *(.text*)
+                m = INPUT_RE.match(line)
+                if m and m.group(1):
+                    current = InputSection(
+                        output, m.group(1), int(m.group(2), 16),
+                        int(m.group(3), 16), m.group(4).strip(), [])
+                    self.sections.append(current)
+                elif " " not in stripped:
+                    pending = line
+                continue
+            m = SYMBOL_RE.match(line)
+            if m and current is not None and not m.group(2).startswith("."):
+                current.symbols.append((int(m.group(1), 16), m.group(2)))
+
+    def region_of(self, address):
+        for region in self.regions:
+            if region.origin <= address < region.origin + region.length:
+                return region.name
+        return None
+
+
+def group_of(path, build_dir, lib_cache_dir=None):
+    """Return ``(group, object)`` for the file column of a map entry.
+
+    Archives linked from the firmware library cache
+    (``<lib_cache_dir>/<xx>/<key>/`` mirrors the build directory) get the
+    group they have when built in place.
+    """
+    member = None
+    m = re.match(r"^(.*)\((.*)\)$", path)
+    if m:
+        path, member = m.groups()
+    abs_path = os.path.abspath(path)
+    build_dir = os.path.abspath(build_dir)
+    if lib_cache_dir:
+        lib_cache_dir = os.path.abspath(lib_cache_dir)
+        if abs_path.startswith(lib_cache_dir + os.sep):
+            parts = os.path.relpath(abs_path, lib_cache_dir).split(os.sep)
+            if len(parts) >= 3:
+                build_dir = os.path.join(lib_cache_dir, parts[0], parts[1])
+    name = os.path.basename(path)
+    if not abs_path.startswith(build_dir + os.sep):
+        archive = name[3:-2] if name.startswith("lib") and name.endswith(".a") else name
+        return "toolchain/%s" % archive, member or name
+
+    parts = os.path.relpath(abs_path, build_dir).split(os.sep)
+    if member is not None and name.startswith("lib") and name.endswith(".a"):
+        lib = name[3:-2]
+        if len(parts) == 1:
+            return lib, member
+        if parts[0] == "middleware":
+            return "middleware/%s" % lib, member
+        return "lib/%s" % lib, member  # PlatformIO library dirs (lib<hash>)
+    if parts[0] == "src":
+        return "src", "/".join(parts[1:])
+    return parts[0], "/".join(parts[1:]) or name
+
+
+def _symbol_name(section):
+    for prefix in SECTION_PREFIXES:
+        if section.name.startswith(prefix):
+            return section.name[len(prefix):]
+    return None
+
+
+def analyse(mapfile, build_dir, nobits=None, lib_cache_dir=None):
+    """Attribute the map's input sections to groups, objects and symbols.
+
+    ``nobits`` is the set of output section names without file content
+    (from the ELF); when omitted, it is guessed from the section names.
+    ``lib_cache_dir`` is the firmware library cache the archives may come
+    from (see :func:`group_of`).
+    """
+    if nobits is None:
+        nobits = set(name for name in mapfile.outputs
+                     if name.startswith(NOBITS_NAMES))
+
+    def regions_for(output):
+        address, _, load_address = mapfile.outputs[output]
+        regions = []
+        run_region = mapfile.region_of(address)
+        if run_region:
+            regions.append(run_region)
+        if load_address is not None and output not in nobits:
+            load_region = mapfile.region_of(load_address)
+            if load_region and load_region not in regions:
+                regions.append(load_region)
+        return regions
+
+    groups = defaultdict(lambda: defaultdict(int))
+    objects = defaultdict(lambda: defaultdict(int))
+    symbols = defaultdict(lambda: defaultdict(int))
+    symbol_objects = {}
+    used = defaultdict(int)
+    attributed = defaultdict(int)
+
+    for section in mapfile.sections:
+        if not section.size:
+            continue
+        regions = regions_for(section.output)
+        if not regions:
+            continue  # debug info and other non-allocated sections
+        attributed[section.output] += section.size
+        if section.name == "*fill*":
+            # Alignment padding and location counter gaps (heap, stack)
+            group, obj = LINKER, section.output
+        else:
+            group, obj = group_of(section.file, build_dir, lib_cache_dir)
+        key = "%s/%s" % (group, obj)
+
+        # Split the section between the symbols the map lists in it; with
+        # -ffunction-sections the section name names the function
+        shares = []
+        listed = sorted(s for s in section.symbols
+                        if section.address <= s[0] < section.address + section.size)
+        if len(listed) > 1:
+            bounds = [s[0] for s in listed[1:]] + [section.address + section.size]
+            shares = [(name, end - addr)
+                      for (addr, name), end in zip(listed, bounds)]
+            shares[0] = (shares[0][0], shares[0][1] + listed[0][0] - section.address)
+        elif section.name == "*fill*":
+            shares = [(section.output, section.size)]
+        else:
+            name = (listed[0][1] if listed else _symbol_name(section)
+                    or "%s (%s)" % (section.name, obj))
+            shares = [(name, section.size)]
+
+        for region in regions:
+            used[region] += section.size
+            groups[group][region] += section.size
+            objects[key][region] += section.size
+            for name, size in shares:
+                symbols[name][region] += size
+                symbol_objects[name] = key
+
+    # Space inside output sections not covered by input sections: location
+    # counter assignments such as the heap and stack reservations
+    for output, (address, size, _) in mapfile.outputs.items():
+        rest = size - attributed[output]
+        regions = regions_for(output)
+        if rest <= 0 or not regions:
+            continue
+        for region in regions:
+            used[region] += rest
+            groups[LINKER][region] += rest
+            objects["%s/%s" % (LINKER, output)][region] += rest
+            symbols[output][region] += rest
+            symbol_objects[output] = "%s/%s" % (LINKER, output)
+
+    def plain(table):
+        return dict((k, dict(v)) for k, v in table.items())
+
+    return {
+        "regions": dict((r.name, {"origin": r.origin, "length": r.length,
+                                  "used": used[r.name]})
+                        for r in mapfile.regions),
+        "groups": plain(groups),
+        "objects": plain(objects),
+        "symbols": dict((name, dict(v, object=symbol_objects[name]))
+                        for name, v in symbols.items()),
+    }
+
+
+def analyse_build(map_path, build_dir, elf_path=None, lib_cache_dir=None):
+    nobits = None
+    if elf_path and os.path.isfile(elf_path):
+        with ElfFile(elf_path) as elf:
+            nobits = set(s.name for s in elf.sections if s.type == SHT_NOBITS)
+    return analyse(MapFile(map_path), build_dir, nobits, lib_cache_dir)
+
+
+def diff(report, baseline, level="objects"):
+    """Return ``[(name, region, delta)]`` sorted by decreasing growth."""
+    changes = []
+    new, old = report.get(level, {}), baseline.get(level, {})
+    for name in set(new) | set(old):
+        for region in set(new.get(name, {})) | set(old.get(name, {})):
+            if region == "object":
+                continue
+            delta = new.get(name, {}).get(region, 0) - old.get(name, {}).get(region, 0)
+            if delta:
+                changes.append((name, region, delta))
+    changes.sort(key=lambda c: (-c[2], c[0], c[1]))
+    return changes
+
+
+def _top(table, region, count):
+    rows = [(values.get(region, 0), name) for name, values in table.items()]
+    return sorted((r for r in rows if r[0]), reverse=True)[:count]
+
+
+def format_report(report, top=10, baseline=None):
+    lines = []
+    regions = [r for r, v in sorted(report["regions"].items(),
+                                    key=lambda x: x[1]["origin"]) if v["used"]]
+    for region in regions:
+        info = report["regions"][region]
+        line = "%-8s %8d / %8d bytes (%.1f%%)" % (
+            region, info["used"], info["length"],
+            100.0 * info["used"] / info["length"] if info["length"] else 0)
+        if baseline and region in baseline.get("regions", {}):
+            line += "  %+d" % (info["used"] - baseline["regions"][region]["used"])
+        lines.append(line)
+    for region in regions:
+        lines.append("")
+        lines.append("%s by library:" % region)
+        for size, name in _top(report["groups"], region, len(report["groups"])):
+            lines.append("  %8d  %s" % (size, name))
+        lines.append("%s top %d objects:" % (region, top))
+        for size, name in _top(report["objects"], region, top):
+            lines.append("  %8d  %s" % (size, name))
+        lines.append("%s top %d symbols:" % (region, top))
+        for size, name in _top(report["symbols"], region, top):
+            lines.append("  %8d  %s (%s)" % (
+                size, name, report["symbols"][name]["object"]))
+    if baseline:
+        lines.append("")
+        changes = diff(report, baseline, "objects")
+        growth = [c for c in changes if c[2] > 0][:top]
+        shrink = [c for c in reversed(changes) if c[2] < 0][:top]
+        lines.append("Largest growth since baseline:")
+        lines.extend("  %+8d  %-6s %s" % (d, r, n) for n, r, d in growth)
+        if not growth:
+            lines.append("  (none)")
+        if shrink:
+            lines.append("Largest reductions since baseline:")
+            lines.extend("  %+8d  %-6s %s" % (d, r, n) for n, r, d in shrink)
+    return "\n".join(lines) + "\n"
+
+
+def check_budgets(report, budgets):
+    """``budgets`` maps ``region`` or ``group:region`` to a byte limit;
+    returns the list of exceeded budgets as messages."""
+    errors = []
+    for key, limit in sorted(budgets.items()):
+        if ":" in key:
+            group, region = key.rsplit(":", 1)
+            used = report["groups"].get(group, {}).get(region, 0)
+        else:
+            group, region = None, key
+            used = report["regions"].get(region, {}).get("used", 0)
+        if used > limit:
+            errors.append("%s%s uses %d bytes, budget is %d bytes" % (
+                "%s in " % group if group else "", region, used, limit))
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("map")
+    parser.add_argument("--build-dir", help="default: the map's directory")
+    parser.add_argument("--elf", help="linked ELF, to tell .bss-like sections")
+    parser.add_argument("--lib-cache-dir", help="firmware library cache of the build")
+    parser.add_argument("--json", help="write the report as JSON")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    report = analyse_build(
+        args.map, args.build_dir or os.path.dirname(os.path.abspath(args.map)),
+        args.elf, args.lib_cache_dir)
+    baseline = None
+    if args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    sys.stdout.write(format_report(report, args.top, baseline))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Flash several boards at once, one OpenOCD instance per probe.
+
+Every probe gets its own OpenOCD process with its own GDB/TCL/telnet
+ports, selected by serial number (``adapter serial``) or, with a
+``usb:`` prefix, by USB port location (``adapter usb location``). The
+instances run concurrently; per-device results and timings are written
+to a JSON report and the exit status is non-zero if any device failed::
+
+    python multiflash.py --probe 0C1A2B --probe usb:1-1.4 \\
+        --image firmware.bin --address 0x08000000 --report report.json \\
+        -- -s scripts -f interface/atlink.cfg -f target/at32f403axG.cfg
+
+``--openocd`` selects the executable, so a stand-in script can take the
+place of OpenOCD when testing a station setup.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BASE_PORT = 50000
+LOG_TAIL = 20
+
+
+def probe_command(probe):
+    """OpenOCD command selecting ``probe``."""
+    if probe.startswith("usb:"):
+        return "adapter usb location %s" % probe[4:]
+    return "adapter serial %s" % probe
+
+
+def program_command(image, address=""):
+    return "program {%s} %s verify reset; shutdown;" % (
+        os.path.abspath(image).replace("\\", "/"), address)
+
+
+def probe_args(openocd_args, probe, index, command, base_port=DEFAULT_BASE_PORT):
+    port = base_port + 3 * index
+    return list(openocd_args) + [
+        "-c", probe_command(probe),
+        "-c", "gdb_port %d; tcl_port %d; telnet_port %d" % (port, port + 1, port + 2),
+        "-c", command,
+    ]
+
+
+def _log_name(probe):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in probe) + ".log"
+
+
+def flash_one(openocd, args, probe, log_dir=None, timeout=None):
+    started = time.time()
+    try:
+        proc = subprocess.run(
+            [openocd] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            timeout=timeout)
+        returncode = proc.returncode
+        output = proc.stdout.decode(errors="replace")
+    except subprocess.TimeoutExpired as e:
+        returncode = None
+        output = (e.output or b"").decode(errors="replace") + "\nTimed out\n"
+    except OSError as e:
+        returncode = None
+        output = "Cannot run %s: %s\n" % (openocd, e)
+    result = {
+        "probe": probe,
+        "ok": returncode == 0,
+        "returncode": returncode,
+        "seconds": round(time.time() - started, 3),
+        "log_tail": output.splitlines()[-LOG_TAIL:],
+    }
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        result["log"] = os.path.join(log_dir, _log_name(probe))
+        with open(result["log"], "w") as f:
+            f.write(output)
+    return result
+
+
+def flash_all(openocd, openocd_args, probes, command, jobs=None, log_dir=None,
+              timeout=None, base_port=DEFAULT_BASE_PORT):
+    """Run one OpenOCD per probe concurrently and return the report."""
+    if len(set(probes)) != len(probes):
+        raise ValueError("Duplicate probes in %s" % ", ".join(probes))
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=jobs or len(probes) or 1) as pool:
+        devices = list(pool.map(
+            lambda item: flash_one(
+                openocd,
+                probe_args(openocd_args, item[1], item[0], command, base_port),
+                item[1], log_dir, timeout),
+            enumerate(probes)))
+    return {
+        "command": command,
+        "seconds": round(time.time() - started, 3),
+        "passed": sum(1 for d in devices if d["ok"]),
+        "failed": sum(1 for d in devices if not d["ok"]),
+        "devices": devices,
+    }
+
+
+def format_report(report):
+    lines = []
+    for device in report["devices"]:
+        lines.append("  %-24s %s  %6.1f s" % (
+            device["probe"], "PASS" if device["ok"] else "FAIL", device["seconds"]))
+        if not device["ok"] and device["log_tail"]:
+            lines.extend("      " + line for line in device["log_tail"][-3:])
+    lines.append("%d passed, %d failed in %.1f s" % (
+        report["passed"], report["failed"], report["seconds"]))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--openocd", default="openocd")
+    parser.add_argument("--probe", action="append", required=True,
+                        help="probe serial number or usb:<location>")
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--address", default="",
+                        help="load address, for raw binary images")
+    parser.add_argument("--report", default="multiflash_report.json")
+    parser.add_argument("--logs", help="directory for the OpenOCD logs")
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--base-port", type=int, default=DEFAULT_BASE_PORT)
+    parser.add_argument("openocd_args", nargs="*",
+                        help="OpenOCD interface/target arguments (after --)")
+    args = parser.parse_args(argv)
+
+    try:
+        report = flash_all(
+            args.openocd, args.openocd_args, args.probe,
+            program_command(args.image, args.address), args.jobs, args.logs,
+            args.timeout, args.base_port)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    sys.stdout.write(format_report(report))
+    write_report(report, args.report)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""Local, directory-backed object cache used as a compiler launcher.
+
+Usage (prefixed to the compile command lines by ``builder/main.py``)::
+
+    python objcache.py --dir CACHE_DIR --log LOG_FILE -- arm-none-eabi-gcc ...
+
+A cache entry is keyed on the compiler (path, size, mtime and ``--version``
+output), the full argument list minus the output path, and the preprocessed
+source.  Commands that are not a single ``-c`` compilation, or that produce
+extra outputs (``-save-temps``, dependency files), are run unchanged.
+Every invocation appends ``hit``/``miss``/``skip`` to the log file; the
+build reads it to print statistics and calls :func:`trim` to evict the
+least recently used entries.
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+SOURCE_EXTS = (".c", ".cc", ".cpp", ".cxx", ".s", ".S")
+UNCACHEABLE_PREFIXES = ("-save-temps", "-M", "-ftime-report", "-fstack-usage",
+                        "-fcallgraph-info", "-fdump-")
+PCH_PRAGMA = re.compile(rb'^#pragma GCC pch_preprocess "([^"]+)"', re.M)
+
+
+def uncacheable_flags(flags):
+    """The flags of ``flags`` that make every compile a ``skip``."""
+    return [f for f in flags if str(f).startswith(UNCACHEABLE_PREFIXES)]
+
+
+def _split_compile(args):
+    """Return ``(output, source, args_without_output)`` or None."""
+    if "-c" not in args or "-E" in args:
+        return None
+    output = None
+    sources = []
+    rest = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-o" and i + 1 < len(args):
+            output = args[i + 1]
+            i += 2
+            continue
+        if arg.startswith(UNCACHEABLE_PREFIXES):
+            return None
+        if not arg.startswith("-") and arg.endswith(SOURCE_EXTS):
+            sources.append(arg)
+        rest.append(arg)
+        i += 1
+    if not output or len(sources) != 1:
+        return None
+    return output, sources[0], rest
+
+
+def _compiler_id(cache_dir, compiler):
+    path = shutil.which(compiler) or compiler
+    st = os.stat(path)
+    stamp = "%s:%d:%d" % (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    id_path = join_entry(cache_dir, "compilers",
+                         hashlib.sha256(stamp.encode()).hexdigest())
+    if os.path.isfile(id_path):
+        with open(id_path) as f:
+            return f.read()
+    version = subprocess.check_output([path, "--version"]).decode(errors="replace")
+    _atomic_write(id_path, (stamp + "\n" + version).encode())
+    return stamp + "\n" + version
+
+
+def join_entry(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, key[:2], key)
+
+
+def _atomic_write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _log(log_path, line):
+    if log_path:
+        with open(log_path, "a") as f:
+            f.write(line + "\n")
+
+
+def _run(cmd):
+    return subprocess.call(cmd)
+
+
+def compile_cached(cache_dir, log_path, cmd):
+    split = _split_compile(cmd[1:])
+    if not split:
+        _log(log_path, "skip")
+        return _run(cmd)
+    output, source, rest = split
+
+    pre = subprocess.run(
+        [cmd[0]] + [a for a in rest if a != "-c"] + ["-E"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if pre.returncode != 0:
+        # Let the real compiler report the error
+        _log(log_path, "skip")
+        return _run(cmd)
+
+    digest = hashlib.sha256()
+    digest.update(_compiler_id(cache_dir, cmd[0]).encode())
+    digest.update("\0".join(rest).encode())
+    digest.update(pre.stdout)
+    # With -fpch-preprocess the header content is only in the .gch
+    for gch in PCH_PRAGMA.findall(pre.stdout):
+        with open(gch, "rb") as f:
+            digest.update(f.read())
+    key = digest.hexdigest()
+
+    obj_entry = join_entry(cache_dir, "objects", key) + ".o"
+    err_entry = join_entry(cache_dir, "objects", key) + ".stderr"
+    if os.path.isfile(obj_entry):
+        shutil.copyfile(obj_entry, output)
+        if os.path.isfile(err_entry):
+            with open(err_entry, "rb") as f:
+                sys.stderr.buffer.write(f.read())
+            os.utime(err_entry, None)
+        os.utime(obj_entry, None)  # LRU: last use time
+        _log(log_path, "hit")
+        return 0
+
+    proc = subprocess.run(cmd, stderr=subprocess.PIPE)
+    sys.stderr.buffer.write(proc.stderr)
+    if proc.returncode == 0 and os.path.isfile(output):
+        with open(output, "rb") as f:
+            _atomic_write(obj_entry, f.read())
+        if proc.stderr:
+            _atomic_write(err_entry, proc.stderr)
+    _log(log_path, "miss")
+    return proc.returncode
+
+
+def read_stats(log_path):
+    stats = {"hit": 0, "miss": 0, "skip": 0}
+    if os.path.isfile(log_path):
+        with open(log_path) as f:
+            for line in f:
+                line = line.strip()
+                if line in stats:
+                    stats[line] += 1
+    return stats
+
+
+def trim(cache_dir, max_size):
+    """Evict least recently used entries until the cache fits ``max_size``.
+
+    Returns ``(total_size, evicted_count)``.
+    """
+    entries = []
+    total = 0
+    objects_dir = os.path.join(cache_dir, "objects")
+    for root, _, files in os.walk(objects_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    return total, evicted
+
+
+def parse_size(value):
+    """``"2G"``, ``"500M"``, ``"64K"`` or a plain byte count."""
+    value = str(value).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", required=True, help="cache directory")
+    parser.add_argument("--log", help="file to append hit/miss/skip to")
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    cmd = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not cmd:
+        parser.error("missing compiler command")
+    return compile_cached(args.dir, args.log, cmd)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+"""A long-lived OpenOCD server per probe, shared by uploads and debug
+sessions.
+
+The first user starts OpenOCD in the background with its own GDB and
+TCL ports and records its pid, ports and configuration in a state file
+(``<state dir>/<probe>.json``). Later uploads send ``program``/``reset``
+over the TCL RPC port instead of starting OpenOCD again; debug sessions
+connect GDB to the recorded port. A server that no longer answers, or
+that was started for another board, is replaced::
+
+    python ocdserver.py status
+    python ocdserver.py program atlink firmware.elf -- -s scripts -f ...
+    python ocdserver.py stop [atlink]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+STATE_DIR = os.path.join(tempfile.gettempdir(), "at32-ocdserver")
+RPC_TERMINATOR = b"\x1a"
+START_TIMEOUT = 15
+LOCK_TIMEOUT = 60
+
+
+class OcdServerError(Exception):
+    pass
+
+
+class TclClient(object):
+    """OpenOCD TCL RPC: commands and results end with ``\\x1a``."""
+
+    def __init__(self, port, host="127.0.0.1", timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.sock.settimeout(timeout)
+        self._buffer = b""
+
+    def run(self, command):
+        self.sock.sendall(command.encode() + RPC_TERMINATOR)
+        while RPC_TERMINATOR not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise OcdServerError("OpenOCD closed the TCL connection")
+            self._buffer += data
+        result, self._buffer = self._buffer.split(RPC_TERMINATOR, 1)
+        return result.decode(errors="replace")
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _safe_name(key):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+
+
+def server_key(protocol, port=""):
+    """State file key of the server for a probe: the upload/debug protocol
+    and, if set, the upload port."""
+    return "-".join(p for p in (protocol, port) if p)
+
+
+def _config_hash(openocd, args):
+    return hashlib.sha256(json.dumps([openocd] + list(args)).encode()).hexdigest()[:16]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _state_path(key, state_dir):
+    return os.path.join(state_dir, _safe_name(key) + ".json")
+
+
+def load_state(key, state_dir=STATE_DIR):
+    try:
+        with open(_state_path(key, state_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def alive(state):
+    """Whether the server recorded in ``state`` answers on its TCL port."""
+    try:
+        with TclClient(state["tcl_port"], timeout=5) as client:
+            return bool(client.run("version"))
+    except (OSError, OcdServerError, KeyError, TypeError):
+        return False
+
+
+class _Lock(object):
+    """Exclusive lock file; a lock older than LOCK_TIMEOUT is stale."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > LOCK_TIMEOUT:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() > deadline:
+                    raise OcdServerError("Timed out waiting for %s" % self.path)
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except (OSError, TypeError):
+        pass
+
+
+def _stop(state):
+    if alive(state):
+        try:
+            with TclClient(state["tcl_port"], timeout=5) as client:
+                client.run("shutdown")
+        except (OSError, OcdServerError):
+            pass
+    else:
+        _kill(state.get("pid"))
+
+
+def _start(openocd, args, key, state_dir):
+    gdb_port, tcl_port = _free_port(), _free_port()
+    log = os.path.join(state_dir, _safe_name(key) + ".log")
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (subprocess.DETACHED_PROCESS
+                                   | subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        kwargs["start_new_session"] = True
+    with open(log, "w") as out:
+        proc = subprocess.Popen(
+            [openocd] + list(args) + [
+                "-c", "gdb_port %d; tcl_port %d; telnet_port disabled" % (
+                    gdb_port, tcl_port)],
+            stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT,
+            **kwargs)
+    state = {
+        "pid": proc.pid,
+        "gdb_port": gdb_port,
+        "tcl_port": tcl_port,
+        "config": _config_hash(openocd, args),
+        "log": log,
+        "started": time.time(),
+    }
+    deadline = time.time() + START_TIMEOUT
+    while not alive(state):
+        if proc.poll() is not None or time.time() > deadline:
+            if proc.poll() is None:
+                proc.kill()
+            with open(log, errors="replace") as f:
+                tail = "".join(f.readlines()[-10:])
+            raise OcdServerError("OpenOCD did not start:\n" + tail)
+        time.sleep(0.2)
+    with open(_state_path(key, state_dir), "w") as f:
+        json.dump(state, f, indent=1)
+    return state
+
+
+def ensure(openocd, args, key, state_dir=STATE_DIR):
+    """Return the state of a running server for probe ``key`` started with
+    ``openocd args``, starting or replacing it as needed."""
+    os.makedirs(state_dir, exist_ok=True)
+    with _Lock(_state_path(key, state_dir) + ".lock"):
+        state = load_state(key, state_dir)
+        if state and state.get("config") == _config_hash(openocd, args) and alive(state):
+            return state
+        if state:
+            _stop(state)
+            os.remove(_state_path(key, state_dir))
+        return _start(openocd, args, key, state_dir)
+
+
+def stop(key, state_dir=STATE_DIR):
+    state = load_state(key, state_dir)
+    if not state:
+        return False
+    _stop(state)
+    os.remove(_state_path(key, state_dir))
+    return True
+
+
+def keys(state_dir=STATE_DIR):
+    if not os.path.isdir(state_dir):
+        return []
+    return sorted(n[:-5] for n in os.listdir(state_dir) if n.endswith(".json"))
+
+
+def run(openocd, args, key, command, state_dir=STATE_DIR):
+    """Run ``command`` on the server and return its result; a server that
+    dies on the way is restarted once."""
+    script = "if {[catch {%s} at32_err]} {set _ \"ERROR: $at32_err\"} else {set _ OK}" % command
+    for attempt in (1, 2):
+        state = ensure(openocd, args, key, state_dir)
+        try:
+            with TclClient(state["tcl_port"]) as client:
+                result = client.run(script)
+            break
+        except (OSError, OcdServerError):
+            if attempt == 2:
+                raise
+    if result != "OK":
+        raise OcdServerError(result[len("ERROR: "):] if result.startswith("ERROR: ")
+                             else result)
+    return state
+
+
+def program_command(image, address=""):
+    return "program {%s} %s verify reset" % (
+        os.path.abspath(image).replace("\\", "/"), address)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    openocd_args = []
+    if "--" in argv:  # OpenOCD arguments follow "--"
+        openocd_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--state-dir", default=STATE_DIR)
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("status", help="list the recorded servers")
+    p = sub.add_parser("program", help="program an image through the server")
+    p.add_argument("key", help="probe, e.g. the upload protocol")
+    p.add_argument("image")
+    p.add_argument("--address", default="")
+    p.add_argument("--openocd", default="openocd")
+    p = sub.add_parser("stop", help="stop one or all servers")
+    p.add_argument("key", nargs="?")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            for key in keys(args.state_dir):
+                state = load_state(key, args.state_dir) or {}
+                print("%-24s pid %-7s gdb :%-5s tcl :%-5s %s" % (
+                    key, state.get("pid"), state.get("gdb_port"), state.get("tcl_port"),
+                    "running" if alive(state) else "dead"))
+        elif args.command == "program":
+            run(args.openocd, openocd_args, args.key,
+                program_command(args.image, args.address), args.state_dir)
+        elif args.command == "stop":
+            for key in [args.key] if args.key else keys(args.state_dir):
+                stop(key, args.state_dir)
+        else:
+            parser.print_help()
+            return 1
+    except OcdServerError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Split an ELF image into its populated address ranges.
+
+``objcopy -O binary`` writes one flat file from the lowest to the highest
+load address, so an image that also places data in the user system data
+area, in SRAM or in a far flash region covers the whole gap. Here the
+loadable sections are grouped into segments instead (blocks closer than
+``MERGE_GAP`` are joined, the gap filled with zeros like objcopy does)
+and described by a manifest::
+
+    {"segments": [{"address": 134217728, "size": 47712,
+                   "file": "firmware.bin", "sha256": "..."}, ...]}
+
+The first segment is written to ``<name>.bin``, the others to
+``<name>_0x<address>.bin``. An image with a single segment gives a
+``.bin`` identical to objcopy's::
+
+    python segments.py firmware.elf .pio/build/<env>/firmware
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools.elf import ElfFile  # noqa: E402
+
+# Padding a gap up to one flash sector is cheaper than programming
+# another segment
+MERGE_GAP = 4096
+
+
+def segments(elf_path, merge_gap=MERGE_GAP):
+    """Return ``[(address, bytes)]`` of the populated ranges of the ELF."""
+    with ElfFile(elf_path) as elf:
+        return merge(elf.load_image(), merge_gap)
+
+
+def merge(blocks, merge_gap=MERGE_GAP):
+    """Join the ``ElfFile.load_image()`` blocks closer than ``merge_gap``."""
+    merged = []
+    for address, data in blocks:
+        if merged and address - (merged[-1][0] + len(merged[-1][1])) <= merge_gap:
+            last = merged[-1][1]
+            last.extend(bytes(address - (merged[-1][0] + len(last))))
+            last.extend(data)
+        else:
+            merged.append((address, bytearray(data)))
+    return [(address, bytes(data)) for address, data in merged]
+
+
+def manifest_path(base):
+    return base + ".segments.json"
+
+
+def write(elf_path, base, merge_gap=MERGE_GAP, blocks=None):
+    """Write ``<base>.bin``, the other segment files and the manifest for
+    ``elf_path`` (or its already read ``load_image()`` blocks); returns
+    the manifest."""
+    out_dir = os.path.dirname(base) or "."
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.basename(base) + "_0x"
+    for name in os.listdir(out_dir):
+        if name.startswith(prefix) and name.endswith(".bin"):
+            os.remove(os.path.join(out_dir, name))
+
+    manifest = {"segments": []}
+    parts = merge(blocks, merge_gap) if blocks is not None else segments(elf_path, merge_gap)
+    for index, (address, data) in enumerate(parts):
+        path = base + (".bin" if index == 0 else "_0x%08X.bin" % address)
+        with open(path, "wb") as f:
+            f.write(data)
+        manifest["segments"].append({
+            "address": address,
+            "size": len(data),
+            "file": os.path.basename(path),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        })
+    with open(manifest_path(base), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def load(base):
+    """Return ``[(address, path)]`` from the manifest of ``<base>``, or
+    None when there is none."""
+    try:
+        with open(manifest_path(base)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    out_dir = os.path.dirname(base) or "."
+    return [(s["address"], os.path.join(out_dir, s["file"]))
+            for s in manifest["segments"]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("elf")
+    parser.add_argument("base", help="output path without extension")
+    parser.add_argument("--merge-gap", type=int, default=MERGE_GAP)
+    args = parser.parse_args(argv)
+
+    for segment in write(args.elf, args.base, args.merge_gap)["segments"]:
+        print("0x%08X  %8d  %s" % (segment["address"], segment["size"], segment["file"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""Worst-case stack depth from ``-fstack-usage`` output and the call graph.
+
+Per-function frame sizes come from the ``.su`` files GCC writes next to
+every object. The call graph is read from the linked ELF (Thumb ``BL``
+and ``B.W`` tail calls between function symbols, ``BLX <reg>`` as an
+indirect call) and, with GCC 10 or newer, merged with the
+``-fcallgraph-info`` ``.ci`` files. The deepest path is computed for every
+entry point: ``main``, every handler in the vector table and any extra
+functions named (FreeRTOS task functions). Recursion, indirect calls,
+dynamically sized frames and functions without stack information make a
+result a lower bound; they are reported.
+
+    python stackusage.py firmware.elf .pio/build/<env> --entry vTaskMain
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+if not __package__:  # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from at32tools.demangle import demangle  # noqa: E402
+from at32tools.elf import STT_FUNC, ElfFile  # noqa: E402
+
+# Registers the core pushes on exception entry, without and with the FPU
+# context (lazy stacking reserves the space either way)
+EXCEPTION_FRAME = 32
+EXCEPTION_FRAME_FPU = 104
+INDIRECT = "__indirect_call"
+
+Frame = namedtuple("Frame", "size qualifier")
+Entry = namedtuple("Entry", "name kind depth path flags")
+
+SU_LINE_RE = re.compile(r"^(.*):(\d+):(\d+):(.+?)\t(\d+)\t(\S+)\s*$")
+CI_EDGE_RE = re.compile(
+    r'^edge:\s*\{\s*sourcename:\s*"([^"]+)"\s+targetname:\s*"([^"]+)"')
+
+
+def _su_key(name):
+    """``int foo(int)`` (C++ with return type) -> ``foo(int)``."""
+    depth = 0
+    for i, c in enumerate(name):
+        if c in "<(":
+            depth += 1
+        elif c in ">)":
+            depth -= 1
+        elif c == " " and depth == 0 and "(" in name[i:]:
+            return _su_key(name[i + 1:])
+    return name
+
+
+def read_stack_usage(build_dir):
+    """Frame sizes from every ``.su`` file under ``build_dir``, keyed by
+    function name (C++ names as GCC prints them, without return type)."""
+    frames = {}
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            if not name.endswith(".su"):
+                continue
+            with open(os.path.join(root, name), errors="replace") as f:
+                for line in f:
+                    m = SU_LINE_RE.match(line)
+                    if not m:
+                        continue
+                    key = _su_key(m.group(4))
+                    frame = Frame(int(m.group(5)), m.group(6))
+                    # Same-named static functions: keep the larger frame
+                    if key not in frames or frames[key].size < frame.size:
+                        frames[key] = frame
+    return frames
+
+
+def read_callgraph_info(build_dir):
+    """Call edges from ``-fcallgraph-info`` ``.ci`` files."""
+    edges = {}
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            if not name.endswith(".ci"):
+                continue
+            with open(os.path.join(root, name), errors="replace") as f:
+                for line in f:
+                    m = CI_EDGE_RE.match(line.strip())
+                    if m:
+                        edges.setdefault(m.group(1), set()).add(m.group(2))
+    return edges
+
+
+def _branch_target(hw1, hw2, address):
+    s = (hw1 >> 10) & 1
+    i1 = ~(((hw2 >> 13) & 1) ^ s) & 1
+    i2 = ~(((hw2 >> 11) & 1) ^ s) & 1
+    offset = (s << 24) | (i1 << 23) | (i2 << 22) | ((hw1 & 0x3FF) << 12) | ((hw2 & 0x7FF) << 1)
+    if s:
+        offset -= 1 << 25
+    return (address + 4 + offset) & 0xFFFFFFFF
+
+
+def elf_callgraph(elf):
+    """Return ``(functions, aliases, edges)``: ``{address: name}`` of the
+    function symbols, ``{alias: name}`` for symbols sharing an address and
+    ``{name: set(callee names)}`` from the Thumb code."""
+    functions = {}
+    sizes = {}
+    aliases = {}
+    for sym in sorted(elf.symbols(), key=lambda s: (s.bind != 1, s.name)):
+        if sym.type == STT_FUNC and sym.size:
+            address = sym.value & ~1
+            # The first global name is the canonical one
+            if address in functions:
+                aliases[sym.name] = functions[address]
+                continue
+            functions[address] = sym.name
+            sizes[address] = sym.size
+    mapping = elf.mapping_symbols()
+
+    def data_ranges(start, end):
+        ranges = []
+        data_start = None
+        for address, kind in mapping:
+            if address >= end:
+                break
+            if kind == "d" and data_start is None:
+                data_start = max(address, start)
+            elif kind != "d" and data_start is not None:
+                if address > start:
+                    ranges.append((data_start, address))
+                data_start = None
+        if data_start is not None:
+            ranges.append((data_start, end))
+        return [(max(a, start), min(b, end)) for a, b in ranges if b > start]
+
+    edges = {}
+    for start, name in functions.items():
+        end = start + sizes[start]
+        code = elf.read(start, sizes[start])
+        if code is None:
+            continue
+        skip = data_ranges(start, end)
+        callees = edges.setdefault(name, set())
+        offset = 0
+        while offset + 2 <= len(code):
+            address = start + offset
+            if any(a <= address < b for a, b in skip):
+                offset += 2
+                continue
+            hw1 = struct.unpack_from("<H", code, offset)[0]
+            if hw1 >> 11 in (0x1D, 0x1E, 0x1F) and offset + 4 <= len(code):
+                hw2 = struct.unpack_from("<H", code, offset + 2)[0]
+                if hw1 >> 11 == 0x1E and hw2 & 0xD000 in (0xD000, 0x9000):
+                    target = _branch_target(hw1, hw2, address)
+                    # BL always calls; B.W only leaves the function as a
+                    # tail call when it lands on another function
+                    if target in functions and (
+                            hw2 & 0xD000 == 0xD000 or not start <= target < end):
+                        callees.add(functions[target])
+                offset += 4
+                continue
+            if hw1 & 0xFF87 == 0x4780:  # BLX <Rm>
+                callees.add(INDIRECT)
+            offset += 2
+    return functions, aliases, edges
+
+
+def vector_handlers(functions, elf):
+    """Return ``(reset handler, [exception handlers])`` from the vector
+    table (``.isr_vector``)."""
+    sec = elf.section(".isr_vector")
+    if sec is None:
+        return None, []
+    data = elf.section_data(sec)
+    words = [w for (w,) in struct.iter_unpack("<I", data[:len(data) - len(data) % 4])]
+    reset = functions.get(words[1] & ~1) if len(words) > 1 else None
+    handlers = []
+    for word in words[2:]:
+        name = functions.get(word & ~1)
+        if word and name and name not in handlers:
+            handlers.append(name)
+    return reset, handlers
+
+
+class StackAnalysis(object):
+
+    def __init__(self, frames, edges, aliases=None):
+        self.frames = frames
+        self.edges = edges
+        self.aliases = aliases or {}
+        self._memo = {}
+
+    def frame(self, name):
+        names = [name] + [a for a, n in self.aliases.items() if n == name]
+        for alias in names:
+            for key in (alias, demangle(alias)):
+                if key in self.frames:
+                    return self.frames[key]
+        return None
+
+    def worst(self, name, stack=()):
+        """Return ``(depth, path, flags)`` of the deepest call chain."""
+        if name in self._memo:
+            return self._memo[name]
+        if name in stack:
+            cycle = list(stack[stack.index(name):]) + [name]
+            return 0, [], {"recursion": [" -> ".join(demangle(n) for n in cycle)]}
+
+        flags = {}
+        frame = self.frame(name)
+        own = 0
+        if frame is None:
+            flags["unknown"] = [demangle(name)]
+        else:
+            own = frame.size
+            if frame.qualifier.startswith("dynamic") and "bounded" not in frame.qualifier:
+                flags["dynamic"] = [demangle(name)]
+
+        best_depth, best_path = 0, []
+        for callee in sorted(self.edges.get(name, ())):
+            if callee == INDIRECT:
+                flags.setdefault("indirect", []).append(demangle(name))
+                continue
+            depth, path, callee_flags = self.worst(callee, stack + (name,))
+            for key, values in callee_flags.items():
+                flags.setdefault(key, [])
+                flags[key].extend(v for v in values if v not in flags[key])
+            if depth > best_depth or not best_path:
+                best_depth, best_path = depth, path
+
+        result = (own + best_depth, [name] + best_path, flags)
+        if not stack or "recursion" not in flags:
+            self._memo[name] = result
+        return result
+
+
+def analyse(elf_path, build_dir, tasks=(), fpu=False):
+    """Return the entry point results and the functions whose stack usage
+    is unknown."""
+    with ElfFile(elf_path) as elf:
+        functions, aliases, edges = elf_callgraph(elf)
+        reset, handlers = vector_handlers(functions, elf)
+    for source, targets in read_callgraph_info(build_dir).items():
+        source = aliases.get(source, source)
+        edges.setdefault(source, set()).update(
+            INDIRECT if t.startswith("__indirect") else aliases.get(t, t)
+            for t in targets)
+    analysis = StackAnalysis(read_stack_usage(build_dir), edges, aliases)
+
+    names = set(functions.values())
+    entries = []
+    for kind, candidates in (("main", ["main"]), ("reset", [reset] if reset else []),
+                             ("isr", handlers), ("task", list(tasks))):
+        for name in candidates:
+            name = aliases.get(name, name)
+            if name not in names and name not in edges:
+                entries.append(Entry(name, kind, None, [], {"missing": [name]}))
+                continue
+            depth, path, flags = analysis.worst(name)
+            if kind == "isr":
+                depth += EXCEPTION_FRAME_FPU if fpu else EXCEPTION_FRAME
+            entries.append(Entry(name, kind, depth, path, flags))
+    return entries
+
+
+def format_report(entries):
+    lines = ["Worst-case stack usage (bytes):"]
+    for entry in entries:
+        if entry.depth is None:
+            lines.append("  %-32s %8s  (no such function)" % (
+                demangle(entry.name), "-"))
+            continue
+        bound = "" if not set(entry.flags) - {"missing"} else " (lower bound)"
+        lines.append("  %-32s %8d%s  %s" % (
+            "%s [%s]" % (demangle(entry.name), entry.kind), entry.depth, bound,
+            " -> ".join(demangle(n) for n in entry.path)))
+        for key, label in (("recursion", "recursion"),
+                           ("indirect", "indirect calls in"),
+                           ("dynamic", "dynamic stack in"),
+                           ("unknown", "no stack usage for")):
+            if entry.flags.get(key):
+                lines.append("      %s: %s" % (label, ", ".join(entry.flags[key][:8]) + (
+                    ", ..." if len(entry.flags[key]) > 8 else "")))
+    isrs = [e.depth for e in entries if e.kind == "isr" and e.depth is not None]
+    mains = [e.depth for e in entries if e.kind == "main" and e.depth is not None]
+    if mains and isrs:
+        lines.append("Main stack with the deepest interrupt on top: %d bytes" % (
+            mains[0] + max(isrs)))
+    return "\n".join(lines) + "\n"
+
+
+def to_json(entries):
+    return [{
+        "name": e.name, "demangled": demangle(e.name), "kind": e.kind,
+        "depth": e.depth, "path": e.path, "flags": e.flags,
+    } for e in entries]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("elf")
+    parser.add_argument("build_dir", help="directory with the .su/.ci files")
+    parser.add_argument("--entry", action="append", default=[],
+                        help="extra entry point, e.g. a FreeRTOS task function")
+    parser.add_argument("--fpu", action="store_true",
+                        help="count the FPU context in exception frames")
+    parser.add_argument("--json", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    entries = analyse(args.elf, args.build_dir, args.entry, args.fpu)
+    sys.stdout.write(format_report(entries))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(to_json(entries), f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
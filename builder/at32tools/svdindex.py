@@ -0,0 +1,480 @@
+"""Pre-parsed, mmap-able register index compiled from an SVD file.
+
+Parsing a multi-megabyte SVD takes a good fraction of a second; the index
+holds the same peripherals, registers and fields with ``derivedFrom`` and
+the size/access/reset defaults already resolved, in fixed-size records
+that are read straight from a memory map. Lookups by address or by name go
+through hash tables stored in the file, so opening an index and answering
+a query takes well under a millisecond::
+
+    python svdindex.py compile misc/svd/AT32F435xx_v2.svd
+    python svdindex.py lookup misc/svd/AT32F435xx_v2.idx 0x40023808
+    python svdindex.py decode misc/svd/AT32F435xx_v2.idx CRM_CFG 0x0000940A
+    python svdindex.py list misc/svd/AT32F435xx_v2.idx CRM
+
+Registers are named ``PERIPHERAL_REGISTER`` (or ``PERIPHERAL.REGISTER``).
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+from xml.etree import ElementTree
+
+MAGIC = b"AT32SVDI"
+VERSION = 1
+
+# magic, version, peripherals, registers, fields, address slots, name slots,
+# and the file offsets of the peripheral, register, field, address table,
+# name table and string sections
+HEADER = struct.Struct("<8sIIIIIIIIIIII")
+# name, description, group, base address, first register, register count
+PERIPHERAL = struct.Struct("<IIIIII")
+# name, description, peripheral, address, size, access, reset value,
+# reset mask, first field, field count
+REGISTER = struct.Struct("<IIIIIIIIII")
+# name, description, register, bit offset, bit width, access
+FIELD = struct.Struct("<IIIBBxxI")
+SLOT = struct.Struct("<I")
+
+Peripheral = namedtuple("Peripheral", "index name description group base")
+Register = namedtuple(
+    "Register", "index peripheral name description address size access "
+    "reset_value reset_mask")
+Field = namedtuple("Field", "name description offset width access")
+
+
+class SvdIndexError(Exception):
+    pass
+
+
+def _int(text, default=None):
+    if text is None:
+        return default
+    text = text.strip().lower()
+    if text.startswith("#"):
+        return int(text[1:].replace("x", "0"), 2)
+    if text.startswith("0x"):
+        return int(text, 16)
+    return int(text, 10)
+
+
+def _text(elem, tag, default=None):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return default
+    return " ".join(child.text.split())
+
+
+def _hash_address(address, mask):
+    return ((address >> 2) * 2654435761) & 0xFFFFFFFF & mask
+
+
+def _hash_name(name, mask):
+    h = 0x811C9DC5  # FNV-1a
+    for c in name.encode():
+        h = ((h ^ c) * 0x01000193) & 0xFFFFFFFF
+    return h & mask
+
+
+def _table_size(count):
+    size = 8
+    while size < count * 2:
+        size *= 2
+    return size
+
+
+def parse_svd(svd_path):
+    """Return the peripherals of an SVD as dicts with inherited properties
+    and ``derivedFrom`` resolved."""
+    device = ElementTree.parse(svd_path).getroot()
+    defaults = {
+        "size": _int(_text(device, "size"), 32),
+        "access": _text(device, "access", ""),
+        "reset_value": _int(_text(device, "resetValue"), 0),
+        "reset_mask": _int(_text(device, "resetMask"), 0xFFFFFFFF),
+    }
+
+    def registers_of(elem, inherited):
+        registers = []
+        by_name = {}
+        parent = elem.find("registers")
+        for reg in (parent.findall("register") if parent is not None else []):
+            base = by_name.get(reg.get("derivedFrom"), {})
+            r = {
+                "name": _text(reg, "name"),
+                "description": _text(reg, "description", base.get("description", "")),
+                "offset": _int(_text(reg, "addressOffset"), base.get("offset", 0)),
+                "size": _int(_text(reg, "size"), base.get("size", inherited["size"])),
+                "access": _text(reg, "access", base.get("access", inherited["access"])),
+                "reset_value": _int(_text(reg, "resetValue"),
+                                    base.get("reset_value", inherited["reset_value"])),
+                "reset_mask": _int(_text(reg, "resetMask"),
+                                   base.get("reset_mask", inherited["reset_mask"])),
+                "fields": list(base.get("fields", [])),
+            }
+            fields = reg.find("fields")
+            if fields is not None:
+                r["fields"] = []
+                for field in fields.findall("field"):
+                    offset, width = _field_bits(field)
+                    r["fields"].append({
+                        "name": _text(field, "name"),
+                        "description": _text(field, "description", ""),
+                        "offset": offset,
+                        "width": width,
+                        "access": _text(field, "access", r["access"]),
+                    })
+            by_name[r["name"]] = r
+            registers.append(r)
+        return registers
+
+    peripherals = []
+    by_name = {}
+    parent = device.find("peripherals")
+    for elem in (parent.findall("peripheral") if parent is not None else []):
+        base = by_name.get(elem.get("derivedFrom"))
+        if elem.get("derivedFrom") and base is None:
+            raise SvdIndexError("%s: %s derives from unknown peripheral %s" % (
+                svd_path, _text(elem, "name"), elem.get("derivedFrom")))
+        base = base or {}
+        inherited = {
+            "size": _int(_text(elem, "size"), defaults["size"]),
+            "access": _text(elem, "access", defaults["access"]),
+            "reset_value": _int(_text(elem, "resetValue"), defaults["reset_value"]),
+            "reset_mask": _int(_text(elem, "resetMask"), defaults["reset_mask"]),
+        }
+        p = {
+            "name": _text(elem, "name"),
+            "description": _text(elem, "description", base.get("description", "")),
+            "group": _text(elem, "groupName", base.get("group", "")),
+            "base": _int(_text(elem, "baseAddress"), base.get("base", 0)),
+            "registers": registers_of(elem, inherited) or base.get("registers", []),
+        }
+        by_name[p["name"]] = p
+        peripherals.append(p)
+    return peripherals
+
+
+def _field_bits(field):
+    if field.find("bitOffset") is not None:
+        return (_int(_text(field, "bitOffset")),
+                _int(_text(field, "bitWidth"), 1))
+    if field.find("lsb") is not None:
+        lsb = _int(_text(field, "lsb"))
+        return lsb, _int(_text(field, "msb")) - lsb + 1
+    msb, lsb = _text(field, "bitRange").strip("[]").split(":")
+    return int(lsb), int(msb) - int(lsb) + 1
+
+
+def compile_svd(svd_path, index_path):
+    """Compile ``svd_path`` into the binary index ``index_path``."""
+    peripherals = parse_svd(svd_path)
+
+    strings = bytearray(b"\0")
+    string_offsets = {"": 0}
+
+    def s(text):
+        text = text or ""
+        if text not in string_offsets:
+            string_offsets[text] = len(strings)
+            strings.extend(text.encode() + b"\0")
+        return string_offsets[text]
+
+    p_records = []
+    r_records = []
+    f_records = []
+    addresses = []
+    names = []
+    for p_index, p in enumerate(peripherals):
+        p_records.append(PERIPHERAL.pack(
+            s(p["name"]), s(p["description"]), s(p["group"]), p["base"],
+            len(r_records), len(p["registers"])))
+        for r in p["registers"]:
+            r_index = len(r_records)
+            address = (p["base"] + r["offset"]) & 0xFFFFFFFF
+            r_records.append(REGISTER.pack(
+                s(r["name"]), s(r["description"]), p_index, address,
+                r["size"], s(r["access"]), r["reset_value"] & 0xFFFFFFFF,
+                r["reset_mask"] & 0xFFFFFFFF, len(f_records), len(r["fields"])))
+            for f in r["fields"]:
+                f_records.append(FIELD.pack(
+                    s(f["name"]), s(f["description"]), r_index, f["offset"],
+                    f["width"], s(f["access"])))
+            addresses.append((address, r_index))
+            names.append((("%s.%s" % (p["name"], r["name"])).upper(), r_index))
+
+    address_slots = _table_size(len(addresses))
+    address_table = [0] * address_slots
+    for address, r_index in addresses:
+        slot = _hash_address(address, address_slots - 1)
+        while address_table[slot]:
+            if _register_address(r_records, address_table[slot] - 1) == address:
+                break  # keep the first register at an aliased address
+            slot = (slot + 1) & (address_slots - 1)
+        else:
+            address_table[slot] = r_index + 1
+
+    name_slots = _table_size(len(names))
+    name_table = [0] * name_slots
+    for name, r_index in names:
+        slot = _hash_name(name, name_slots - 1)
+        while name_table[slot]:
+            slot = (slot + 1) & (name_slots - 1)
+        name_table[slot] = r_index + 1
+
+    offset = HEADER.size
+    sections = []
+    for blob in (b"".join(p_records), b"".join(r_records), b"".join(f_records),
+                 struct.pack("<%dI" % address_slots, *address_table),
+                 struct.pack("<%dI" % name_slots, *name_table),
+                 bytes(strings)):
+        sections.append((offset, blob))
+        offset += len(blob) + (-len(blob) % 4)
+
+    tmp = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(
+            MAGIC, VERSION, len(p_records), len(r_records), len(f_records),
+            address_slots, name_slots, *[o for o, _ in sections]))
+        for _, blob in sections:
+            f.write(blob + b"\0" * (-len(blob) % 4))
+    os.replace(tmp, index_path)
+    return index_path
+
+
+def _register_address(r_records, r_index):
+    return REGISTER.unpack(r_records[r_index])[3]
+
+
+def index_path_for(svd_path):
+    return os.path.splitext(svd_path)[0] + ".idx"
+
+
+def ensure_index(svd_path, index_path=None):
+    """Compile the index of ``svd_path`` unless an up-to-date one exists."""
+    index_path = index_path or index_path_for(svd_path)
+    if (not os.path.isfile(index_path)
+            or os.path.getmtime(index_path) < os.path.getmtime(svd_path)):
+        compile_svd(svd_path, index_path)
+    return index_path
+
+
+class SvdIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise SvdIndexError("%s is not an SVD index" % path)
+        if self._data[:8] != MAGIC:
+            raise SvdIndexError("%s is not an SVD index" % path)
+        (_, version, self.peripheral_count, self.register_count,
+         self.field_count, self._address_slots, self._name_slots,
+         self._peripherals, self._registers, self._fields,
+         self._address_table, self._name_table,
+         self._strings) = HEADER.unpack_from(self._data)
+        if version != VERSION:
+            raise SvdIndexError("%s: unsupported index version %d" % (
+                path, version))
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _str(self, offset):
+        start = self._strings + offset
+        return self._data[start:self._data.find(b"\0", start)].decode()
+
+    def peripheral(self, index):
+        name, desc, group, base, _, _ = PERIPHERAL.unpack_from(
+            self._data, self._peripherals + index * PERIPHERAL.size)
+        return Peripheral(index, self._str(name), self._str(desc),
+                          self._str(group), base)
+
+    def peripherals(self):
+        return [self.peripheral(i) for i in range(self.peripheral_count)]
+
+    def register(self, index):
+        (name, desc, p_index, address, size, access, reset_value, reset_mask,
+         _, _) = REGISTER.unpack_from(
+             self._data, self._registers + index * REGISTER.size)
+        return Register(index, self.peripheral(p_index).name, self._str(name),
+                        self._str(desc), address, size, self._str(access),
+                        reset_value, reset_mask)
+
+    def registers(self, peripheral=None):
+        if peripheral is None:
+            return [self.register(i) for i in range(self.register_count)]
+        for i in range(self.peripheral_count):
+            values = PERIPHERAL.unpack_from(
+                self._data, self._peripherals + i * PERIPHERAL.size)
+            if self._str(values[0]).upper() == peripheral.upper():
+                return [self.register(r) for r in range(values[4], values[4] + values[5])]
+        raise SvdIndexError("Unknown peripheral %s" % peripheral)
+
+    def fields(self, register):
+        values = REGISTER.unpack_from(
+            self._data, self._registers + register.index * REGISTER.size)
+        result = []
+        for i in range(values[8], values[8] + values[9]):
+            name, desc, _, offset, width, access = FIELD.unpack_from(
+                self._data, self._fields + i * FIELD.size)
+            result.append(Field(self._str(name), self._str(desc), offset,
+                                width, self._str(access)))
+        return result
+
+    def _probe(self, table, slots, slot, match):
+        mask = slots - 1
+        for _ in range(slots):
+            entry = SLOT.unpack_from(self._data, table + slot * SLOT.size)[0]
+            if not entry:
+                return None
+            if match(entry - 1):
+                return entry - 1
+            slot = (slot + 1) & mask
+        return None
+
+    def _register_at(self, address):
+        def match(index):
+            return REGISTER.unpack_from(
+                self._data, self._registers + index * REGISTER.size)[3] == address
+        return self._probe(self._address_table, self._address_slots,
+                           _hash_address(address, self._address_slots - 1), match)
+
+    def find_address(self, address):
+        """Return ``(register, field)`` covering the byte ``address``; field
+        is None when no field covers it, both are None for unknown
+        addresses."""
+        for aligned in (address & ~3, address & ~1, address):
+            index = self._register_at(aligned)
+            if index is None:
+                continue
+            register = self.register(index)
+            if address >= register.address + max(register.size // 8, 1):
+                continue
+            bit = (address - register.address) * 8
+            for field in self.fields(register):
+                if field.offset <= bit < field.offset + field.width or (
+                        bit <= field.offset < bit + 8):
+                    return register, field
+            return register, None
+        return None, None
+
+    def find_register(self, name):
+        """Look up ``PERIPH_REG`` or ``PERIPH.REG`` (case-insensitive)."""
+        name = name.upper()
+        if "." in name:
+            candidates = [name]
+        else:
+            candidates = ["%s.%s" % (name[:i], name[i + 1:])
+                          for i, c in enumerate(name) if c == "_"]
+        for candidate in candidates:
+            p_name, r_name = candidate.split(".", 1)
+
+            def match(index):
+                values = REGISTER.unpack_from(
+                    self._data, self._registers + index * REGISTER.size)
+                return (self._str(values[0]).upper() == r_name and
+                        self.peripheral(values[2]).name.upper() == p_name)
+            index = self._probe(
+                self._name_table, self._name_slots,
+                _hash_name(candidate, self._name_slots - 1), match)
+            if index is not None:
+                return self.register(index)
+        return None
+
+    def decode(self, register, value):
+        """Return ``[(field, field_value), ...]`` for a register value."""
+        if not isinstance(register, Register):
+            name = register
+            register = self.find_register(name)
+            if register is None:
+                raise SvdIndexError("Unknown register %s" % name)
+        return [(field, (value >> field.offset) & ((1 << field.width) - 1))
+                for field in sorted(self.fields(register),
+                                    key=lambda f: -f.offset)]
+
+
+def open_index(path):
+    """Open an index, or the (cached) index of an SVD file."""
+    if path.lower().endswith(".svd"):
+        path = ensure_index(path)
+    return SvdIndex(path)
+
+
+def _format_register(register):
+    return "%s_%s @ 0x%08X (%d-bit %s, reset 0x%08X)" % (
+        register.peripheral, register.name, register.address, register.size,
+        register.access or "-", register.reset_value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("compile", help="compile an SVD file into an index")
+    p.add_argument("svd")
+    p.add_argument("-o", "--output", help="default: <svd>.idx")
+    p = sub.add_parser("lookup", help="register and field at an address")
+    p.add_argument("index", help=".idx or .svd file")
+    p.add_argument("address", type=lambda x: int(x, 0))
+    p = sub.add_parser("decode", help="decode a register value")
+    p.add_argument("index", help=".idx or .svd file")
+    p.add_argument("register", help="PERIPH_REG")
+    p.add_argument("value", type=lambda x: int(x, 0))
+    p = sub.add_parser("list", help="list peripherals, or the registers of one")
+    p.add_argument("index", help=".idx or .svd file")
+    p.add_argument("peripheral", nargs="?")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "compile":
+            print(compile_svd(args.svd, args.output or index_path_for(args.svd)))
+            return 0
+        if args.command not in ("lookup", "decode", "list"):
+            parser.print_help()
+            return 1
+        with open_index(args.index) as index:
+            if args.command == "lookup":
+                register, field = index.find_address(args.address)
+                if register is None:
+                    print("0x%08X: no register" % args.address)
+                    return 1
+                print(_format_register(register))
+                if field:
+                    print("  %s [%d:%d] %s" % (
+                        field.name, field.offset + field.width - 1,
+                        field.offset, field.description))
+            elif args.command == "decode":
+                register = index.find_register(args.register)
+                if register is None:
+                    raise SvdIndexError("Unknown register %s" % args.register)
+                print("%s = 0x%08X" % (_format_register(register), args.value))
+                for field, value in index.decode(register, args.value):
+                    print("  %-12s [%2d:%2d] = 0x%X  %s" % (
+                        field.name, field.offset + field.width - 1,
+                        field.offset, value, field.description))
+            elif args.peripheral:
+                for register in index.registers(args.peripheral):
+                    print(_format_register(register))
+            else:
+                for peripheral in index.peripherals():
+                    print("%-12s 0x%08X  %s" % (
+                        peripheral.name, peripheral.base, peripheral.description))
+    except (OSError, SvdIndexError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
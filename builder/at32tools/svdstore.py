@@ -0,0 +1,168 @@
+"""Compressed, deduplicated store of the device SVD files.
+
+Each SVD is split into its ``<peripheral>`` blocks and the text between
+them. Identical blocks (most peripherals are shared across a series and
+between sibling devices) are stored once, and the whole store is
+LZMA-compressed into a single file::
+
+    python svdstore.py pack misc/svd misc/svd/at32_svd.store
+    python svdstore.py extract misc/svd/at32_svd.store AT32F435xx_v2.svd -o misc/svd
+    python svdstore.py list misc/svd/at32_svd.store
+
+The store is an LZMA stream holding a JSON manifest line followed by the
+concatenated unique blocks. The manifest maps every device file to its
+block list and the SHA-256 of the original file, so extraction is
+byte-exact and verified.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import lzma
+import os
+import re
+import sys
+
+STORE_NAME = "at32_svd.store"
+PERIPHERAL_RE = re.compile(
+    rb"[ \t]*<peripheral\b.*?</peripheral>[ \t]*(?:\r?\n)?", re.S)
+
+
+class SvdStoreError(Exception):
+    pass
+
+
+def split_svd(data):
+    """Split SVD content into chunks that concatenate back to ``data``."""
+    chunks = []
+    pos = 0
+    for m in PERIPHERAL_RE.finditer(data):
+        if m.start() > pos:
+            chunks.append(data[pos:m.start()])
+        chunks.append(m.group())
+        pos = m.end()
+    if pos < len(data):
+        chunks.append(data[pos:])
+    return chunks
+
+
+def pack(svd_files, store_path):
+    """Write the store for ``svd_files``; returns ``(raw_size, store_size)``."""
+    blocks = {}
+    blob = []
+    offset = 0
+    devices = {}
+    raw_size = 0
+    for path in sorted(svd_files):
+        with open(path, "rb") as f:
+            data = f.read()
+        raw_size += len(data)
+        indexes = []
+        for chunk in split_svd(data):
+            key = hashlib.sha256(chunk).digest()
+            if key not in blocks:
+                blocks[key] = (len(blocks), offset, len(chunk))
+                blob.append(chunk)
+                offset += len(chunk)
+            indexes.append(blocks[key][0])
+        devices[os.path.basename(path)] = {
+            "blocks": indexes,
+            "sha256": hashlib.sha256(data).hexdigest(),
+        }
+
+    manifest = {
+        "version": 1,
+        "blocks": [[o, n] for _, o, n in sorted(blocks.values())],
+        "devices": devices,
+    }
+    payload = json.dumps(manifest, sort_keys=True, separators=(",", ":"))
+    tmp = store_path + ".tmp"
+    with lzma.open(tmp, "wb", preset=9 | lzma.PRESET_EXTREME) as f:
+        f.write(payload.encode() + b"\n")
+        for chunk in blob:
+            f.write(chunk)
+    os.replace(tmp, store_path)
+    return raw_size, os.path.getsize(store_path)
+
+
+def _load(store_path):
+    try:
+        with lzma.open(store_path, "rb") as f:
+            data = f.read()
+    except (OSError, lzma.LZMAError) as e:
+        raise SvdStoreError("Cannot read SVD store %s: %s" % (store_path, e))
+    end = data.index(b"\n")
+    return json.loads(data[:end].decode()), memoryview(data)[end + 1:]
+
+
+def names(store_path):
+    manifest, _ = _load(store_path)
+    return sorted(manifest["devices"])
+
+
+def extract(store_path, name, out_dir):
+    """Extract SVD file ``name`` into ``out_dir`` and return its path.
+
+    A previously extracted file is reused unless the store is newer.
+    """
+    out_path = os.path.join(out_dir, name)
+    if (os.path.isfile(out_path)
+            and os.path.getmtime(out_path) >= os.path.getmtime(store_path)):
+        return out_path
+
+    manifest, blob = _load(store_path)
+    device = manifest["devices"].get(name)
+    if device is None:
+        raise SvdStoreError("%s is not in the SVD store %s" % (name, store_path))
+    blocks = manifest["blocks"]
+    data = b"".join(
+        blob[blocks[i][0]:blocks[i][0] + blocks[i][1]] for i in device["blocks"])
+    if hashlib.sha256(data).hexdigest() != device["sha256"]:
+        raise SvdStoreError("Corrupted SVD store %s (%s)" % (store_path, name))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    tmp = "%s.%d.tmp" % (out_path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("pack", help="pack a directory of SVD files")
+    p.add_argument("svd_dir")
+    p.add_argument("store")
+    p = sub.add_parser("extract", help="extract SVD files from a store")
+    p.add_argument("store")
+    p.add_argument("names", nargs="*", help="default: all devices")
+    p.add_argument("-o", "--output", default=".")
+    p = sub.add_parser("list", help="list the devices in a store")
+    p.add_argument("store")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "pack":
+            raw, packed = pack(
+                glob.glob(os.path.join(args.svd_dir, "*.svd")), args.store)
+            print("Packed %.1f MB of SVD files into %d KB" % (
+                raw / 1048576.0, packed // 1024))
+        elif args.command == "extract":
+            for name in args.names or names(args.store):
+                print(extract(args.store, name, args.output))
+        elif args.command == "list":
+            print("\n".join(names(args.store)))
+        else:
+            parser.print_help()
+            return 1
+    except SvdStoreError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,8 @@
 # Default flags for bare-metal programming (without any framework layers)
 #
 
+import sys
+
 from SCons.Script import DefaultEnvironment
 
 env = DefaultEnvironment()
@@ -10,16 +12,85 @@ board = env.BoardConfig()
 cpu_type = board.get("build.cpu", "cortex-m4") # 默认为cortex-m4，如果是cortex-m0+，则使用cm0plus目录
 gcc_cpu = "cortex-m0plus" if cpu_type == "cortex-m0+" else cpu_type
 
+# Floating point: boards with ``build.fpu = "Yes"`` carry the single
+# precision FPv4 unit of the Cortex-M4F.  Default to the hard-float ABI so
+# float math is done in hardware; ``board_build.float_abi`` overrides it
+# per env (``hard``, ``softfp`` or ``soft``).
+has_fpu = board.get("build.fpu", "No") == "Yes" and cpu_type == "cortex-m4"
+float_abi = board.get("build.float_abi", "hard" if has_fpu else "soft").strip()
+if float_abi not in ("hard", "softfp", "soft"):
+    sys.stderr.write(
+        "Error! Unknown float ABI '%s' (expected hard, softfp or soft).\n" % float_abi)
+    sys.exit(1)
+if float_abi != "soft" and not has_fpu:
+    sys.stderr.write(
+        "Warning! %s has no FPU, ignoring float ABI '%s'.\n" % (
+            board.get("build.mcu", ""), float_abi))
+    float_abi = "soft"
+
+machine_flags = ["-mthumb", "-mcpu=%s" % gcc_cpu]
+if float_abi == "soft":
+    machine_flags.append("-mfloat-abi=soft")
+else:
+    machine_flags.extend(["-mfpu=fpv4-sp-d16", "-mfloat-abi=%s" % float_abi])
+
+env.Replace(FLOAT_ABI=float_abi)
+
+# Build profiles: coherent optimisation flag sets for compiling and linking,
+# selected with ``board_build.profile``.  ``default`` keeps the historical
+# flags (``-Os`` plus ``-save-temps=obj`` intermediate files for inspection).
+BUILD_PROFILES = {
+    "default": {
+        "CCFLAGS": ["-Os", "-save-temps=obj"],  # 生成中间文件供检查优化
+        "LINKFLAGS": ["-Os"],
+    },
+    "dev-fast": {
+        "CCFLAGS": ["-Og"],
+        "LINKFLAGS": ["-Og"],
+    },
+    "release-size": {
+        "CCFLAGS": ["-Os"],
+        "LINKFLAGS": ["-Os"],
+    },
+    # Functions marked ``__attribute__((cold))`` (and the unlikely blocks
+    # split off by -freorder-blocks-and-partition) are still optimised for
+    # size by GCC, hot paths get -O2.
+    "release-speed": {
+        "CCFLAGS": ["-O2", "-freorder-blocks-and-partition"],
+        "LINKFLAGS": ["-O2"],
+    },
+    # Applies to the firmware library archives too: they are built with the
+    # same CCFLAGS and archived with the plugin-aware gcc-ar.
+    "lto": {
+        "CCFLAGS": ["-Os", "-flto", "-ffat-lto-objects"],
+        "LINKFLAGS": ["-Os", "-flto"],
+    },
+}
+
+build_profile = board.get("build.profile", "default").strip()
+if build_profile not in BUILD_PROFILES:
+    sys.stderr.write("Error! Unknown build profile '%s' (expected %s).\n" % (
+        build_profile, ", ".join(sorted(BUILD_PROFILES))))
+    sys.exit(1)
+profile_flags = BUILD_PROFILES[build_profile]
+
+# -save-temps=obj makes every compile uncacheable (see at32tools/objcache.py),
+# so the compiler cache takes precedence over the intermediate files
+if (board.get("build.compiler_cache", "no") == "yes"
+        and "-save-temps=obj" in profile_flags["CCFLAGS"]):
+    print("Compiler cache: not keeping the -save-temps=obj files of the "
+          "'%s' profile" % build_profile)
+    profile_flags = dict(profile_flags, CCFLAGS=[
+        f for f in profile_flags["CCFLAGS"] if f != "-save-temps=obj"])
+
+env.Replace(BUILD_PROFILE=build_profile)
+
 env.Append(
-    CCFLAGS=[
-        "-Os",  # optimize for size
+    CCFLAGS=profile_flags["CCFLAGS"] + [
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
-        "-Wall",
-        "-mthumb",
-        "-mcpu=%s" % gcc_cpu,
-        "-save-temps=obj" # 生成中间文件供检查优化
-    ],
+        "-Wall"
+    ] + machine_flags,
 
     CXXFLAGS=[
         "-fno-rtti",
@@ -30,15 +101,12 @@ env.Append(
         ("F_CPU", "$BOARD_F_CPU")
     ],
 
-    LINKFLAGS=[
-        "-Os",
+    LINKFLAGS=profile_flags["LINKFLAGS"] + [
         "-Wl,--gc-sections,--relax",
         "--specs=nano.specs",
         "--specs=nosys.specs",
-        "-mthumb",
-        "-mcpu=%s" % gcc_cpu,
         "-Wl,-Map,%s/linkmap.map" % env.get("BUILD_DIR")
-    ],
+    ] + machine_flags,  # same flags as CCFLAGS so gcc picks the matching newlib multilib
 
     LIBS=["c", "gcc", "m", "stdc++"]
 )
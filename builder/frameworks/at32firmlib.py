@@ -1,11 +1,20 @@
+import glob
+import hashlib
 import json
 import os
 import re
+import shutil
 import subprocess
 import sys
 from os.path import exists, isdir, isfile, join
 
 from SCons.Script import DefaultEnvironment
+from SCons.Tool import CScanner
+
+from at32tools import fwstore, hotcode
+from at32tools.fwstore import (BSP_PACKAGE_MAP, PACKAGE_GIT_URLS,
+                               PACKAGE_GIT_URLS_GITEE)
+from at32tools.ldscript import parse_number
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
@@ -20,57 +29,13 @@ cmsis_core_dir = "cm0plus" if cpu_type == "cortex-m0+" else "cm4"
 env.SConscript("_bare.py")
 
 # ---------------------------------------------------------------------------
-# BSP → package name → git URL resolution
+# BSP → package name → git URL resolution (see at32tools/fwstore.py)
 # ---------------------------------------------------------------------------
 
-BSP_PACKAGE_MAP = {
-    "AT32A403A": "AT32A403A_Firmware_Library",
-    "AT32A423": "AT32A423_Firmware_Library",
-    "AT32F011": "AT32F011_Firmware_Library",
-    "AT32F402_405": "AT32F402_405_Firmware_Library",
-    "AT32F403": "AT32F403_Firmware_Library",
-    "AT32F403A_407": "AT32F403A_407_Firmware_Library",
-    "AT32F413": "AT32F413_Firmware_Library",
-    "AT32F415": "AT32F415_Firmware_Library",
-    "AT32F421": "AT32F421_Firmware_Library",
-    "AT32F422_426": "AT32F422_426_Firmware_Library",
-    "AT32F423": "AT32F423_Firmware_Library",
-    "AT32F425": "AT32F425_Firmware_Library",
-    "AT32F435_437": "AT32F435_437_Firmware_Library",
-    "AT32F45x": "AT32F45x_Firmware_Library",
-    "AT32F490": "AT32F490_Firmware_Library",
-    "AT32L021": "AT32L021_Firmware_Library",
-    "AT32M412_416": "AT32M412_416_Firmware_Library",
-    "AT32WB415": "AT32WB415_Firmware_Library",
-}
-
-PACKAGE_GIT_URLS = {
-    "AT32A403A_Firmware_Library": "https://github.com/ArteryTek/AT32A403A_Firmware_Library.git",
-    "AT32A423_Firmware_Library": "https://github.com/ArteryTek/AT32A423_Firmware_Library.git",
-    "AT32F011_Firmware_Library": "https://github.com/ArteryTek/AT32F011_Firmware_Library.git",
-    "AT32F402_405_Firmware_Library": "https://github.com/ArteryTek/AT32F402_405_Firmware_Library.git",
-    "AT32F403_Firmware_Library": "https://github.com/ArteryTek/AT32F403_Firmware_Library.git",
-    "AT32F403A_407_Firmware_Library": "https://github.com/ArteryTek/AT32F403A_407_Firmware_Library.git",
-    "AT32F413_Firmware_Library": "https://github.com/ArteryTek/AT32F413_Firmware_Library.git",
-    "AT32F415_Firmware_Library": "https://github.com/ArteryTek/AT32F415_Firmware_Library.git",
-    "AT32F421_Firmware_Library": "https://github.com/ArteryTek/AT32F421_Firmware_Library.git",
-    "AT32F422_426_Firmware_Library": "https://github.com/ArteryTek/AT32F422_426_Firmware_Library.git",
-    "AT32F423_Firmware_Library": "https://github.com/ArteryTek/AT32F423_Firmware_Library.git",
-    "AT32F425_Firmware_Library": "https://github.com/ArteryTek/AT32F425_Firmware_Library.git",
-    "AT32F435_437_Firmware_Library": "https://github.com/ArteryTek/AT32F435_437_Firmware_Library.git",
-    "AT32F45x_Firmware_Library": "https://github.com/ArteryTek/AT32F45x_Firmware_Library.git",
-    "AT32F490_Firmware_Library": "https://github.com/ArteryTek/AT32F490_Firmware_Library.git",
-    "AT32L021_Firmware_Library": "https://github.com/ArteryTek/AT32L021_Firmware_Library.git",
-    "AT32M412_416_Firmware_Library": "https://github.com/ArteryTek/AT32M412_416_Firmware_Library.git",
-    "AT32WB415_Firmware_Library": "https://github.com/ArteryTek/AT32WB415_Firmware_Library.git",
-}
-
-# Gitee mirror URLs for the same repos — used as fallback when
-# GitHub is unreachable (common for users in China).
-PACKAGE_GIT_URLS_GITEE = {
-    k: v.replace("github.com/ArteryTek", "gitee.com/arterytek")
-    for k, v in PACKAGE_GIT_URLS.items()
-}
+middlewares = [
+    x.strip() for x in env.GetProjectOption("middlewares", "").split(",")
+    if x.strip()
+]
 
 package_name = BSP_PACKAGE_MAP.get(bsp)
 if not package_name:
@@ -157,6 +122,81 @@ def _preferred_mirror():
     return mirror
 
 
+# ``board_build.at32firmlib.fetch = sparse`` clones without blobs and only
+# checks out the directories the build reads (``libraries/`` and the
+# referenced middlewares) instead of the examples, documents and IDE
+# projects that make up most of each firmware library repo.
+fetch_mode = board.get("build.at32firmlib.fetch", "full")
+
+
+def _sparse_paths():
+    paths = ["libraries"]
+    for x in middlewares:
+        if x in ("usbd_drivers", "usbh_drivers"):
+            paths.extend(["middlewares/usb_drivers", "middlewares/usbd_drivers"])
+        else:
+            paths.append("middlewares/" + x)
+    return paths
+
+
+def _git_clone(git_url, pkg_dir):
+    if fetch_mode == "sparse":
+        try:
+            subprocess.check_call(
+                ["git", "clone", "--depth=1", "--filter=blob:none",
+                 "--sparse", git_url, pkg_dir],
+                stdout=sys.stdout, stderr=sys.stderr,
+            )
+            subprocess.check_call(
+                ["git", "-C", pkg_dir, "sparse-checkout", "set"] + _sparse_paths(),
+                stdout=sys.stdout, stderr=sys.stderr,
+            )
+            return
+        except subprocess.CalledProcessError:
+            # Old git or a server without partial clone support
+            sys.stderr.write(
+                "Warning! Sparse clone failed, falling back to a full clone.\n")
+            if isdir(pkg_dir):
+                shutil.rmtree(pkg_dir)
+    subprocess.check_call(
+        ["git", "clone", "--depth=1", git_url, pkg_dir],
+        stdout=sys.stdout, stderr=sys.stderr,
+    )
+
+
+def _widen_sparse_checkout(pkg_dir):
+    """Add newly referenced middlewares to an existing sparse checkout."""
+    sparse_file = join(pkg_dir, ".git", "info", "sparse-checkout")
+    if not isfile(sparse_file):
+        return
+    with open(sparse_file) as f:
+        listed = f.read()
+    missing = [p for p in _sparse_paths() if "/%s/" % p not in listed]
+    if not missing:
+        return
+    print("Adding %s to the sparse checkout of %s ..." % (
+        ", ".join(missing), os.path.basename(pkg_dir)))
+    try:
+        subprocess.check_call(
+            ["git", "-C", pkg_dir, "sparse-checkout", "add"] + missing,
+            stdout=sys.stdout, stderr=sys.stderr,
+        )
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write(
+            "Warning! Failed to widen the sparse checkout of %s: %s\n" % (
+                pkg_dir, e))
+
+
+# Local firmware store (bare git mirrors or tarballs, see at32tools/fwstore.py)
+# that is resolved before touching the network.  With ``offline`` the
+# network is never used.
+FIRMWARE_STORE = board.get(
+    "build.at32firmlib.store", os.environ.get("AT32_FIRMWARE_STORE", ""))
+FIRMWARE_OFFLINE = board.get(
+    "build.at32firmlib.offline",
+    "yes" if os.environ.get("AT32_OFFLINE") == "1" else "no") == "yes"
+
+
 def _ensure_framework_package(pkg_name):
     """
     Ensure the firmware library package is available locally.
@@ -172,16 +212,10 @@ def _ensure_framework_package(pkg_name):
     pkg_dir = join(pio_packages_dir, pkg_name)
 
     if isdir(pkg_dir) and isfile(join(pkg_dir, "package.json")):
+        _widen_sparse_checkout(pkg_dir)
         return pkg_dir
 
-    mirror = _preferred_mirror()
-    url_map = PACKAGE_GIT_URLS if mirror == "github" else PACKAGE_GIT_URLS_GITEE
-    git_url = url_map.get(pkg_name)
-    if not git_url:
-        sys.stderr.write(
-            "Error! No git URL configured for package '%s'.\n" % pkg_name
-        )
-        sys.exit(1)
+    store_entry = fwstore.store_entry(FIRMWARE_STORE, pkg_name)
 
     if isdir(pkg_dir):
         # Directory exists but package.json is missing —
@@ -199,13 +233,37 @@ def _ensure_framework_package(pkg_name):
             sys.stderr.write(
                 "Proceeding with existing local copy.\n"
             )
+        _widen_sparse_checkout(pkg_dir)
+    elif store_entry:
+        kind, path = store_entry
+        print("Fetching %s from local store %s ..." % (pkg_name, path))
+        try:
+            if kind == "git":
+                _git_clone(fwstore.mirror_url(path), pkg_dir)
+            else:
+                fwstore.extract_tarball(path, pkg_dir)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            sys.stderr.write(
+                "Error! Failed to fetch %s from %s: %s\n" % (pkg_name, path, e))
+            sys.exit(1)
+    elif FIRMWARE_OFFLINE:
+        sys.stderr.write(
+            "Error! %s is not in the local firmware store '%s' and network "
+            "access is disabled.\n" % (pkg_name, FIRMWARE_STORE))
+        sys.exit(1)
     else:
+        mirror = _preferred_mirror()
+        url_map = PACKAGE_GIT_URLS if mirror == "github" else PACKAGE_GIT_URLS_GITEE
+        git_url = url_map.get(pkg_name)
+        if not git_url:
+            sys.stderr.write(
+                "Error! No git URL configured for package '%s'.\n" % pkg_name
+            )
+            sys.exit(1)
+
         print("Fetching %s ..." % git_url)
         try:
-            subprocess.check_call(
-                ["git", "clone", "--depth=1", git_url, pkg_dir],
-                stdout=sys.stdout, stderr=sys.stderr,
-            )
+            _git_clone(git_url, pkg_dir)
         except subprocess.CalledProcessError:
             # If GitHub failed, flip the cache and try Gitee once
             if mirror == "github" and _MIRROR_CACHE_FILE:
@@ -214,10 +272,7 @@ def _ensure_framework_package(pkg_name):
             git_url = PACKAGE_GIT_URLS_GITEE.get(pkg_name)
             print("Retrying from Gitee mirror ...")
             try:
-                subprocess.check_call(
-                    ["git", "clone", "--depth=1", git_url, pkg_dir],
-                    stdout=sys.stdout, stderr=sys.stderr,
-                )
+                _git_clone(git_url, pkg_dir)
             except subprocess.CalledProcessError as e:
                 sys.stderr.write(
                     "Error! Failed to clone from both GitHub and Gitee: %s\n" % e
@@ -241,17 +296,74 @@ def _ensure_framework_package(pkg_name):
     return pkg_dir
 
 
-FRAMEWORK_DIR = _ensure_framework_package(package_name)
+#
+# Configure-time result cache
+#
+# The facts resolved below (framework dir and version, linker script,
+# include paths, USB middleware layout) only change when the board, the
+# middlewares, the fetch settings or the firmware library package change.
+# They are kept in a per-env stamp file and reused while its key matches
+# and the package's package.json (rewritten on every update) is unchanged.
+#
+
+CONFIGURE_STAMP = join(env.subst("$BUILD_DIR"), "at32_configure.json")
+configure_key = {
+    "platform": platform.version,
+    "bsp": bsp,
+    "product_line": product_line,
+    "cmsis_core_dir": cmsis_core_dir,
+    "middlewares": middlewares,
+    "fetch": fetch_mode,
+    "store": FIRMWARE_STORE,
+}
+
+
+def _load_configure_stamp():
+    try:
+        with open(CONFIGURE_STAMP) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if stamp.get("key") != configure_key:
+        return {}
+    pkg_json = join(stamp.get("framework_dir", ""), "package.json")
+    if not isfile(pkg_json) or os.path.getmtime(pkg_json) != stamp.get("package_mtime"):
+        return {}
+    if stamp.get("ldscript") and not isfile(stamp["ldscript"]):
+        return {}
+    return stamp
+
+
+def _save_configure_stamp(**facts):
+    stamp = dict(facts, key=configure_key)
+    stamp["package_mtime"] = os.path.getmtime(
+        join(stamp["framework_dir"], "package.json"))
+    if stamp == configure_stamp:
+        return
+    if not isdir(os.path.dirname(CONFIGURE_STAMP)):
+        os.makedirs(os.path.dirname(CONFIGURE_STAMP))
+    with open(CONFIGURE_STAMP, "w") as f:
+        json.dump(stamp, f, indent=2, sort_keys=True)
+
+
+configure_stamp = _load_configure_stamp()
+
+FRAMEWORK_DIR = configure_stamp.get("framework_dir") or \
+    _ensure_framework_package(package_name)
 FRAMEWORK_LIB_DIR = join(FRAMEWORK_DIR, "libraries")
-assert isdir(FRAMEWORK_LIB_DIR), (
-    "Cannot find 'libraries' directory in %s" % FRAMEWORK_DIR
-)
+if not configure_stamp:
+    assert isdir(FRAMEWORK_LIB_DIR), (
+        "Cannot find 'libraries' directory in %s" % FRAMEWORK_DIR
+    )
 
 FRAMEWORK_MIDDLEWARE_DIR = join(FRAMEWORK_DIR, "middlewares")
 env.Append(FMD=[FRAMEWORK_MIDDLEWARE_DIR])
 
 
 def get_linker_script():
+    if configure_stamp.get("ldscript"):
+        return configure_stamp["ldscript"]
+
     ldscript = join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "device_support", "startup", "gcc",
                     "linker", product_line + "_FLASH.ld")
 
@@ -261,13 +373,15 @@ def get_linker_script():
     sys.stderr.write("Warning! Cannot find a linker script for the required board! "+ldscript)
 
 
+FRAMEWORK_CPPPATH = configure_stamp.get("cpppath") or [
+    join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "core_support"),
+    join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "device_support"),
+    join(FRAMEWORK_LIB_DIR, "drivers", "inc"),
+    join(FRAMEWORK_LIB_DIR, "drivers", "src")
+]
+
 env.Append(
-    CPPPATH=[
-        join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "core_support"),
-        join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "device_support"),
-        join(FRAMEWORK_LIB_DIR, "drivers", "inc"),
-        join(FRAMEWORK_LIB_DIR, "drivers", "src")
-    ]
+    CPPPATH=FRAMEWORK_CPPPATH
 )
 
 env.Append(
@@ -282,8 +396,423 @@ env.Append(
     ]
 )
 
+ldscript = configure_stamp.get("ldscript") or get_linker_script()
 if not board.get("build.ldscript", ""):
-    env.Replace(LDSCRIPT_PATH=get_linker_script())
+    env.Replace(LDSCRIPT_PATH=ldscript)
+
+#
+# Hot code placement
+#
+# ``board_build.hot_code`` lists the functions, objects and sections that
+# must run at full speed.  They are placed in front of ``.text`` by a linker
+# script derived from the selected one: in the zero-wait flash right after
+# the vector table (``board_build.hot_code_region = zw``) or in SRAM, copied
+# there at start-up (``sram``).  Functions marked ``__hot`` go to the same
+# place.  ``board_build.sram_size`` resizes the RAM region to the SRAM/ZW
+# split programmed in the EOPB0 option byte (see at32tools/hotcode.py).
+#
+
+hot_code_spec = board.get("build.hot_code", "")
+hot_code_region = board.get("build.hot_code_region", "")
+if hot_code_spec and not hot_code_region:
+    hot_code_region = "zw"
+sram_size = board.get("build.sram_size", "")
+
+if hot_code_region or sram_size:
+    source_ldscript = env.subst("$LDSCRIPT_PATH")
+    if not isfile(source_ldscript):
+        source_ldscript = join(env.subst("$PROJECT_DIR"), source_ldscript)
+    try:
+        with open(source_ldscript) as f:
+            ldscript_text = f.read()
+        sram_bytes = parse_number(str(sram_size)) if sram_size else None
+        max_ram = int(board.get("upload.maximum_ram_size", 0))
+        if sram_bytes and max_ram and sram_bytes > max_ram:
+            raise hotcode.HotCodeError("board_build.sram_size %d is larger than "
+                                       "the %d bytes of SRAM" % (sram_bytes, max_ram))
+        hot_ldscript_text = hotcode.generate(
+            ldscript_text, hotcode.parse_patterns(hot_code_spec),
+            hot_code_region or None, sram_bytes, os.path.basename(source_ldscript))
+        if board.get("build.zw_size", ""):
+            zw_size = parse_number(str(board.get("build.zw_size")))
+        else:
+            ram = hotcode.ram_region(hot_ldscript_text)
+            zw_size = hotcode.zw_size(bsp, ram.length) if ram else None
+    except (OSError, ValueError, hotcode.HotCodeError) as e:
+        sys.stderr.write("Error! Hot code placement: %s\n" % e)
+        sys.exit(1)
+
+    hot_code_dir = join(env.subst("$BUILD_DIR"), "hot_code")
+    hot_ldscript = join(hot_code_dir, "at32_hot.ld")
+    hotcode.write_if_changed(hot_ldscript, hot_ldscript_text)
+    env.Replace(LDSCRIPT_PATH=hot_ldscript)
+    # INCLUDE statements of the original script
+    env.Append(LIBPATH=[os.path.dirname(os.path.abspath(source_ldscript))])
+
+    if hot_code_region:
+        hot_header = join(hot_code_dir, "at32_hot.h")
+        hotcode.write_if_changed(hot_header, hotcode.header_text(hot_code_region))
+        env.Append(CCFLAGS=["-include", hot_header])
+        if hot_code_region == "sram":
+            hotcode.write_if_changed(
+                join(hot_code_dir, "at32_ramfunc.c"), hotcode.RAMFUNC_SOURCE)
+            env.BuildSources(join("$BUILD_DIR", "hot_code_obj"), hot_code_dir,
+                             src_filter="+<at32_ramfunc.c>")
+        env.Replace(
+            HOT_CODE_REGION=hot_code_region,
+            HOT_CODE_ZW_END=hotcode.FLASH_BASE + zw_size
+            if zw_size and hot_code_region == "zw" else None)
+
+#
+# Prebuilt library cache
+#
+# The cmsis/driver/middleware archives only depend on the firmware library
+# sources, the compiler and the flags, so identical archives are rebuilt in
+# every env of every project.  With ``board_build.at32firmlib.lib_cache = yes``
+# finished archives are stored next to the cloned firmware library package,
+# keyed by everything that can change their content, and linked directly on
+# the next build that asks for the same key.
+#
+
+LIB_CACHE_DIR = join(os.path.dirname(FRAMEWORK_DIR), ".at32_libcache", package_name)
+lib_cache_enabled = board.get("build.at32firmlib.lib_cache", "no") == "yes"
+if lib_cache_enabled and board.get("build.stack_usage", "no") == "yes":
+    # Cached archives come without the .su files the stack report reads
+    print("Library cache: disabled while board_build.stack_usage = yes")
+    lib_cache_enabled = False
+lib_cache_stats = {"hit": [], "miss": []}
+if lib_cache_enabled:
+    env.Replace(AT32_LIB_CACHE_DIR=LIB_CACHE_DIR)
+_headers_hash = []
+
+
+def _fw_version():
+    if configure_stamp.get("version"):
+        return configure_stamp["version"]
+    try:
+        with open(join(FRAMEWORK_DIR, "package.json")) as f:
+            return json.load(f).get("version", "0.0.0")
+    except (OSError, ValueError):
+        return "0.0.0"
+
+
+def _project_headers_hash():
+    """Hash every header of the project (``*_conf.h``, ``FreeRTOSConfig.h``,
+    ``usb_conf.h``, ...), since the library sources include them."""
+    if _headers_hash:
+        return _headers_hash[0]
+    digest = hashlib.sha1()
+    for top in ("$PROJECT_INCLUDE_DIR", "$PROJECT_SRC_DIR", "$PROJECT_LIB_DIR"):
+        top = env.subst(top)
+        if not isdir(top):
+            continue
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith(".h"):
+                    continue
+                path = join(root, name)
+                digest.update(os.path.relpath(path, top).encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    _headers_hash.append(digest.hexdigest())
+    return _headers_hash[0]
+
+
+def _cache_flags():
+    """Compile flags for the cache key. Force-included headers count by
+    their content: hot code placement's ``at32_hot.h`` lives in each
+    project's build dir, so its path would make every project miss."""
+    flags = env.subst("$CC $CCFLAGS $CFLAGS $ASFLAGS $_CPPDEFFLAGS")
+    items = [env.subst(str(item)) for item in env.get("CCFLAGS", []) + env.get("CFLAGS", [])]
+    for option, header in zip(items, items[1:]):
+        if option != "-include" or not isfile(header):
+            continue
+        with open(header, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        flags = flags.replace(header, "<%s:%s>" % (os.path.basename(header), digest))
+    return flags
+
+
+def _lib_cache_key(name, src_dir, src_filter):
+    key = {
+        "bsp": bsp,
+        "fw_version": _fw_version(),
+        "toolchain": platform.get_package_version("toolchain-gccarmnoneeabi"),
+        "library": name,
+        "src_dir": os.path.relpath(src_dir, FRAMEWORK_DIR),
+        "src_filter": src_filter,
+        "unity": unity_chunks if unity_enabled else 0,
+        "pch": pch_mode != "no",
+        "flags": _cache_flags(),
+        "headers": _project_headers_hash(),
+    }
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+#
+# Unity (jumbo) builds
+#
+# With ``board_build.at32firmlib.unity = yes`` the C sources of each library
+# are compiled through a few generated translation units that ``#include``
+# the original files, so the device header is parsed once per unit instead
+# of once per source.  Sources whose file-scope names (static functions and
+# variables, typedefs, macros) would clash are put into separate units;
+# a source that clashes with every unit gets its own, i.e. the per-file
+# build.  Assembly sources are always built as usual.
+#
+
+unity_enabled = board.get("build.at32firmlib.unity", "no") == "yes"
+unity_chunks = int(board.get("build.at32firmlib.unity_chunks", 1))
+
+
+def collect_fw_sources(src_dir, src_filter):
+    """Resolve a ``+<glob>``/``-<glob>`` filter to paths relative to src_dir."""
+    sources = []
+    for item in src_filter:
+        sign, pattern = item[0], item[2:-1]
+        matches = []
+        for path in glob.glob(join(src_dir, pattern), recursive=True):
+            if isdir(path):
+                matches.extend(
+                    join(root, f) for root, _, files in os.walk(path)
+                    for f in files)
+            else:
+                matches.append(path)
+        matches = sorted(os.path.relpath(p, src_dir) for p in matches)
+        if sign == "+":
+            sources.extend(p for p in matches if p not in sources)
+        else:
+            sources = [p for p in sources if p not in matches]
+    return sources
+
+
+def _file_scope_names(path):
+    with open(path, errors="replace") as f:
+        code = re.sub(r"/\*.*?\*/", "", f.read(), flags=re.S)
+    code = re.sub(r"//[^\n]*", "", code)
+    names = set(re.findall(
+        r"^static\b[^;{(=]*?\b([A-Za-z_]\w*)\s*[(\[=;,]", code, flags=re.M))
+    names.update(re.findall(r"^typedef\b[^;]*?\b(\w+)\s*;", code, flags=re.M))
+    names.update(
+        m for m in re.findall(r"^\s*#\s*define\s+(\w+)", code, flags=re.M)
+        if not re.search(r"^\s*#\s*undef\s+%s\b" % m, code, flags=re.M))
+    return names
+
+
+def _unity_units(src_dir, sources):
+    units = [[] for _ in range(max(1, min(unity_chunks, len(sources))))]
+    unit_names = [set() for _ in units]
+    isolated = 0
+    for i, src in enumerate(sources):
+        names = _file_scope_names(join(src_dir, src))
+        for j in [(i + k) % len(units) for k in range(len(units))]:
+            if not names & unit_names[j]:
+                break
+        else:
+            isolated += 1
+            units.append([])
+            unit_names.append(set())
+            j = len(units) - 1
+        units[j].append(src)
+        unit_names[j].update(names)
+    return [u for u in units if u], isolated
+
+
+def _build_unity_library(variant_dir, src_dir, src_filter):
+    name = os.path.basename(variant_dir)
+    sources = [s for s in collect_fw_sources(src_dir, src_filter)
+               if s.endswith(".c")]
+    if len(sources) < 2:
+        return env.BuildLibrary(variant_dir, src_dir, src_filter=src_filter)
+
+    units, isolated = _unity_units(src_dir, sources)
+    # Kept outside variant_dir, which SCons maps back onto src_dir
+    unity_dir = env.subst(join("$BUILD_DIR", "unity", name))
+    if not isdir(unity_dir):
+        os.makedirs(unity_dir)
+    nodes = []
+    for i, unit in enumerate(units):
+        unit_path = join(unity_dir, "unity_%d.c" % i)
+        content = "/* Generated by at32firmlib unity build - do not edit */\n" + "".join(
+            '#include "%s"\n' % join(src_dir, src).replace("\\", "/")
+            for src in unit)
+        if not isfile(unit_path) or open(unit_path).read() != content:
+            with open(unit_path, "w") as f:
+                f.write(content)
+        if pch_mode != "no":
+            nodes.append(_pch_object(env, env.File(unit_path)))
+        else:
+            nodes.append(env.Object(unit_path))
+        env.Depends(nodes[-1], [join(src_dir, src) for src in unit])
+
+    print("Unity build: %s %d sources -> %d unit(s)%s" % (
+        name, len(sources), len(units),
+        ", %d isolated on name clashes" % isolated if isolated else ""))
+    nodes.extend(env.CollectBuildFiles(
+        variant_dir, src_dir,
+        src_filter + ["-<%s>" % src for src in sources]))
+    return env.BuildLibrary(variant_dir, src_dir, nodes=nodes)
+
+
+def _build_library(variant_dir, src_dir, src_filter):
+    if unity_enabled:
+        return _build_unity_library(variant_dir, src_dir, src_filter)
+    return env.BuildLibrary(variant_dir, src_dir, src_filter=src_filter)
+
+
+def _store_in_lib_cache(cache_path):
+    def _store(target, source, env):
+        if not isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        shutil.copyfile(target[0].get_abspath(), tmp_path)
+        os.replace(tmp_path, cache_path)
+    return _store
+
+
+def build_fw_library(variant_dir, src_dir, src_filter):
+    """Build one firmware library archive, or reuse it from the cache."""
+    if not lib_cache_enabled:
+        return _build_library(variant_dir, src_dir, src_filter)
+
+    name = os.path.basename(variant_dir)
+    key = _lib_cache_key(name, src_dir, src_filter)
+    # Mirrors the archive's place in the build dir (``middleware/libx.a``),
+    # which the memory report uses to attribute it
+    rel_dir = os.path.relpath(os.path.dirname(env.subst(variant_dir)),
+                              env.subst("$BUILD_DIR"))
+    cache_path = os.path.normpath(
+        join(LIB_CACHE_DIR, key[:2], key, rel_dir, "lib%s.a" % name))
+    if isfile(cache_path):
+        print("Library cache: hit  %s (%s)" % (name, key[:12]))
+        lib_cache_stats["hit"].append(name)
+        return env.File(cache_path)
+
+    print("Library cache: miss %s (%s)" % (name, key[:12]))
+    lib_cache_stats["miss"].append(name)
+    lib = _build_library(variant_dir, src_dir, src_filter)
+    # With ``lib_archive = no`` PlatformIO returns plain objects - nothing to cache
+    node = lib[0] if isinstance(lib, list) else lib
+    if str(node).endswith(env.subst("$LIBSUFFIX")):
+        env.AddPostAction(node, env.VerboseAction(
+            _store_in_lib_cache(cache_path), "Caching lib%s.a" % name))
+    return lib
+
+
+#
+# Peripheral driver selection
+#
+# Every driver source is wrapped in ``#ifdef <PPP>_MODULE_ENABLED``, and the
+# project's ``<bsp>_conf.h`` decides which modules are on.  With
+# ``board_build.at32firmlib.driver_selection = auto`` the drivers whose
+# switch is present but not defined in that header are not compiled at all.
+#
+
+def find_conf_header():
+    name = bsp.lower() + "_conf.h"
+    for top in ("$PROJECT_INCLUDE_DIR", "$PROJECT_SRC_DIR"):
+        for root, dirs, files in os.walk(env.subst(top)):
+            dirs.sort()
+            if name in files:
+                return join(root, name)
+    return None
+
+
+def _driver_src_excludes():
+    if board.get("build.at32firmlib.driver_selection", "all") != "auto":
+        return []
+
+    conf_header = find_conf_header()
+    if not conf_header:
+        sys.stderr.write(
+            "Warning! Driver selection needs %s_conf.h in the project, "
+            "building all drivers.\n" % bsp.lower())
+        return []
+
+    with open(conf_header) as f:
+        conf = re.sub(r"/\*.*?\*/", "", f.read(), flags=re.S)
+    conf = re.sub(r"//[^\n]*", "", conf)
+    with open(conf_header) as f:
+        mentioned = set(re.findall(r"\b(\w+)_MODULE_ENABLED\b", f.read()))
+    enabled = set(re.findall(
+        r"^\s*#\s*define\s+(\w+)_MODULE_ENABLED\b", conf, flags=re.M))
+
+    prefix = bsp.lower() + "_"
+    drivers_dir = join(FRAMEWORK_LIB_DIR, "drivers", "src")
+    drivers = sorted(
+        f for f in os.listdir(drivers_dir)
+        if f.startswith(prefix) and f.endswith(".c"))
+    pruned = [
+        f for f in drivers
+        if f[len(prefix):-2].upper() in mentioned - enabled
+    ]
+    print("Driver selection: building %d of %d drivers%s" % (
+        len(drivers) - len(pruned), len(drivers),
+        " (pruned %s)" % ", ".join(f[len(prefix):-2] for f in pruned)
+        if pruned else ""))
+    return ["-<%s>" % f for f in pruned]
+
+
+#
+# Precompiled device header
+#
+# Every source includes the series device header, which pulls in the CMSIS
+# core headers and the project's conf header.  With
+# ``board_build.at32firmlib.pch = libs`` (or ``all`` to include the project
+# sources) that header is compiled once per env into a ``.gch`` and
+# force-included with ``-include``.  The ``.gch`` is rebuilt when the
+# compile command changes or any header it includes changes; GCC silently
+# falls back to the plain header when the ``.gch`` does not match the
+# flags of a translation unit (reported with ``-Winvalid-pch``).
+#
+
+pch_mode = board.get("build.at32firmlib.pch", "no")
+if pch_mode not in ("no", "libs", "all"):
+    sys.stderr.write(
+        "Error! Unknown pch mode '%s' (expected no, libs or all).\n" % pch_mode)
+    sys.exit(1)
+
+if pch_mode != "no":
+    pch_header = join(env.subst("$BUILD_DIR"), "pch", "at32_device.h")
+    pch_content = '#include "%s.h"\n' % bsp.lower()
+    if not isfile(pch_header) or open(pch_header).read() != pch_content:
+        if not isdir(os.path.dirname(pch_header)):
+            os.makedirs(os.path.dirname(pch_header))
+        with open(pch_header, "w") as f:
+            f.write(pch_content)
+
+    pch_gch = env.Command(
+        pch_header + ".gch", pch_header,
+        env.VerboseAction(
+            "$CC -x c-header -o $TARGET $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+            "Precompiling $SOURCE"),
+        source_scanner=CScanner)
+    conf_header = find_conf_header()
+    if conf_header:
+        env.Depends(pch_gch, conf_header)
+    pch_flags = ["-include", pch_header, "-Winvalid-pch", "-fpch-preprocess"]
+
+
+def _pch_object(env, node):
+    obj = env.Object(node, CFLAGS=env.get("CFLAGS", []) + pch_flags)
+    env.Depends(obj, pch_gch)
+    return obj
+
+
+def _pch_middleware(env, node):
+    if not node.name.endswith(".c"):
+        return node
+    if pch_mode == "libs" and not node.srcnode().get_abspath().startswith(
+            FRAMEWORK_DIR):
+        return node
+    return _pch_object(env, node)
+
+
+if pch_mode != "no":
+    env.AddBuildMiddleware(_pch_middleware)
+
 
 #
 # Target: Build Firmware Library
@@ -294,7 +823,7 @@ extra_flags = board.get("build.extra_flags", "")
 libs = []
 
 if board.get("build.at32firmlib.custom_system_setup", "no") == "no":
-    libs.append(env.BuildLibrary(
+    libs.append(build_fw_library(
         join("$BUILD_DIR", "cmsis"),
         join(FRAMEWORK_LIB_DIR, "cmsis", cmsis_core_dir, "device_support"),
         src_filter=[
@@ -303,16 +832,15 @@ if board.get("build.at32firmlib.custom_system_setup", "no") == "no":
         ]
     ))
 
-libs.append(env.BuildLibrary(
+libs.append(build_fw_library(
     join("$BUILD_DIR", "driver"),
     join(FRAMEWORK_LIB_DIR, "drivers", "src"),
-    src_filter=["+<*.c>"]
+    src_filter=["+<*.c>"] + _driver_src_excludes()
 ))
 
-middlewares = env.GetProjectOption("middlewares","")
-if(middlewares):
-    for x in middlewares.split(","):
-        x = x.strip()
+usb_layout = configure_stamp.get("usb_layout")
+if middlewares:
+    for x in middlewares:
         print("Middleware %s referenced." % x)
         if x == "i2c_application_library":
             env.Append(
@@ -320,17 +848,18 @@ if(middlewares):
                     join(FRAMEWORK_MIDDLEWARE_DIR, x.strip())
                 ]
             )
-            libs.append(env.BuildLibrary(
+            libs.append(build_fw_library(
                 join("$BUILD_DIR", "middleware", x.strip()),
                 join(FRAMEWORK_MIDDLEWARE_DIR, x.strip()),
                 src_filter=["+<*.c>"]
             ))
         elif x == "freertos":
-            # Determine FreeRTOS portable dir based on CPU type and FPU
-            fpu = board.get("build.fpu", "No")
+            # Determine FreeRTOS portable dir based on CPU type and the
+            # float ABI resolved in _bare.py (the CM4F port saves FPU
+            # context, so it is only usable when FPU code is generated)
             if cpu_type == "cortex-m0+":
                 freertos_port_dir = "ARM_CM0"
-            elif cpu_type == "cortex-m4" and fpu == "Yes":
+            elif cpu_type == "cortex-m4" and env["FLOAT_ABI"] != "soft":
                 freertos_port_dir = "ARM_CM4F"
             else:
                 freertos_port_dir = "ARM_CM3"
@@ -357,7 +886,7 @@ if(middlewares):
             else:
                 print("FreeRTOS heap: skipped (user-provided)\r\n")
 
-            libs.append(env.BuildLibrary(
+            libs.append(build_fw_library(
                 join("$BUILD_DIR", "middleware", x.strip()),
                 join(FRAMEWORK_MIDDLEWARE_DIR, x.strip(), "source"),
                 src_filter=src_filter
@@ -370,23 +899,26 @@ if(middlewares):
             # Detect USB driver directory structure at build time
             usb_driver_dir = join(FRAMEWORK_MIDDLEWARE_DIR, "usb_drivers")
             usbd_driver_dir = join(FRAMEWORK_MIDDLEWARE_DIR, "usbd_drivers")
+            if usb_layout is None:
+                usb_layout = ("usb_drivers" if isdir(usb_driver_dir) else
+                              "usbd_drivers" if isdir(usbd_driver_dir) else "")
 
-            if isdir(usb_driver_dir):
+            if usb_layout == "usb_drivers":
                 src_filter = ["+<usb_core.c>"]
                 src_filter.append("+<usbd_*.c>" if not is_host else "+<usbh_*.c>")
                 env.Append(
                     CPPPATH=[join(usb_driver_dir, "inc")]
                 )
-                libs.append(env.BuildLibrary(
+                libs.append(build_fw_library(
                     join("$BUILD_DIR", "middleware", "usb_drivers"),
                     join(usb_driver_dir, "src"),
                     src_filter=src_filter
                 ))
-            elif isdir(usbd_driver_dir) and not is_host:
+            elif usb_layout == "usbd_drivers" and not is_host:
                 env.Append(
                     CPPPATH=[join(usbd_driver_dir, "inc")]
                 )
-                libs.append(env.BuildLibrary(
+                libs.append(build_fw_library(
                     join("$BUILD_DIR", "middleware", "usbd_drivers"),
                     join(usbd_driver_dir, "src"),
                     src_filter=["+<*.c>"]
@@ -398,4 +930,24 @@ if(middlewares):
         else:
             sys.stderr.write("Middleware %s not supported.\r\n" % x)
 
+if lib_cache_enabled:
+    print("Library cache: %d hit(s), %d miss(es)%s" % (
+        len(lib_cache_stats["hit"]), len(lib_cache_stats["miss"]),
+        " - rebuilding %s" % ", ".join(lib_cache_stats["miss"])
+        if lib_cache_stats["miss"] else ""))
+
 env.Append(LIBS=libs)
+
+mirror = configure_stamp.get("mirror")
+if _MIRROR_CACHE_FILE and isfile(_MIRROR_CACHE_FILE):
+    with open(_MIRROR_CACHE_FILE) as f:
+        mirror = f.read().strip()
+
+_save_configure_stamp(
+    framework_dir=FRAMEWORK_DIR,
+    version=_fw_version(),
+    ldscript=ldscript,
+    cpppath=FRAMEWORK_CPPPATH,
+    usb_layout=usb_layout,
+    mirror=mirror,
+)
@@ -1,7 +1,11 @@
+import atexit
+import json
+import os
 import sys
+import time
 from platform import system
 from os import makedirs
-from os.path import basename, isdir, join
+from os.path import basename, isdir, isfile, join
 from platformio.util import get_systype
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
@@ -11,6 +15,13 @@ env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
+sys.path.insert(0, join(platform.get_dir(), "builder"))
+from at32tools import (artifacts, deltaflash, dfu, fwstore, hotcode, ldscript,  # noqa: E402
+                       mapfile, multiflash, objcache, ocdserver, segments,
+                       stackusage)
+from at32tools.buildtrace import BuildTrace  # noqa: E402
+from at32tools.elf import ElfError, ElfFile, MemoryRegion  # noqa: E402
+
 env.Replace(
     AR="arm-none-eabi-gcc-ar",
     AS="arm-none-eabi-as",
@@ -25,11 +36,6 @@ env.Replace(
 
     ARFLAGS=["rc"],
 
-    SIZEPROGREGEXP=r"^(?:\.isr_vector|\.text|\.data|\.rodata|\.text.align|\.init_array|\.fini_array|\.ARM.exidx)\s+(\d+).*",
-    SIZEDATAREGEXP=r"^(?:\.data|\.bss|\.noinit)\s+(\d+).*",
-    SIZECHECKCMD="$SIZETOOL -A -d $SOURCES",
-    SIZEPRINTCMD='$SIZETOOL -B -d $SOURCES',
-
     PROGSUFFIX=".elf"
 )
 
@@ -37,44 +43,219 @@ env.Replace(
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
+#
+# Build trace: time every spawned command (compile, archive, link) and
+# every post-link action, and write a Chrome trace plus a summary at the end
+#
+
+build_trace = None
+if board.get("build.trace", "no") in ("yes", "time-report"):
+    build_trace = BuildTrace(
+        env.subst("$BUILD_DIR"),
+        time_report=board.get("build.trace") == "time-report")
+    env["SPAWN"] = build_trace.wrap_spawn(env["SPAWN"])
+    if build_trace.time_report:
+        env.Append(CCFLAGS=["-ftime-report"])
+
+    def _write_build_trace():
+        print(build_trace.write(int(board.get("build.trace_top", 10))), end="")
+        print("Build trace written to %s" % join(
+            build_trace.build_dir, "build_trace.json"))
+
+    atexit.register(_write_build_trace)
+
+
+def _traced(func, name):
+    """``func`` as a build action, timed in the build trace when it is on."""
+    return build_trace.wrap_action(func, name) if build_trace else func
+
+
+def _build_artifacts(target, source, env):
+    # bin, hex, asm, symbols, size and map artifacts come from one read of
+    # the ELF and are skipped when its content hash did not change (see
+    # at32tools/artifacts.py)
+    build_dir = env.subst("$BUILD_DIR")
+    progname = env.subst("$PROGNAME")
+    kinds = []
+    for node in target:
+        kind = artifacts.kind_of(node.get_abspath(), build_dir, progname)
+        if kind and kind not in kinds:
+            kinds.append(kind)
+    regions, limits, _, _ = _memory_regions(env)
+    try:
+        results = artifacts.generate(
+            source[0].get_abspath(), build_dir, progname, kinds,
+            jobs=int(board.get("build.artifacts_jobs", 0)) or None,
+            regions=regions, limits=limits,
+            objdump=env.subst("$OBJDUMP"), tool_env=env["ENV"],
+            lib_cache_dir=env.get("AT32_LIB_CACHE_DIR"))
+    except artifacts.ArtifactError as e:
+        sys.stderr.write("Error! %s\n" % e)
+        env.Exit(1)
+    for message in results.values():
+        if message:
+            print(message)
+
+
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(
+                _traced(_build_artifacts, "bin"), "Building $TARGET"),
             suffix=".bin"
         ),
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(
+                _traced(_build_artifacts, "hex"), "Building $TARGET"),
             suffix=".hex"
         ),
         ElfToAsm=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJDUMP",
-                "-d",
-                "-S",
-                "$SOURCES",
-                ">",
-                "$TARGET"
-            ]), "Disassmbling to $TARGET"),
+            action=env.VerboseAction(
+                _traced(_build_artifacts, "asm"), "Disassmbling to $TARGET"),
             suffix=".asm"
         )
     )
 )
 
+#
+# Memory usage and symbols are read from the ELF in-process (see
+# at32tools/elf.py) instead of running $SIZETOOL and $NMTOOL
+#
+
+FLASH_ORIGIN = 0x08000000
+RAM_ORIGIN = 0x20000000
+
+
+def _memory_regions(env):
+    """Memory regions of the linker script; the first region containing the
+    flash/RAM start is limited by the board's maximum sizes."""
+    path = env.subst("$LDSCRIPT_PATH")
+    if path and not os.path.isabs(path):
+        path = join(env.subst("$PROJECT_DIR"), path)
+    regions = []
+    if path and isfile(path):
+        regions = ldscript.memory_regions(path)
+    flash_max = int(board.get("upload.maximum_size", 0))
+    ram_max = int(board.get("upload.maximum_ram_size", 0))
+    if not regions:
+        regions = [MemoryRegion("FLASH", FLASH_ORIGIN, flash_max),
+                   MemoryRegion("RAM", RAM_ORIGIN, ram_max)]
+
+    flash = ram = None
+    limits = {}
+    for region in regions:
+        limits[region.name] = region.length
+        if flash is None and region.origin <= FLASH_ORIGIN < region.origin + region.length:
+            flash = region.name
+            limits[flash] = flash_max or region.length
+        elif ram is None and region.origin <= RAM_ORIGIN < region.origin + region.length:
+            ram = region.name
+            limits[ram] = ram_max or region.length
+    return regions, limits, flash, ram
+
+
+def _format_usage(used, total):
+    percent = float(used) / total if total else 0
+    blocks = min(int(round(10 * percent)), 10)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * blocks, 10, percent, used, total)
+
+
+def _check_upload_size(target, source, env):
+    regions, limits, flash, ram = _memory_regions(env)
+    with ElfFile(source[0].get_abspath()) as elf:
+        usage = elf.region_usage(regions)
+
+    if ram:
+        print("RAM:   %s" % _format_usage(usage[ram], limits[ram]))
+    if flash:
+        print("Flash: %s" % _format_usage(usage[flash], limits[flash]))
+    for region in regions:
+        if region.name not in (flash, ram) and usage[region.name]:
+            print("%-6s %s" % (region.name + ":", _format_usage(
+                usage[region.name], limits[region.name])))
+    if usage.get("?"):
+        sys.stderr.write("Warning! %d bytes are outside every memory region "
+                         "of the linker script\n" % usage["?"])
+
+    if ram and usage[ram] > limits[ram]:
+        sys.stderr.write(
+            "Warning! The data size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (usage[ram], limits[ram]))
+    for region in regions:
+        if region.name != ram and usage[region.name] > limits[region.name]:
+            sys.stderr.write(
+                "Error: The %s size (%d bytes) is greater than maximum "
+                "allowed (%s bytes)\n" % (
+                    "program" if region.name == flash else region.name,
+                    usage[region.name], limits[region.name]))
+            env.Exit(1)
+
+
+def _print_size(target, source, env):
+    with open(source[0].get_abspath()) as f:
+        print(f.read(), end="")
+
+
+_traced_check_upload_size = _traced(_check_upload_size, "size check")
+
+
+def CheckUploadSize(_, target, source, env):
+    return _traced_check_upload_size(target, source, env)
+
+
+env.AddMethod(CheckUploadSize)
+
+#
+# Compiler cache: prefix the compile commands with a launcher that keeps
+# objects in a local directory-backed cache (see at32tools/objcache.py)
+#
+
+if board.get("build.compiler_cache", "no") == "yes":
+    objcache_dir = board.get(
+        "build.compiler_cache_dir",
+        join(env.subst("$PROJECT_CORE_DIR"), ".cache", "at32-objcache"))
+    objcache_max_size = objcache.parse_size(
+        board.get("build.compiler_cache_size", "2G"))
+    objcache_log = join(env.subst("$BUILD_DIR"), "objcache.log")
+    if not isdir(env.subst("$BUILD_DIR")):
+        makedirs(env.subst("$BUILD_DIR"))
+    if isfile(objcache_log):
+        os.remove(objcache_log)
+
+    launcher = '"$PYTHONEXE" "%s" --dir "%s" --log "%s" --' % (
+        objcache.__file__, objcache_dir, objcache_log)
+    for com in ("CCCOM", "CXXCOM", "ASPPCOM"):
+        env[com] = "%s %s" % (launcher, env[com])
+
+    def _report_objcache():
+        stats = objcache.read_stats(objcache_log)
+        cacheable = stats["hit"] + stats["miss"]
+        if not cacheable and not stats["skip"]:
+            return
+        total, evicted = objcache.trim(objcache_dir, objcache_max_size)
+        print("Compiler cache: %d hit(s), %d miss(es), %d uncacheable, "
+              "hit rate %d%%, %.1f MiB in %s%s" % (
+                  stats["hit"], stats["miss"], stats["skip"],
+                  100 * stats["hit"] // cacheable if cacheable else 0,
+                  total / 1048576.0, objcache_dir,
+                  ", evicted %d" % evicted if evicted else ""))
+
+    atexit.register(_report_objcache)
+
+#
+# Stack usage: per-function frame sizes (and the call graph with GCC 10+)
+# for the worst-case stack report, see at32tools/stackusage.py
+#
+
+stack_usage_enabled = board.get("build.stack_usage", "no") == "yes"
+if stack_usage_enabled:
+    env.Append(CCFLAGS=["-fstack-usage"])
+    toolchain_version = platform.get_package_version("toolchain-gccarmnoneeabi") or ""
+    gcc_version = toolchain_version.split(".")[1] if "." in toolchain_version else ""
+    if gcc_version[:-4].isdigit() and int(gcc_version[:-4]) >= 10:
+        env.Append(CCFLAGS=["-fcallgraph-info=su"])
+
 if not env.get("PIOFRAMEWORK"):
     env.SConscript("frameworks/_bare.py")
 
@@ -90,9 +271,96 @@ if "nobuild" in COMMAND_LINE_TARGETS:
     target_asm = join("$BUILD_DIR", "${PROGNAME}.asm")
 else:
     target_elf = env.BuildProgram()
-    target_firm = env.ElfToBin(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
-    target_hex = env.ElfToHex(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
-    target_asm = env.ElfToAsm(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
+    if board.get("build.compiler_cache", "no") == "yes":
+        uncacheable = objcache.uncacheable_flags(
+            env.get("CCFLAGS", []) + env.get("CFLAGS", []) + env.get("CXXFLAGS", []))
+        if uncacheable:
+            sys.stderr.write(
+                "Warning! %s make every compile uncacheable, the compiler "
+                "cache will not store anything\n" % ", ".join(uncacheable))
+
+#
+# Post-link artifacts: the kinds in board_build.artifacts are generated
+# together, in parallel, and make up the default target; the others are
+# built on request (buildhex, disassembling, ...)
+#
+
+default_artifacts = []
+for kind in board.get("build.artifacts", "bin, hex, symbols, size").split(","):
+    if kind.strip() and kind.strip() not in default_artifacts:
+        default_artifacts.append(kind.strip())
+if set(default_artifacts) - set(artifacts.KINDS):
+    sys.stderr.write("Error! Unknown board_build.artifacts: %s (known: %s)\n" % (
+        ", ".join(sorted(set(default_artifacts) - set(artifacts.KINDS))),
+        ", ".join(artifacts.KINDS)))
+    env.Exit(1)
+
+artifact_nodes = {}
+artifact_groups = [default_artifacts] if default_artifacts else []
+artifact_groups += [[kind] for kind in artifacts.KINDS if kind not in default_artifacts]
+for kinds in artifact_groups:
+    files = [
+        path for kind in kinds for path in artifacts.outputs(
+            kind, "$BUILD_DIR", "${PROGNAME}")
+    ]
+    if "nobuild" in COMMAND_LINE_TARGETS:
+        nodes = [env.File(path) for path in files]
+    else:
+        nodes = env.Command(files, target_elf, env.VerboseAction(
+            _traced(_build_artifacts, ", ".join(kinds)),
+            "Generating %s" % ", ".join(kinds)))
+    for kind in kinds:
+        artifact_nodes[kind] = [
+            node for node, path in zip(nodes, files)
+            if path in artifacts.outputs(kind, "$BUILD_DIR", "${PROGNAME}")
+        ]
+
+if "nobuild" not in COMMAND_LINE_TARGETS:
+    target_firm = artifact_nodes["bin"][0]
+    target_hex = artifact_nodes["hex"][0]
+    target_asm = artifact_nodes["asm"][0]
+
+#
+# Build profile report: link time and image size of this link, compared
+# with the last link made with each other profile
+#
+
+_link_started = []
+
+
+def _start_link_timer(target, source, env):
+    _link_started.append(time.time())
+
+
+def _report_profile(target, source, env):
+    profile = env.get("BUILD_PROFILE", "default")
+    link_time = time.time() - (_link_started or [time.time()])[-1]
+    with ElfFile(target[0].get_abspath()) as elf:
+        flash, ram = elf.memory_usage()
+
+    stats_path = join(env.subst("$BUILD_DIR"), "profile_stats.json")
+    stats = {}
+    if isfile(stats_path):
+        with open(stats_path) as f:
+            stats = json.load(f)
+    stats[profile] = {"link_time": round(link_time, 3), "flash": flash, "ram": ram}
+    with open(stats_path, "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+    print("Profile %s: linked in %.2fs, flash %d B, RAM %d B" % (
+        profile, link_time, flash, ram))
+    for other, data in sorted(stats.items()):
+        if other == profile:
+            continue
+        print("  vs %s: link %+.2fs, flash %+d B, RAM %+d B" % (
+            other, link_time - data["link_time"],
+            flash - data["flash"], ram - data["ram"]))
+
+
+if target_elf and "nobuild" not in COMMAND_LINE_TARGETS:
+    env.AddPreAction(target_elf, _start_link_timer)
+    env.AddPostAction(target_elf, env.VerboseAction(
+        _traced(_report_profile, "profile report"), "Reporting build profile"))
 
 AlwaysBuild(env.Alias("nobuild", target_firm))
 target_buildprog = env.Alias("buildprog", target_firm, target_firm)
@@ -102,28 +370,165 @@ target_buildasm = env.Alias("disassembling", target_asm, target_asm)
 #
 # Target: Export Symbols
 #
-target_symbols = env.Alias(
-    "symbols", target_elf,
-    env.VerboseAction(" ".join([
-        "$NMTOOL",
-        "--print-size",
-        "--size-sort",
-        "-gC",
-        "$SOURCES",
-        ">",
-        join("$BUILD_DIR","symbols_${PROGNAME}.txt")
-    ]),"Exporting Symbols"))
-AlwaysBuild(target_symbols)
+target_symbols = env.Alias("symbols", artifact_nodes["symbols"])
 
 #
 # Target: Print binary size
 #
 
 target_size = env.Alias(
-    "size", target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
+    "size", artifact_nodes["size"][0],
+    env.VerboseAction(_traced(_print_size, "size"), "Calculating size ${PROGNAME}.elf"))
 AlwaysBuild(target_size)
 
+#
+# Target: Memory report from the linker map, attributed to libraries,
+# objects and symbols, compared with a stored baseline
+#
+
+memory_baseline = board.get(
+    "build.memory_report.baseline",
+    join("$PROJECT_DIR", "memory_baseline_${PIOENV}.json"))
+
+
+def _memory_budgets():
+    """``FLASH:14K, RAM:3K, driver:FLASH:4K`` -> {"FLASH": 14336, ...}"""
+    budgets = {}
+    for item in board.get("build.memory_report.budget", "").replace("\n", ",").split(","):
+        if item.strip():
+            key, size = item.strip().rsplit(":", 1)
+            budgets[key.strip()] = objcache.parse_size(size)
+    return budgets
+
+
+def _load_memory_report(env):
+    # written by the hash-gated ``map`` artifact
+    path = artifacts.outputs("map", env.subst("$BUILD_DIR"), env.subst("$PROGNAME"))[0]
+    with open(path) as f:
+        return json.load(f)
+
+
+def _memory_report(target, source, env):
+    report = _load_memory_report(env)
+
+    baseline = None
+    baseline_path = env.subst(memory_baseline)
+    if isfile(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    print(mapfile.format_report(
+        report, int(board.get("build.memory_report.top", 10)), baseline), end="")
+    if not baseline:
+        print("No baseline yet, save one with `pio run -t memory_baseline`")
+
+    errors = mapfile.check_budgets(report, _memory_budgets())
+    for error in errors:
+        sys.stderr.write("Error: %s\n" % error)
+    if errors:
+        env.Exit(1)
+
+
+def _memory_baseline(target, source, env):
+    report = _load_memory_report(env)
+    with open(env.subst(memory_baseline), "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Memory baseline saved to %s" % env.subst(memory_baseline))
+
+
+env.AddCustomTarget(
+    name="memory_report",
+    dependencies=artifact_nodes["map"],
+    actions=_traced(_memory_report, "memory report"),
+    title="Memory Report",
+    description="Flash/RAM usage per library, object and symbol, with baseline diff")
+
+env.AddCustomTarget(
+    name="memory_baseline",
+    dependencies=artifact_nodes["map"],
+    actions=_traced(_memory_baseline, "memory baseline"),
+    title="Save Memory Baseline",
+    description="Store the current memory report as the baseline")
+
+if board.get("build.memory_report.on_build", "no") == "yes" and "nobuild" not in COMMAND_LINE_TARGETS:
+    Default(artifact_nodes["map"])
+    env.AddPostAction(artifact_nodes["map"][0], env.VerboseAction(
+        _traced(_memory_report, "memory report"), "Reporting memory usage"))
+
+#
+# Target: Worst-case stack depth per entry point (main, reset, interrupt
+# handlers and the configured task functions)
+#
+
+
+def _stack_report(target, source, env):
+    if not stack_usage_enabled:
+        sys.stderr.write("Error! Set board_build.stack_usage = yes to build "
+                         "with the stack usage information.\n")
+        env.Exit(1)
+    tasks = [t.strip() for t in board.get("build.stack_usage_tasks", "").split(",")
+             if t.strip()]
+    entries = stackusage.analyse(
+        source[0].get_abspath(), env.subst("$BUILD_DIR"), tasks,
+        fpu=env.get("FLOAT_ABI", "soft") != "soft")
+    report = stackusage.format_report(entries)
+    print(report, end="")
+    build_dir = env.subst("$BUILD_DIR")
+    with open(join(build_dir, "stack_report.txt"), "w") as f:
+        f.write(report)
+    with open(join(build_dir, "stack_report.json"), "w") as f:
+        json.dump(stackusage.to_json(entries), f, indent=1)
+
+
+env.AddCustomTarget(
+    name="stack_report",
+    dependencies=target_elf,
+    actions=_traced(_stack_report, "stack report"),
+    title="Stack Report",
+    description="Worst-case stack depth of main, interrupt handlers and tasks")
+
+if stack_usage_enabled and "nobuild" not in COMMAND_LINE_TARGETS:
+    env.AddPostAction(target_elf, env.VerboseAction(
+        _traced(_stack_report, "stack report"), "Analysing stack usage"))
+
+#
+# Hot code placement check: the hot code must end inside the zero-wait
+# flash, see at32tools/hotcode.py
+#
+
+
+def _hot_code_report(target, source, env):
+    region = env["HOT_CODE_REGION"]
+    zw_end = env.get("HOT_CODE_ZW_END")
+    try:
+        start, end, functions, spilled, missing = hotcode.check(
+            target[0].get_abspath(), region,
+            hotcode.parse_patterns(board.get("build.hot_code", "")), zw_end)
+    except (OSError, ElfError, hotcode.HotCodeError) as e:
+        sys.stderr.write("Warning! Cannot check the hot code: %s\n" % e)
+        return
+    print("Hot code: %d bytes in %s at 0x%08X-0x%08X, %d function(s)" % (
+        end - start, "SRAM" if region == "sram" else "flash", start, end,
+        len(functions)))
+    if spilled:
+        sys.stderr.write(
+            "Warning! %d bytes of hot code are past the zero-wait flash "
+            "(ends at 0x%08X): %s\n" % (
+                end - max(start, zw_end), zw_end,
+                ", ".join(name for name, _, _ in spilled)))
+    if missing:
+        sys.stderr.write(
+            "Warning! Hot functions not placed (inlined, removed or named "
+            "differently): %s\n" % ", ".join(missing))
+
+
+if "nobuild" not in COMMAND_LINE_TARGETS and (
+        env.get("HOT_CODE_REGION") or board.get("build.sram_size", "")):
+    # the generated linker script is only rewritten when it changes
+    env.Depends(target_elf, env.subst("$LDSCRIPT_PATH"))
+if env.get("HOT_CODE_REGION") and "nobuild" not in COMMAND_LINE_TARGETS:
+    env.AddPostAction(target_elf, env.VerboseAction(
+        _traced(_hot_code_report, "hot code check"), "Checking hot code placement"))
+
 #
 # Target: Upload by default .bin file
 #
@@ -133,16 +538,34 @@ debug_tools = board.get("debug.tools", {})
 upload_source = target_firm
 upload_actions = []
 
+
+def _upload_segments(source):
+    """``[(address, path)]`` when the uploaded .bin is the first of several
+    image segments, None otherwise."""
+    image = source[0].get_abspath()
+    if not image.endswith(".bin"):
+        return None
+    result = segments.load(image[:-len(".bin")])
+    return result if result and len(result) > 1 else None
+
+
+def _program_commands(source):
+    """OpenOCD ``program`` commands for the upload image, one per segment."""
+    image = source[0].get_abspath()
+    targets = [(board.get("upload.offset_address", ""), image)]
+    if _upload_segments(source):
+        targets = [("0x%08X" % a, path) for a, path in _upload_segments(source)]
+    commands = ["program {%s} %s verify" % (path.replace("\\", "/"), address)
+                for address, path in targets]
+    commands[-1] += " reset"
+    return commands
+
 if upload_protocol in debug_tools:
     openocd_args = [
         "-d%d" % (2 if int(ARGUMENTS.get("PIOVERBOSE", 0)) else 1)
     ]
     openocd_args.extend(
         debug_tools.get(upload_protocol).get("server").get("arguments", []))
-    openocd_args.extend([
-        "-c", "program {$SOURCE} %s verify reset; shutdown;" %
-        board.get("upload.offset_address", "")
-    ])
     openocd_args = [
         f.replace("$PACKAGE_DIR",
                   platform.get_package_dir("tool-openocd-at32") or "")
@@ -152,12 +575,135 @@ if upload_protocol in debug_tools:
         UPLOADER=join(
             platform.get_package_dir("tool-openocd-at32") or "",
             "bin-"+ get_systype(), "openocd.exe" if system()=="Windows" else "openocd"),
-        UPLOADERFLAGS=openocd_args,
+        OPENOCDFLAGS=openocd_args,
+        UPLOADERFLAGS=openocd_args + [
+            "-c", "program {$SOURCE} %s verify reset; shutdown;" %
+            board.get("upload.offset_address", "")
+        ],
         UPLOADCMD="$UPLOADER $UPLOADERFLAGS")
 
+    def _prepare_openocd_upload(target, source, env):
+        if _upload_segments(source):
+            env.Replace(UPLOADERFLAGS=env["OPENOCDFLAGS"] + [
+                "-c", "; ".join(_program_commands(source)) + "; shutdown;"])
+
     if not board.get("upload").get("offset_address"):
         upload_source = target_elf
-    upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+    upload_actions = [
+        env.Action(_prepare_openocd_upload, None),
+        env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
+    ]
+
+    # Each of these replaces the OpenOCD upload action, they do not combine
+    upload_modes = [
+        option for option, enabled in (
+            ("board_upload.delta_flash", board.get("upload.delta_flash", "no") == "yes"),
+            ("board_upload.persistent_server",
+             board.get("upload.persistent_server", "no") == "yes"),
+            ("board_upload.probes", bool(board.get("upload.probes", "").strip())),
+        ) if enabled
+    ]
+    if len(upload_modes) > 1:
+        sys.stderr.write("Error! %s cannot be combined, set only one of them\n" % (
+            " and ".join(upload_modes)))
+        env.Exit(1)
+
+    if board.get("upload.delta_flash", "no") == "yes":
+
+        def _delta_upload(target, source, env):
+            image = source[0].get_abspath()
+            with open(image, "rb") as f:
+                data = f.read()
+            base = int(board.get("upload.offset_address", "") or str(FLASH_ORIGIN), 0)
+            extra = _upload_segments(source) or []
+            if extra:
+                base, extra = extra[0][0], extra[1:]
+            sector_size = int(board.get(
+                "upload.sector_size", deltaflash.DEFAULT_SECTOR_SIZE))
+            probe = "-".join(p for p in (
+                upload_protocol, env.subst("$UPLOAD_PORT")) if p)
+            target_id = "%s:%s" % (probe, board.get("debug.openocd_target", ""))
+            record_dir = join(env.subst("$BUILD_DIR"), "deltaflash")
+            record = join(record_dir, "last_%s.json" % "".join(
+                c if c.isalnum() or c in "-_." else "_" for c in probe))
+
+            runs = deltaflash.changed_runs(
+                data, base, sector_size, deltaflash.load_record(record), target_id)
+            print("Delta flash: " + deltaflash.describe(runs, sector_size, len(data)))
+            if runs is None:
+                runs = [(0, len(data))]
+            script = join(record_dir, "upload.cfg")
+            with open(script, "w") as f:
+                f.write(deltaflash.openocd_script(
+                    image, base, runs, join(record_dir, "chunks"), extra))
+
+            # Forget the record first: an interrupted upload must not
+            # leave one that claims sectors were written
+            deltaflash.forget(record)
+            if env.Execute(env.VerboseAction(
+                    '$UPLOADER $OPENOCDFLAGS -f "%s"' % script,
+                    "Flashing changed sectors")):
+                env.Exit(1)
+            deltaflash.save_record(record, data, base, sector_size, target_id)
+
+        upload_source = target_firm
+        upload_actions = [env.VerboseAction(_delta_upload, "Uploading $SOURCE")]
+
+    if board.get("upload.persistent_server", "no") == "yes":
+        # Same executable and arguments as the debug server, so uploads
+        # and debug sessions share one OpenOCD (see platform.py)
+        server_args = [
+            f.replace("$PACKAGE_DIR",
+                      platform.get_package_dir("tool-openocd-at32") or "")
+            for f in debug_tools.get(upload_protocol).get("server").get("arguments", [])
+        ]
+        server_key = ocdserver.server_key(upload_protocol, env.subst("$UPLOAD_PORT"))
+
+        def _server_upload(target, source, env):
+            try:
+                state = ocdserver.run(
+                    env.subst("$UPLOADER"), server_args, server_key,
+                    "; ".join(_program_commands(source)))
+            except ocdserver.OcdServerError as e:
+                sys.stderr.write("Error! %s\n" % e)
+                env.Exit(1)
+            print("Programmed through the OpenOCD server (pid %d, GDB port %d)" % (
+                state["pid"], state["gdb_port"]))
+
+        def _stop_openocd(target, source, env):
+            if not ocdserver.stop(server_key):
+                print("No OpenOCD server is running for %s" % server_key)
+
+        upload_actions = [env.VerboseAction(_server_upload, "Uploading $SOURCE")]
+        env.AddCustomTarget(
+            name="stop_openocd",
+            dependencies=None,
+            actions=_stop_openocd,
+            title="Stop OpenOCD Server",
+            description="Stop the persistent OpenOCD server of this probe")
+
+    probes = [p.strip() for p in board.get("upload.probes", "").split(",") if p.strip()]
+    if probes:
+
+        def _multi_upload(target, source, env):
+            report_path = env.subst(board.get(
+                "upload.probes_report", join("$BUILD_DIR", "multiflash_report.json")))
+            try:
+                report = multiflash.flash_all(
+                    env.subst("$UPLOADER"), env["OPENOCDFLAGS"],
+                    probes, "; ".join(_program_commands(source)) + "; shutdown;",
+                    log_dir=join(env.subst("$BUILD_DIR"), "multiflash"))
+                print(multiflash.format_report(report), end="")
+                multiflash.write_report(report, report_path)
+            except (OSError, ValueError) as e:
+                sys.stderr.write("Error! %s\n" % e)
+                env.Exit(1)
+            print("Report: %s" % report_path)
+            if report["failed"]:
+                env.Exit(1)
+
+        upload_actions = [env.VerboseAction(
+            _multi_upload, "Uploading $SOURCE to %d probes" % len(probes))]
 
 elif upload_protocol == "dfu":
     hwids = board.get("build.hwids", [["0x2E3C", "0xDF11"]])
@@ -173,27 +719,53 @@ elif upload_protocol == "dfu":
         "%s:leave" % board.get("upload.offset_address", "0x08000000"), "-D"
     ]
 
-    upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+    def _prepare_dfu_upload(target, source, env):
+        # A multi-region image goes up as a DfuSe container, which carries
+        # the address of every segment
+        if _upload_segments(source):
+            dfuse_path = join(env.subst("$BUILD_DIR"), env.subst("${PROGNAME}.dfu"))
+            dfu.build_dfuse(join(env.subst("$BUILD_DIR"), env.subst("${PROGNAME}.elf")),
+                            dfuse_path, int(vid, 16), int(pid, 16))
+            env.Replace(
+                UPLOADERFLAGS=env["UPLOADERFLAGS"][:-2] + [":leave", "-D"],
+                UPLOADCMD='$UPLOADER $UPLOADERFLAGS "%s"' % dfuse_path)
+
+    upload_actions = [
+        env.Action(_prepare_dfu_upload, None),
+        env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
+    ]
+
+    def _add_dfu_suffix(target, source, env):
+        dfu.add_suffix(join(env.subst("$BUILD_DIR"), env.subst("${PROGNAME}.bin")),
+                       int(vid, 16), int(pid, 16))
 
     # Add special DFU header to the binary image
     env.AddPostAction(
         join("$BUILD_DIR", "${PROGNAME}.bin"),
-        env.VerboseAction(
-            " ".join([
-                '"%s"' % join(platform.get_package_dir("tool-dfuutil") or "",
-                        "bin", "dfu-suffix"),
-                "-v %s" % vid,
-                "-p %s" % pid,
-                "-d 0xffff", "-a", "$TARGET"
-            ]), "Adding dfu suffix to ${PROGNAME}.bin"))
-    
+        env.VerboseAction(_traced(_add_dfu_suffix, "dfu suffix"),
+                          "Adding dfu suffix to ${PROGNAME}.bin"))
+
+    upload_source = target_firm
+
+    if board.get("upload.dfuse", "no") == "yes":
+        # DfuSe container with one element per contiguous block of the ELF,
+        # carrying its own addresses (no padding between regions)
+        def _build_dfuse(target, source, env):
+            dfu.build_dfuse(source[0].get_abspath(), target[0].get_abspath(),
+                            int(vid, 16), int(pid, 16))
+
+        upload_source = join("$BUILD_DIR", "${PROGNAME}.dfu")
+        if "nobuild" not in COMMAND_LINE_TARGETS:
+            upload_source = env.Command(
+                upload_source, target_elf,
+                env.VerboseAction(_traced(_build_dfuse, "dfuse"), "Building $TARGET"))
+        _upload_flags = _upload_flags[:-2] + [":leave", "-D"]
+
     env.Replace(
         UPLOADER=_upload_tool,
         UPLOADERFLAGS=_upload_flags,
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS "${SOURCE.get_abspath()}"')
 
-    upload_source = target_firm
-
 # custom upload tool
 elif upload_protocol == "custom":
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
@@ -203,6 +775,32 @@ else:
 
 AlwaysBuild(env.Alias("upload", upload_source, upload_actions))
 
+#
+# Target: Fill or refresh the local firmware library store for every BSP
+#
+
+def _prefetch_firmware(target, source, env):
+    store = board.get("build.at32firmlib.store",
+                      os.environ.get("AT32_FIRMWARE_STORE", ""))
+    if not store:
+        sys.stderr.write(
+            "Error! Set board_build.at32firmlib.store or AT32_FIRMWARE_STORE "
+            "to the firmware store directory.\n")
+        env.Exit(1)
+    results = fwstore.prefetch(
+        store, jobs=int(board.get("build.at32firmlib.prefetch_jobs", 8)),
+        mirror=board.get("build.at32firmlib.prefetch_mirror", "github"))
+    if not all(r["ok"] for r in results):
+        env.Exit(1)
+
+
+env.AddCustomTarget(
+    name="prefetch_firmware",
+    dependencies=None,
+    actions=_prefetch_firmware,
+    title="Prefetch Firmware Libraries",
+    description="Mirror every AT32 firmware library into the local store")
+
 #
 # Information about obsolete method of specifying linker scripts
 #
@@ -215,4 +813,7 @@ if any("-Wl,-T" in f for f in env.get("LINKFLAGS", [])):
 # Default targets
 #
 
-Default([target_buildprog, target_buildhex, target_symbols, target_size])
+Default([target_elf] + [
+    target_size if kind == "size" else artifact_nodes[kind]
+    for kind in default_artifacts
+])
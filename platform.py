@@ -14,45 +14,189 @@
 
 import json
 import os
-from os.path import isdir, isfile, join
+import sys
+from os.path import dirname, isdir, isfile, join
 
 from platform import system
 
 from platformio.managers.platform import PlatformBase
+from platformio.platform.board import PlatformBoardConfig
 from platformio.util import get_systype
 
+sys.path.insert(0, join(dirname(os.path.realpath(__file__)), "builder"))
+
+from at32tools import ocdserver, svdindex, svdstore  # noqa: E402
+
+DEBUG_LINKS = ("cmsis-dap", "atlink", "atlink_dap_v2", "jlink", "stlink")
+
+
+def manifest_from_index(entry):
+    """The board manifest src/board.tpl.json renders, rebuilt from its
+    misc/boards_index.json entry."""
+    return {
+        "build": {
+            "core": entry["core"],
+            "cpu": entry["cpu"],
+            "f_cpu": entry["f_cpu"],
+            "mcu": entry["mcu"],
+            "product_line": entry["product_line"],
+            "bsp": entry["bsp"],
+            "variant": entry["variant"],
+            "fpu": entry["fpu"],
+        },
+        "debug": {
+            "openocd_target": entry["openocd_target"],
+            "svd_path": entry["svd_path"],
+        },
+        "frameworks": list(entry["frameworks"]),
+        "name": entry["name"],
+        "upload": {
+            "maximum_ram_size": entry["ram"],
+            "maximum_size": entry["flash"],
+            "protocol": entry["protocol"],
+            "protocols": list(entry["protocols"]),
+        },
+        "url": entry["url"],
+        "vendor": entry["vendor"],
+    }
+
+
+class IndexedBoardConfig(PlatformBoardConfig):
+    """Board config of a generated board, built from the index instead of
+    loading boards/<id>.json."""
+
+    def __init__(self, manifest_path, manifest):  # pylint: disable=super-init-not-called
+        self._id = os.path.basename(manifest_path)[:-5]
+        self.manifest_path = manifest_path
+        self._manifest = manifest
+
+
 class Arterytekat32Platform(PlatformBase):
-    
+
+    _board_index = None
+
+    def board_index(self):
+        """Compact index of the generated boards (misc/boards_index.json),
+        written by src/generic_pio_board_generator.py."""
+        if Arterytekat32Platform._board_index is None:
+            index_path = join(self.get_dir(), "misc", "boards_index.json")
+            index = {}
+            if isfile(index_path):
+                with open(index_path) as f:
+                    index = json.load(f)
+            Arterytekat32Platform._board_index = index
+        return Arterytekat32Platform._board_index
+
+    def filter_boards(self, **criteria):
+        """Return the ids of indexed boards whose fields equal ``criteria``,
+        e.g. ``filter_boards(bsp="AT32F435_437", fpu="Yes")``."""
+        return sorted(
+            board_id for board_id, info in self.board_index().items()
+            if all(info.get(k) == v for k, v in criteria.items()))
+
     def configure_default_packages(self, variables, targets):
         board = variables.get("board")
-        board_config = self.board_config(board)
-
-        default_protocol = board_config.get("upload.protocol") or ""
+        indexed = self.board_index().get(board)
+        if indexed:
+            default_protocol = indexed.get("protocol", "")
+        else:
+            default_protocol = self.board_config(board).get("upload.protocol") or ""
         if variables.get("upload_protocol", default_protocol) == "dfu":
             self.packages["tool-dfuutil"]["optional"] = False
 
         return PlatformBase.configure_default_packages(self, variables, targets)
 
+    def _add_indexed_boards(self):
+        """Put the generated boards into PlatformIO's board cache from the
+        index, so listing them reads one file instead of every manifest.
+        PlatformBase.get_boards() only loads the manifests of boards that
+        are not cached yet: those of the project and core ``boards`` dirs,
+        which also take precedence over ours, and boards missing from the
+        index."""
+        boards_dir = join(self.get_dir(), "boards")
+        override_dirs = [
+            self.config.get("platformio", "boards_dir"),
+            join(self.config.get("platformio", "core_dir"), "boards"),
+        ]
+        for board_id, entry in self.board_index().items():
+            if board_id in self._BOARDS_CACHE:
+                continue
+            manifest_path = join(boards_dir, "%s.json" % board_id)
+            if not isfile(manifest_path) or any(
+                    isfile(join(d, "%s.json" % board_id)) for d in override_dirs if d):
+                continue
+            config = IndexedBoardConfig(manifest_path, manifest_from_index(entry))
+            config.manifest["platform"] = self.name
+            self._BOARDS_CACHE[board_id] = config
+
     def get_boards(self, id_=None):
+        if id_ is None:
+            self._add_indexed_boards()
         result = PlatformBase.get_boards(self, id_)
         if not result:
             return result
         if id_:
+            self._extract_svd(result)
             return self._add_default_debug_tools(result)
         else:
+            # Listing only needs the tool names and their default/onboard
+            # flags; the OpenOCD server configuration is materialised when
+            # a single board is requested (build, upload, debug)
             for key, value in result.items():
-                result[key] = self._add_default_debug_tools(result[key])
+                result[key] = self._add_default_debug_tools(
+                    result[key], lazy=True)
         return result
 
-    def _add_default_debug_tools(self, board):
+    def configure_debug_session(self, debug_config):
+        # With board_upload.persistent_server, GDB attaches to the OpenOCD
+        # server that uploads use instead of starting a second one
+        server = debug_config.server
+        if (debug_config.env_options.get("board_upload.persistent_server", "no") != "yes"
+                or not server or server.get("package") != "tool-openocd-at32"):
+            return
+        try:
+            state = ocdserver.ensure(
+                join(server["cwd"], server["executable"]), server["arguments"],
+                ocdserver.server_key(debug_config.tool_name,
+                                     debug_config.env_options.get("upload_port", "")))
+        except ocdserver.OcdServerError as e:
+            sys.stderr.write("Warning: %s\nStarting a separate OpenOCD.\n" % e)
+            return
+        debug_config.server = None
+        debug_config.port = "localhost:%d" % state["gdb_port"]
+
+    def _extract_svd(self, board):
+        """SVD files ship packed in misc/svd/at32_svd.store; unpack the one
+        this board uses into misc/svd, where debug clients look for it, and
+        compile its register index next to it."""
+        svd_name = board.manifest.get("debug", {}).get("svd_path")
+        svd_dir = join(self.get_dir(), "misc", "svd")
+        store = join(svd_dir, svdstore.STORE_NAME)
+        if not svd_name or os.path.isabs(svd_name) or not isfile(store):
+            return
+        try:
+            svdindex.ensure_index(svdstore.extract(store, svd_name, svd_dir))
+        except (OSError, svdstore.SvdStoreError, svdindex.SvdIndexError) as e:
+            sys.stderr.write("Warning: cannot extract %s: %s\n" % (svd_name, e))
+
+    def _add_default_debug_tools(self, board, lazy=False):
         debug = board.manifest.get("debug", {})
         upload_protocols = board.manifest.get("upload", {}).get(
             "protocols", [])
         if "tools" not in debug:
             debug['tools'] = {}
 
-        for link in ("cmsis-dap", "atlink", "atlink_dap_v2", "jlink", "stlink"):
-            if link not in upload_protocols or link in debug['tools']:
+        for link in DEBUG_LINKS:
+            if link not in upload_protocols:
+                continue
+            if link in debug['tools'] and not debug['tools'][link].get("lazy"):
+                continue
+            if lazy:
+                debug['tools'][link] = {
+                    "lazy": True,
+                    "onboard": link in debug.get("onboard_tools", []),
+                    "default": link in debug.get("default_tools", []),
+                }
                 continue
 
             server_args = ["-s", "$PACKAGE_DIR/scripts"]
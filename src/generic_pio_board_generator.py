@@ -1,14 +1,33 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+"""Generate boards/generic*.json and misc/boards_index.json from the AT32
+MCU selection table.
 
+The table is read either from the exported at32.csv or directly from the
+ArteryTek selection table workbook (.xlsx). Every row is validated before
+anything is written; only boards whose rendered manifest changed are
+rewritten, and boards that were dropped from the table are removed.
+
+    python src/generic_pio_board_generator.py
+    python src/generic_pio_board_generator.py --source src/ARTERY_AT32_MCU_Selection_Table_V202605.xlsx
+    python src/generic_pio_board_generator.py --check
+"""
+
+import argparse
 import csv
+import glob
+import json
 import os
 import re
-from collections import defaultdict
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
+from xml.etree import ElementTree
 
-rows = defaultdict(list)
-dirname = os.path.dirname(__file__)
+dirname = os.path.dirname(os.path.abspath(__file__))
+boards_dir = os.path.join(dirname, '..', 'boards')
+index_path = os.path.join(dirname, '..', 'misc', 'boards_index.json')
 
 bspDict = {
     'AT32A403A': ['AT32A403A'],
@@ -31,6 +50,29 @@ bspDict = {
     'AT32WB415': ['AT32WB415']
 }
 
+# Flash size code in the part number -> flash size in KB
+flashDict = {
+    '4': 16, '6': 32, '8': 64, 'B': 128, 'C': 256,
+    'D': 448, 'E': 512, 'G': 1024, 'M': 4032
+}
+
+coreDict = {'M4': 'cortex-m4', 'M0+': 'cortex-m0+'}
+
+# Selection table column (first line of the header cell) -> at32.csv column
+XLSX_COLUMNS = {
+    'Product Series': 'Product',
+    'Part No.': 'SKU',
+    'Core': 'Core',
+    'FPU': 'FPU',
+    'Speed': 'Speed',
+    'Flash': 'Flash',
+    'SRAM': 'SRAM',
+}
+CSV_COLUMNS = ['Product', 'SKU', 'Core', 'FPU', 'Speed', 'Flash', 'SRAM']
+
+SRAM_RE = re.compile(r'^\d+(\+\d+)?(/\d+(\+\d+)?)*$')
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
 
 def get_ocd_target(product, sku):
     # Flash size letter sits at position len(product)+1 in the SKU:
@@ -61,50 +103,286 @@ def get_bsp(product):
             return item
 
 
-with open(os.path.join(dirname, 'board.tpl.json'), "r") as template_file:
-    template = Template(template_file.read())
+def read_csv(path):
+    with open(path) as f:
+        for item in csv.DictReader(f, delimiter=','):
+            yield item
+
+
+def _xlsx_cell_text(cell, strings):
+    value = cell.find(XLSX_NS + 'v')
+    if value is None:
+        inline = cell.find(XLSX_NS + 'is')
+        if inline is None:
+            return ''
+        return ''.join(t.text or '' for t in inline.iter(XLSX_NS + 't'))
+    if cell.get('t') == 's':
+        return strings[int(value.text)]
+    return value.text or ''
+
+
+def read_xlsx(path):
+    """Stream the rows of the first sheet of the selection table workbook,
+    mapped to the at32.csv columns."""
+    with zipfile.ZipFile(path) as book:
+        strings = []
+        if 'xl/sharedStrings.xml' in book.namelist():
+            with book.open('xl/sharedStrings.xml') as f:
+                for _, elem in ElementTree.iterparse(f):
+                    if elem.tag == XLSX_NS + 'si':
+                        strings.append(''.join(
+                            t.text or '' for t in elem.iter(XLSX_NS + 't')))
+                        elem.clear()
 
-with open(os.path.join(dirname, 'at32.csv')) as f:
-    reader = csv.DictReader(f, delimiter=',')
-    for item in reader:
-        # when SRAM is by '96/224' format, means ram can be configured to 96K or 224K,
-        # when SRAM is by '96+6' format, means ram can be configured to 96K or 102K,
-        # we need to list all possible ram size for sram_options,
-        # and use the max size for sram_size
+        columns = None
+        with book.open('xl/worksheets/sheet1.xml') as f:
+            for _, elem in ElementTree.iterparse(f):
+                if elem.tag != XLSX_NS + 'row':
+                    continue
+                cells = {}
+                for cell in elem.findall(XLSX_NS + 'c'):
+                    column = re.match(r'[A-Z]+', cell.get('r')).group()
+                    cells[column] = _xlsx_cell_text(cell, strings).strip()
+                elem.clear()
 
+                if columns is None:
+                    # Header row: the one naming all the columns we need
+                    names = dict((v.split('\n')[0].strip(), k)
+                                 for k, v in cells.items())
+                    if all(name in names for name in XLSX_COLUMNS):
+                        columns = dict((names[name], key)
+                                       for name, key in XLSX_COLUMNS.items())
+                    continue
+                item = dict((key, cells.get(column, ''))
+                            for column, key in columns.items())
+                # Footnotes and blank rows after the table
+                if not item['SKU'].startswith('AT32'):
+                    continue
+                yield item
 
-        sram_sizes = item['SRAM'].split('/')
-        possible_sram_sizes = []
-        sram_options = []
-        for size in sram_sizes:
+        if columns is None:
+            raise ValueError('%s: no selection table header found' % path)
+
+
+def read_table(path):
+    if path.lower().endswith('.xlsx'):
+        return list(read_xlsx(path))
+    return list(read_csv(path))
+
+
+def prepare_row(item):
+    """Compute the template fields of a table row. Raises ValueError with
+    every problem found in the row."""
+    errors = []
+    sku = item.get('SKU', '')
+    product = item.get('Product', '')
+
+    for column in CSV_COLUMNS:
+        if not item.get(column):
+            errors.append('missing %s' % column)
+    if errors:
+        raise ValueError(', '.join(errors))
+
+    if not sku.startswith(product):
+        errors.append('part number does not start with %s' % product)
+
+    # when SRAM is by '96/224' format, means ram can be configured to 96K or 224K,
+    # when SRAM is by '96+6' format, means ram can be configured to 96K or 102K,
+    # we need to list all possible ram size for sram_options,
+    # and use the max size for sram_size
+    sram_options = []
+    possible_sram_sizes = []
+    if SRAM_RE.match(item['SRAM']):
+        for size in item['SRAM'].split('/'):
             if '+' in size:
                 min_size, extra_size = size.split('+')
                 sram_options.append(min_size + 'K')
                 sram_options.append(str(int(min_size) + int(extra_size)) + 'K')
 
-                possible_sram_sizes.append(min_size)
-                possible_sram_sizes.append(str(int(min_size) + int(extra_size)))
+                possible_sram_sizes.append(int(min_size))
+                possible_sram_sizes.append(int(min_size) + int(extra_size))
             else:
                 sram_options.append(size + 'K')
-                possible_sram_sizes.append(size)
-        item['sram_options'] = '/'.join(sram_options)
-        item['sram_size'] = max([int(size) for size in possible_sram_sizes]) * 1024
-        
-
-        item['SKU'] = item['SKU']
-        item['variant'] = item['SKU'].replace('-','_')
-        item['cpu_type'] = {'M4': 'cortex-m4', 'M0+': 'cortex-m0+'}.get(item['Core'], 'cortex-m4')
-        item['fpu'] = item['FPU']  # "Yes" or "No"
-        item['f_cpu'] = int(item['Speed']) * 1000000
-        item['flash_size'] = int(item['Flash'])*1024
-        item['ocd_target'] = get_ocd_target(item['Product'], item["SKU"])
-        item['product_flash_series'] = item['Product'] + \
-            'x' + item['SKU'].replace(item['Product'], '')[1]
-        item['bsp'] = get_bsp(item['Product'])
-        rows[item['SKU']] = item
-
-for item in rows:
-    # print(rows[item])
-    # print(template.substitute(rows[item]))
-    with open(os.path.join(dirname, '../boards/generic{}.json'.format(item)), 'w') as out:
-        out.write(template.substitute(rows[item]))
+                possible_sram_sizes.append(int(size))
+    else:
+        errors.append('unrecognised SRAM %r' % item['SRAM'])
+
+    flash_letter = sku[len(product) + 1] if len(sku) > len(product) + 1 else '?'
+    if flash_letter not in flashDict:
+        errors.append('unknown flash code %r' % flash_letter)
+    elif not item['Flash'].isdigit() or flashDict[flash_letter] != int(item['Flash']):
+        errors.append('flash code %r does not match %sK flash' % (
+            flash_letter, item['Flash']))
+
+    if item['Core'] not in coreDict:
+        errors.append('unknown core %r' % item['Core'])
+    if item['FPU'] not in ('Yes', 'No'):
+        errors.append('FPU must be Yes or No, not %r' % item['FPU'])
+    if not item['Speed'].isdigit():
+        errors.append('unrecognised speed %r' % item['Speed'])
+
+    bsp = get_bsp(product)
+    if not bsp:
+        errors.append('%s has no BSP in bspDict' % product)
+
+    if errors:
+        raise ValueError(', '.join(errors))
+
+    row = dict((column, item[column]) for column in CSV_COLUMNS)
+    row['sram_options'] = '/'.join(sram_options)
+    row['sram_size'] = max(possible_sram_sizes) * 1024
+    row['variant'] = sku.replace('-', '_')
+    row['cpu_type'] = coreDict[item['Core']]
+    row['fpu'] = item['FPU']  # "Yes" or "No"
+    row['f_cpu'] = int(item['Speed']) * 1000000
+    row['flash_size'] = int(item['Flash']) * 1024
+    row['ocd_target'] = get_ocd_target(product, sku)
+    row['product_flash_series'] = product + 'x' + flash_letter
+    row['bsp'] = bsp
+    return row
+
+
+def validate(items):
+    """Return ``(rows, errors)``; rows are keyed by part number."""
+    rows = {}
+    errors = []
+    for number, item in enumerate(items, 1):
+        sku = item.get('SKU') or 'row %d' % number
+        try:
+            row = prepare_row(item)
+        except ValueError as e:
+            errors.append('%s: %s' % (sku, e))
+            continue
+        if sku in rows:
+            errors.append('%s: duplicate part number' % sku)
+            continue
+        rows[sku] = row
+    return rows, errors
+
+
+def index_entry(manifest):
+    """Index fields of a board; they hold the whole manifest, so that
+    platform.py can list the boards from the index alone."""
+    return {
+        'name': manifest['name'],
+        'vendor': manifest['vendor'],
+        'url': manifest['url'],
+        'frameworks': manifest['frameworks'],
+        'core': manifest['build']['core'],
+        'variant': manifest['build']['variant'],
+        'mcu': manifest['build']['mcu'],
+        'cpu': manifest['build']['cpu'],
+        'fpu': manifest['build']['fpu'],
+        'f_cpu': manifest['build']['f_cpu'],
+        'flash': manifest['upload']['maximum_size'],
+        'ram': manifest['upload']['maximum_ram_size'],
+        'bsp': manifest['build']['bsp'],
+        'product_line': manifest['build']['product_line'],
+        'openocd_target': manifest['debug']['openocd_target'],
+        'svd_path': manifest['debug']['svd_path'],
+        'protocol': manifest['upload']['protocol'],
+        'protocols': manifest['upload']['protocols'],
+    }
+
+
+def _read(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def render(template, sku, row):
+    """Return ``(path, content, status)``; status is ``added``, ``changed``
+    or None when the board on disk is already up to date."""
+    path = os.path.join(boards_dir, 'generic{}.json'.format(sku))
+    content = template.substitute(row)
+    json.loads(content)  # the template must render valid JSON
+    current = _read(path)
+    if current is None:
+        return path, content, 'added'
+    if current != content:
+        return path, content, 'changed'
+    return path, content, None
+
+
+def generate(source, jobs=None, check=False, keep_removed=False, log=print):
+    """Regenerate the boards from ``source``. Returns the process exit
+    code."""
+    rows, errors = validate(read_table(source))
+    if errors:
+        for error in errors:
+            log('error: %s' % error)
+        log('%d invalid rows in %s, nothing written' % (len(errors), source))
+        return 1
+
+    with open(os.path.join(dirname, 'board.tpl.json'), "r") as template_file:
+        template = Template(template_file.read())
+
+    with ThreadPoolExecutor(jobs) as pool:
+        results = list(pool.map(
+            lambda sku: render(template, sku, rows[sku]), sorted(rows)))
+
+    wanted = set(os.path.normpath(path) for path, _, _ in results)
+    removed = sorted(
+        path for path in glob.glob(os.path.join(boards_dir, 'generic*.json'))
+        if os.path.normpath(path) not in wanted and not keep_removed)
+
+    # Compact index of all generated boards, used by platform.py to look up
+    # and filter boards without loading every manifest
+    index = {}
+    for path, content, _ in results:
+        index[os.path.basename(path)[:-5]] = index_entry(json.loads(content))
+    index_content = json.dumps(index, separators=(',', ':'), sort_keys=True) + '\n'
+    index_changed = _read(index_path) != index_content
+
+    report = {'added': [], 'changed': [], 'removed': []}
+    for path, content, status in results:
+        if status:
+            report[status].append(os.path.basename(path))
+    report['removed'] = [os.path.basename(path) for path in removed]
+
+    for status in ('added', 'changed', 'removed'):
+        for name in report[status]:
+            log('%-8s %s' % (status, name))
+    log('%d boards: %d added, %d changed, %d removed, %d unchanged' % (
+        len(results), len(report['added']), len(report['changed']),
+        len(report['removed']),
+        len(results) - len(report['added']) - len(report['changed'])))
+
+    if check:
+        return 1 if any(report.values()) or index_changed else 0
+
+    for path, content, status in results:
+        if status:
+            with open(path, 'w') as out:
+                out.write(content)
+    for path in removed:
+        os.remove(path)
+    if index_changed:
+        with open(index_path, 'w') as out:
+            out.write(index_content)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate the generic AT32 boards from the MCU selection table')
+    parser.add_argument(
+        '--source', default=os.path.join(dirname, 'at32.csv'),
+        help='selection table, at32.csv or the ArteryTek .xlsx workbook')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of boards rendered in parallel')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='only report differences, exit 1 if the boards are out of date')
+    parser.add_argument(
+        '--keep-removed', action='store_true',
+        help='do not delete boards that are no longer in the table')
+    args = parser.parse_args(argv)
+    return generate(args.source, args.jobs, args.check, args.keep_removed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())